@@ -1,11 +1,103 @@
-from core import *
-from repairs import *
-from products import *
-from returns import *
-from comms import *
-from diagnostics import *
-from parts import *
-from comptia import *
-from escalations import *
-from lookups import *
-from orders import *
+# -*- coding: utf-8 -*-
+"""
+The submodules are imported on first attribute access so that
+"import gsxws" doesn't pull in requests and lxml until they're needed.
+gsxws.Product, from gsxws import Repair etc work as before.
+"""
+
+import sys
+import pkgutil
+import importlib
+
+from types import ModuleType
+
+# Submodules in the order they used to be star-imported, later ones win
+MODULES = ('core', 'repairs', 'products', 'returns', 'comms', 'diagnostics',
+           'parts', 'comptia', 'escalations', 'lookups', 'orders',)
+
+# Where the public names live, so accessing one imports just that module
+EXPORTS = {
+    'core': ('ENVIRONMENTS', 'GSX_ENV', 'GSX_HOSTS', 'GSX_LANG', 'GSX_LOCALE',
+             'GSX_REGION', 'GSX_REGIONS', 'GSX_SESSION', 'GSX_TIMEOUT',
+             'GSX_TIMEZONE', 'GSX_TIMEZONES', 'GSX_URL', 'GSX_WORKERS',
+             'GSX_BREAKER_THRESHOLD', 'GSX_BREAKER_TIMEOUT', 'GSX_COMPRESS',
+             'GSX_COMPRESS_MIN', 'GSX_CHUNK_SIZE', 'GSX_PARSE_PROCESSES',
+             'GSX_PARSE_MIN', 'GSX_PARSE_TIMEOUT', 'REGION_CODES',
+             'VERSION', 'GsxError', 'GsxEmptyResult', 'GsxCircuitOpen', 'CircuitBreaker', 'GsxCache',
+             'GsxRequest', 'GsxResponse', 'GsxObject', 'GsxRequestObject',
+             'GsxSession', 'ResponseReader', 'gzip', 'connect', 'validate', 'chunked', 'pmap', 'submit_batch', 'get_format',
+             'circuit_status', 'parse_pool', 'parse_offloaded',),
+    'repairs': ('COMPLETE_BATCH_SIZE', 'COVERAGE_STATUSES', 'EVENT_CLOSED',
+                'EVENT_NEW', 'EVENT_STATUS', 'REPAIR_STATUSES', 'REPAIR_TYPES',
+                'STATUS_BATCH_SIZE', 'CannotDuplicateRepair', 'CarryInRepair',
+                'CompTiaCode', 'ComponentCheck', 'Customer', 'IndirectOnsiteRepair',
+                'MailInRepair', 'Repair', 'RepairOrReplace', 'RepairOrderLine',
+                'RepairSync', 'ServicePart', 'SymptomIssue', 'WholeUnitExchange',
+                'mark_complete_many', 'status_many', 'RepairDetails', 'RepairStatus',),
+    'products': ('INTAKE_CALLS', 'RECORD_CALLS', 'Product', 'models', 'Dossier',
+                 'intake', 'WarrantyInfo', 'ActivationInfo', 'ModelInfo', 'ModelIndex',
+                 'serial_suffix', 'use_model_index',),
+    'returns': ('BULK_RETURN_SIZE', 'CARRIERS', 'RETURN_TYPES', 'Return',
+                'download_labels', 'register_bulk', 'update_parts_many',),
+    'comms': ('ACK_BATCH_SIZE', 'CommsSync', 'Communication', 'ack', 'content',),
+    'diagnostics': ('Diagnostics', 'DiagnosticsTable', 'event_numbers', 'harvest',),
+    'parts': ('IMAGE_URL', 'REASON_CODES', 'Part', 'prefetch_images',),
+    'comptia': ('GROUPS', 'MODIFIERS', 'CompTIA', 'fetch',),
+    'escalations': ('CONTEXTS', 'ISSUE_TYPES', 'STATUSES', 'STATUS_CLOSED',
+                    'STATUS_ESCALATED', 'STATUS_OPEN', 'Context', 'Escalation',
+                    'FileAttachment',),
+    'lookups': ('REPAIR_LOOKUP_LIMIT', 'HashingWriter', 'Lookup',
+                'harvest_invoices', 'PartInfo', 'RepairSummary',),
+    'orders': ('APPOrder', 'OrderLine', 'StockingOrder',),
+}
+
+_exports = dict((n, m) for m, names in EXPORTS.items() for n in names)
+
+
+class LazyModule(ModuleType):
+    def _submodule(self, name):
+        return importlib.import_module('%s.%s' % (self.__name__, name))
+
+    def _submodules(self):
+        return [m[1] for m in pkgutil.iter_modules(self.__path__)]
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+
+        if name in _exports:
+            value = getattr(self._submodule(_exports[name]), name)
+            setattr(self, name, value)
+            return value
+
+        if name in self._submodules():
+            return self._submodule(name)
+
+        # Anything else the star imports used to bring in (date, logging...)
+        for m in reversed(MODULES):
+            module = self._submodule(m)
+            if not name.startswith('_') and hasattr(module, name):
+                value = getattr(module, name)
+                setattr(self, name, value)
+                return value
+
+        raise AttributeError("module %r has no attribute %r" % (self.__name__, name))
+
+    @property
+    def __all__(self):
+        names = {}
+        for m in MODULES:
+            for k in dir(self._submodule(m)):
+                if not k.startswith('_'):
+                    names[k] = True
+        return sorted(names)
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_exports))
+
+
+_module = sys.modules[__name__]
+_lazy = LazyModule(__name__, __doc__)
+_lazy.__dict__.update(_module.__dict__)
+_lazy._module = _module  # py2 clears a module's globals when it's collected
+sys.modules[__name__] = _lazy
@@ -1,6 +1,13 @@
 # -*- coding: utf-8 -*-
 
-from core import GsxObject
+import shelve
+import logging
+import threading
+
+from core import GsxObject, GsxError, GsxEmptyResult, chunked, pmap
+
+# Maximum number of acknowledgements per AcknowledgeCommunication request
+ACK_BATCH_SIZE = 50
 
 
 class Communication(GsxObject):
@@ -46,6 +53,103 @@ def ack(id, status):
     return Communication(acknowledgement=ack).acknowledge()
 
 
+def _todict(el):
+    return dict((c.tag, c.text) for c in el.iterchildren())
+
+
+class CommsSync(object):
+    """
+    Local store of service news articles and their content keyed by articleID.
+    sync() only fetches the content of articles that aren't in the store yet,
+    and acknowledgements are queued and sent in batches.
+
+    >>> s = CommsSync('/tmp/comms')
+    >>> s.sync(priority='HIGH') # doctest: +ELLIPSIS
+    ['SN3133', ...
+    >>> s.ack('SN3133', 'READ')
+    >>> s.flush()
+    """
+    def __init__(self, path, workers=None, batch_size=ACK_BATCH_SIZE):
+        self.shelf = shelve.open(path, protocol=-1)
+        self.workers = workers
+        self.batch_size = batch_size
+        self._acks = []
+        self._lock = threading.Lock()
+
+    def __contains__(self, id):
+        return str(id) in self.shelf
+
+    def __getitem__(self, id):
+        return self.shelf[str(id)]
+
+    def articles(self):
+        return self.shelf.values()
+
+    def sync(self, **kwargs):
+        """
+        Fetches the list of active articles and the content of new ones.
+        Returns the IDs of the articles that were added.
+        """
+        try:
+            articles = fetch(**kwargs)
+        except GsxEmptyResult:
+            articles = []  # no active articles
+
+        new = dict((str(a.articleID), _todict(a)) for a in articles
+                   if str(a.articleID) not in self.shelf)
+
+        for id, result in pmap(content, new.keys(), self.workers):
+            if isinstance(result, GsxError):
+                logging.error("Failed to fetch article %s: %s" % (id, result))
+                continue
+
+            article = new[id]
+            article['content'] = _todict(result)
+            self.shelf[id] = article
+
+        self.shelf.sync()
+        return [id for id in new if id in self.shelf]
+
+    def ack(self, id, status):
+        """Queues an acknowledgement, flushing the queue once it's full."""
+        ack = GsxObject(articleID=id)
+        ack.acknowledgeType = status
+
+        with self._lock:
+            self._acks.append(ack)
+            full = len(self._acks) >= self.batch_size
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Sends all queued acknowledgements. The batches that fail are
+        queued again and the first error is raised once the rest are sent.
+        """
+        with self._lock:
+            acks, self._acks = self._acks, []
+
+        failed, error = [], None
+
+        for batch in chunked(acks, self.batch_size):
+            try:
+                Communication(acknowledgement=batch).acknowledge()
+            except GsxError as e:
+                failed.extend(batch)
+                error = error or e
+
+        if failed:
+            # Requeue so the next flush can retry
+            with self._lock:
+                self._acks[:0] = failed
+            raise error
+
+    def close(self):
+        self.flush()
+        self.shelf.close()
+
+
 if __name__ == '__main__':
     import sys
     import doctest
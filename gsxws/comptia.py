@@ -45,7 +45,7 @@ class CompTIA(GsxObject):
         self._comptia = {}
         self._cache = GsxCache("comptia")
 
-    def fetch(self):
+    def fetch(self, refresh=False):
         """
         Description:
         The CompTIA Codes Lookup API retrieves a list of CompTIA groups and modifiers.
@@ -59,8 +59,10 @@ class CompTIA(GsxObject):
 
         >>> CompTIA().fetch() # doctest: +ELLIPSIS
         {u'A': {'989': u'Remote Inoperable', ...
+
+        refresh=True skips the cache and stores the fresh codes in it.
         """
-        if self._cache.get('comptia'):
+        if not refresh and self._cache.get('comptia'):
             return self._cache.get('comptia')
 
         doc = self._submit("ComptiaCodeLookupRequest", "ComptiaCodeLookup",
@@ -26,18 +26,31 @@ OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMA
 
 import os
 import re
+import zlib
 import json
 import base64
 import shelve
 import os.path
+import socket
+import httplib
 import hashlib
 import logging
 import requests
 import tempfile
+import threading
+import multiprocessing
+import binascii
+import metrics
+import tracing
 import objectify
+import xml.sax
 import xml.etree.ElementTree as ET
 
+from itertools import islice
+from timeit import default_timer as clock
+from multiprocessing.pool import ThreadPool
 from datetime import date, time, datetime, timedelta
+from requests.packages.urllib3.exceptions import HTTPError as TransportError
 
 VERSION     = "0.92"
 
@@ -46,6 +59,18 @@ GSX_LANG    = "en"
 GSX_REGION  = "emea"
 GSX_LOCALE  = "en_XXX"
 GSX_TIMEOUT = 30 # session timeout (expiration) in minutes
+GSX_WORKERS = 4  # concurrent requests for the bulk operations
+
+GSX_COMPRESS = True        # gzip request bodies of at least GSX_COMPRESS_MIN bytes
+GSX_COMPRESS_MIN = 8192
+GSX_CHUNK_SIZE = 64 * 1024  # bytes read from the socket at a time
+
+GSX_PARSE_PROCESSES = 0     # processes parsing large responses into dicts, 0 to disable
+GSX_PARSE_MIN = 1024 * 1024 # bytes of XML that make a response large
+GSX_PARSE_TIMEOUT = 60      # seconds to wait for a parse process
+
+GSX_BREAKER_THRESHOLD = 5   # failures in a row that open the circuit, 0 to disable
+GSX_BREAKER_TIMEOUT = 30    # seconds an open circuit waits before a trial request
 
 GSX_SESSION = None
 
@@ -149,6 +174,121 @@ def validate(value, what=None):
     return (result == what) if what else result
 
 
+def chunked(iterable, size):
+    """
+    Yields lists of at most size items from iterable.
+
+    >>> list(chunked('abcde', 2))
+    [['a', 'b'], ['c', 'd'], ['e']]
+    """
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def pmap(func, items, workers=None):
+    """
+    Applies func to each of items from a pool of worker threads
+    and yields (item, result) tuples in the order they complete.
+    A GsxError raised by func is returned as the result so that
+    one failing item doesn't abort the rest. An error raised while
+    iterating items is re-raised once the results so far are yielded.
+    """
+    failed = []
+
+    def call(item):
+        try:
+            return item, func(item)
+        except GsxError as e:
+            return item, e
+
+    def feed():
+        # items is consumed by the pool's task thread, so make sure
+        # its errors are raised in the caller's thread instead
+        try:
+            for item in items:
+                yield item
+        except Exception as e:
+            failed.append(e)
+
+    pool = ThreadPool(workers or GSX_WORKERS)
+
+    try:
+        for result in pool.imap_unordered(call, feed()):
+            yield result
+    finally:
+        pool.terminate()
+
+    if failed:
+        raise failed[0]
+
+
+def submit_batch(submit, keys):
+    """
+    Calls submit(keys), which returns the results of one GSX request by key.
+    If GSX faults on the whole batch, it is split in half and resubmitted
+    until the failing keys are isolated. Errors without a fault code, such
+    as a failed connection or an open circuit, are the result of every key.
+    """
+    try:
+        results = submit(keys)
+    except GsxError as e:
+        if len(keys) == 1 or not e.codes or isinstance(e, GsxCircuitOpen):
+            return dict((k, e) for k in keys)
+
+        half = len(keys) // 2
+        metrics.incr('request.retry', value=2, reason='batch')
+        results = submit_batch(submit, keys[:half])
+        results.update(submit_batch(submit, keys[half:]))
+        return results
+
+    for k in keys:
+        if k not in results:
+            results[k] = GsxError('No result returned for %s' % k)
+
+    return results
+
+
+_parse_pool = None
+_parse_lock = threading.Lock()
+
+
+def parse_pool():
+    """
+    Returns the process pool that parses large responses, started on first use
+    with GSX_PARSE_PROCESSES processes and reused after that.
+    """
+    global _parse_pool
+    with _parse_lock:
+        if _parse_pool is None:
+            _parse_pool = multiprocessing.Pool(GSX_PARSE_PROCESSES or None)
+        return _parse_pool
+
+
+def parse_offloaded(method, xml, response):
+    """
+    Parses xml into packed to_dict() dicts in the parse_pool() processes.
+    A pool that doesn't answer within GSX_PARSE_TIMEOUT seconds is replaced.
+    """
+    global _parse_pool
+    pool = parse_pool()
+
+    try:
+        result = pool.apply_async(objectify.parse_packed, (xml, response,))
+        return result.get(GSX_PARSE_TIMEOUT)
+    except multiprocessing.TimeoutError:
+        with _parse_lock:
+            if _parse_pool is pool:
+                _parse_pool = None
+        pool.terminate()
+        raise GsxError('Parsing the %s response timed out' % method)
+    except ValueError as e:
+        raise GsxError('Invalid %s response: %s' % (method, e))
+
+
 def get_format(locale=GSX_LOCALE):
     filepath = os.path.join(os.path.dirname(__file__), 'langs.json')
     df = open(filepath, 'r')
@@ -213,6 +353,133 @@ class GsxError(Exception):
         return u' '.join(self.messages)
 
 
+class GsxEmptyResult(GsxError):
+    """Raised when a GSX call returns no result, eg. a lookup that found nothing."""
+
+    def __init__(self):
+        super(GsxEmptyResult, self).__init__('GSX request returned empty result')
+
+
+class GsxCircuitOpen(GsxError):
+    """Raised without contacting GSX while its circuit breaker is open."""
+
+    def __init__(self, url, retry_after):
+        super(GsxCircuitOpen, self).__init__('GSX circuit open for %s' % url)
+        self.codes.append('GSX.CIRCUIT.OPEN')
+        self.url = url
+        self.retry_after = retry_after
+
+
+class CircuitBreaker(object):
+    """
+    Stops sending requests to a GSX endpoint after threshold connection
+    failures in a row. Once timeout seconds have passed one trial request
+    is let through (half-open), its outcome closes or reopens the circuit.
+    There's one breaker per resolved GSX_URL, ie. environment and region.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    # Statuses that mean GSX itself is in trouble, SOAP faults come as 500
+    FAILURE_STATUSES = (502, 503, 504,)
+
+    _breakers = {}
+    _lock = threading.Lock()
+
+    def __init__(self, url, threshold=None, timeout=None):
+        self.url = url
+        self.threshold = threshold
+        self.timeout = timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get(cls, url):
+        with cls._lock:
+            if url not in cls._breakers:
+                cls._breakers[url] = cls(url)
+            return cls._breakers[url]
+
+    @classmethod
+    def all(cls):
+        with cls._lock:
+            return dict(cls._breakers)
+
+    @classmethod
+    def reset_all(cls):
+        with cls._lock:
+            cls._breakers.clear()
+
+    def _threshold(self):
+        return GSX_BREAKER_THRESHOLD if self.threshold is None else self.threshold
+
+    def _timeout(self):
+        return timedelta(seconds=GSX_BREAKER_TIMEOUT if self.timeout is None else self.timeout)
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if self.trial or datetime.now() >= self.opened_at + self._timeout():
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def status(self):
+        return {
+            'url': self.url,
+            'state': self.state,
+            'failures': self.failures,
+            'opened_at': self.opened_at,
+        }
+
+    def before(self):
+        """Raises GsxCircuitOpen unless a request may be sent now."""
+        with self.lock:
+            if self.opened_at is None or self._threshold() < 1:
+                return
+
+            retry = self.opened_at + self._timeout()
+
+            if self.trial or datetime.now() < retry:
+                metrics.incr('circuit.rejected', url=self.url)
+                raise GsxCircuitOpen(self.url, retry)
+
+            self.trial = True
+
+    def success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                logging.info('GSX circuit closed for %s' % self.url)
+                metrics.incr('circuit.closed', url=self.url)
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            threshold = self._threshold()
+
+            if self.trial or (threshold > 0 and self.failures >= threshold):
+                if self.opened_at is None or self.trial:
+                    logging.warning('GSX circuit open for %s after %d failures' %
+                                    (self.url, self.failures))
+                    metrics.incr('circuit.opened', url=self.url)
+                self.opened_at = datetime.now()
+                self.trial = False
+
+    def reset(self):
+        self.success()
+
+
+def circuit_status():
+    """Returns the state of the circuit breaker of each GSX endpoint used so far."""
+    return dict((url, b.status()) for url, b in CircuitBreaker.all().items())
+
+
 class GsxCache(object):
     """The cache creates a separate shelf for each GSX session."""
 
@@ -234,21 +501,25 @@ class GsxCache(object):
         """Get a value from the cache."""
         try:
             d = self.shelf[key]
-            if d['expires'] > self.now:
+            if d['expires'] > datetime.now():
+                metrics.incr('cache.hit', cache=key)
                 return d['value']
             else:
                 del self.shelf[key]
         except KeyError:
-            return None
+            pass
+
+        metrics.incr('cache.miss', cache=key)
 
     def set(self, key, value):
         """Set a value in the cache."""
         d = {
             'value'     : value,
-            'expires'   : self.now + self.expires
+            'expires'   : datetime.now() + self.expires
         }
 
         self.shelf[key] = d
+        self.shelf.sync()  # so that other instances of this cache see it
         return self
 
     def nuke(self):
@@ -256,6 +527,90 @@ class GsxCache(object):
         os.remove(self.fp)
 
 
+def gzip(data):
+    """
+    >>> zlib.decompress(gzip('spam'), zlib.MAX_WBITS | 32)
+    'spam'
+    """
+    c = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    return c.compress(data) + c.flush()
+
+
+# What reading a response body can raise when the connection fails
+READ_ERRORS = (requests.exceptions.RequestException, TransportError,
+               httplib.HTTPException, socket.error,)
+
+
+class ResponseReader(object):
+    """
+    Reads a streamed HTTP response, decompressing a gzip or deflate
+    body as it arrives. Keeps track of the bytes read off the wire,
+    the decompressed size and the time spent waiting on the socket.
+    """
+    def __init__(self, res, chunk_size=None):
+        self.res = res
+        self.chunk_size = chunk_size or GSX_CHUNK_SIZE
+        self.chunks = []
+        self.wire = 0
+        self.size = 0
+        self.elapsed = 0
+        self.encoding = res.headers.get('content-encoding', '').lower()
+        self.decoder = None
+
+        if self.encoding in ('gzip', 'x-gzip', 'deflate',):
+            # accepts both gzip and zlib headers
+            self.decoder = zlib.decompressobj(zlib.MAX_WBITS | 32)
+
+    def _decode(self, chunk):
+        if self.decoder is None:
+            return chunk
+        try:
+            return self.decoder.decompress(chunk)
+        except zlib.error:
+            if self.encoding != 'deflate' or self.wire > len(chunk):
+                raise
+            # Some servers send raw deflate without the zlib header
+            self.decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self.decoder.decompress(chunk)
+
+    def _next(self, raw):
+        start = clock()
+        try:
+            return next(raw, None)
+        finally:
+            self.elapsed += clock() - start
+
+    def __iter__(self):
+        raw = self.res.raw.stream(self.chunk_size, decode_content=False)
+
+        while True:
+            chunk = self._next(raw)
+            if chunk is None:
+                break
+            self.wire += len(chunk)
+            chunk = self._decode(chunk)
+            if chunk:
+                self.size += len(chunk)
+                self.chunks.append(chunk)
+                yield chunk
+
+        if self.decoder is not None:
+            chunk = self.decoder.flush()
+            if chunk:
+                self.size += len(chunk)
+                self.chunks.append(chunk)
+                yield chunk
+
+    @property
+    def content(self):
+        return ''.join(self.chunks)
+
+    def read(self):
+        for chunk in self:
+            pass
+        return self.content
+
+
 class GsxRequest(object):
     """Creates and submits the SOAP envelope."""
 
@@ -267,6 +622,8 @@ class GsxRequest(object):
     _request = ""
     _response = ""
 
+    uncompressed = set() # URLs that rejected compressed requests
+
     def __init__(self, **kwargs):
         "Construct the SOAP envelope."
         self.objects = []
@@ -287,7 +644,7 @@ class GsxRequest(object):
             self.data = v.to_xml(self._request)
             self._response = k.replace("Request", "Response")
 
-    def _send(self, method, xmldata):
+    def _send(self, method, xmldata, stream=False):
         "Send the final SOAP message"
         global GSX_ENV, GSX_REGION, GSX_HOSTS, GSX_URL, GSX_TIMEOUT
 
@@ -301,11 +658,23 @@ class GsxRequest(object):
         logging.debug(xmldata)
 
         headers = {
-            'User-Agent'    : "py-gsxws %s" % VERSION,
-            'Content-type'  : 'text/xml; charset="UTF-8"',
-            'SOAPAction'    : '"%s"' % method
+            'User-Agent'      : "py-gsxws %s" % VERSION,
+            'Content-type'    : 'text/xml; charset="UTF-8"',
+            'SOAPAction'      : '"%s"' % method,
+            'Accept-Encoding' : 'gzip, deflate',
         }
 
+        compress = (GSX_COMPRESS and len(xmldata) >= GSX_COMPRESS_MIN
+                    and self._url not in GsxRequest.uncompressed)
+
+        body = xmldata
+
+        if compress:
+            headers['Content-Encoding'] = 'gzip'
+            body = gzip(xmldata)
+
+        metrics.size('request.sent.wire', len(body), operation=method)
+
         # Send GSX client certs with every request
         try:
             self.gsx_cert = os.environ['GSX_CERT']
@@ -313,16 +682,40 @@ class GsxRequest(object):
         except KeyError as e:
             raise GsxError('SSL configuration error: %s' % e)
 
+        breaker = CircuitBreaker.get(self._url)
+        breaker.before()
+
         try:
-            return requests.post(self._url, cert=(self.gsx_cert, self.gsx_key),
-                                 data=xmldata,
-                                 headers=headers,
-                                 timeout=GSX_TIMEOUT)
+            res = requests.post(self._url, cert=(self.gsx_cert, self.gsx_key),
+                                data=body,
+                                headers=headers,
+                                stream=stream,
+                                timeout=GSX_TIMEOUT)
         except Exception as e:
+            breaker.failure()
+            metrics.incr('request.fault', operation=method, code='connection')
             raise GsxError('GSX connection failed: %s' % e)
 
-    def _submit(self, method, response=None, raw=False):
-        "Constructs and submits the final SOAP message"
+        # A streamed response succeeds once its body has been read, see _received()
+        self._breaker = breaker
+
+        if res.status_code in breaker.FAILURE_STATUSES:
+            breaker.failure()
+        elif not stream:
+            breaker.success()
+
+        if compress and res.status_code == 415:
+            # This endpoint doesn't take compressed requests, resend as is
+            logging.warning('%s rejected a compressed request' % self._url)
+            GsxRequest.uncompressed.add(self._url)
+            res.close()
+            breaker.success()  # it answered, let the resend through
+            return self._send(method, xmldata, stream)
+
+        return res
+
+    def _envelope(self, method):
+        "Constructs the final SOAP message"
         root = ET.SubElement(self.body, self.obj._namespace + method)
 
         if method is "Authenticate":
@@ -355,22 +748,166 @@ class GsxRequest(object):
             else:
                 request.append(self.data)
 
-        data = ET.tostring(self.env, "UTF-8")
-        res = self._send(method, data)
-        xml = res.text.encode('utf-8')
-        self.xml_response = xml
+        return ET.tostring(self.env, "UTF-8")
+
+    def _fault(self, method, res, xml=None):
+        "Returns the GsxError for a failed response"
+        if xml is None:
+            xml = res.text.encode('utf-8')
+        error = GsxError(xml=xml, url=self._url, status=res.status_code)
+        metrics.incr('request.fault', operation=method, code=error.code)
+        return error
+
+    def _received(self, res):
+        "Records a response whose body was read in full with the circuit breaker"
+        if res.status_code not in CircuitBreaker.FAILURE_STATUSES:
+            self._breaker.success()
+
+    def _read_failed(self, method, error):
+        "Returns the GsxError for a response body that couldn't be read"
+        self._breaker.failure()
+        metrics.incr('request.fault', operation=method, code='connection')
+        return GsxError('GSX connection failed: %s' % error)
+
+    def _invalid(self, method, error):
+        "Returns the GsxError for a response body that isn't a SOAP response"
+        self._breaker.failure()
+        metrics.incr('request.fault', operation=method, code='invalid')
+        return GsxError('Invalid %s response: %s' % (method, error))
+
+    def _span(self, method):
+        "Opens the tracing span of this SOAP call"
+        return tracing.span('gsx.%s' % method, **{
+            'gsx.operation': method,
+            'gsx.region': GSX_REGION,
+            'gsx.environment': GSX_ENV,
+        })
+
+    def _submit(self, method, response=None, raw=False, dicts=False):
+        """
+        Constructs and submits the final SOAP message. The response is
+        decompressed and parsed as it's read off the socket.
+        With dicts=True returns the response elements as objectify.to_dict()
+        dicts instead, parsing large responses in the parse_pool() processes
+        if GSX_PARSE_PROCESSES is set so that the parse doesn't hold the GIL.
+        """
+        offload = dicts and GSX_PARSE_PROCESSES > 0
 
-        logging.debug("Response: %s %s %s" % (res.status_code, res.reason, xml))
+        with self._span(method) as span:
+            with metrics.Timer('request.serialize', operation=method):
+                data = self._envelope(method)
 
-        if res.status_code > 200:
-            raise GsxError(xml=xml, url=self._url, status=res.status_code)
+            start = clock()
+            res = self._send(method, data, stream=True)
+            waited = clock() - start
+            reader = ResponseReader(res)
+            response = response or self._response
 
-        if raw is True:
-            return ET.fromstring(self.xml_response)
+            try:
+                if res.status_code > 200 or raw is True or offload:
+                    reader.read()
+                else:
+                    start = clock()
+                    self.objects = objectify.parse_chunks(reader, response)
+                    metrics.timing('request.parse', clock() - start - reader.elapsed,
+                                   operation=method)
+            except READ_ERRORS as e:
+                raise self._read_failed(method, e)
+            except Exception:
+                self._breaker.failure()  # never leave a trial request unsettled
+                raise
+            finally:
+                res.close()
+
+            self._received(res)
+
+            xml = self.xml_response = reader.content
+            metrics.timing('request.network', waited + reader.elapsed, operation=method)
+            metrics.size('request.sent', len(data), operation=method)
+            metrics.size('request.received', reader.size, operation=method)
+            metrics.size('request.received.wire', reader.wire, operation=method)
+            span.set_attribute('gsx.request_size', len(data))
+            span.set_attribute('gsx.response_size', reader.size)
+            span.set_attribute('gsx.response_wire_size', reader.wire)
+
+            logging.debug("Response: %s %s %s" % (res.status_code, res.reason, xml))
+
+            if res.status_code > 200:
+                error = self._fault(method, res, xml)
+                span.set_attribute('gsx.fault_code', error.code)
+                raise error
+
+            if raw is True:
+                return ET.fromstring(self.xml_response)
+
+            if offload:
+                start = clock()
+                if reader.size >= GSX_PARSE_MIN:
+                    metrics.incr('request.offload', operation=method)
+                    packed = parse_offloaded(method, xml, response)
+                    metrics.timing('request.parse', clock() - start, operation=method)
+                    return objectify.unpack(packed)
+                self.objects = objectify.parse(xml, response)
+                metrics.timing('request.parse', clock() - start, operation=method)
+
+            if dicts:
+                root, self.objects = self.objects, None  # don't keep the tree
+                return [objectify.to_dict(e) for e in root] if root is not None else []
+
+            return self.objects
+
+    def _stream(self, method):
+        """
+        Constructs and submits the final SOAP message and returns
+        the HTTP response without reading the body. The caller reports
+        reading it with _received() or _read_failed().
+        """
+        with self._span(method) as span:
+            with metrics.Timer('request.serialize', operation=method):
+                data = self._envelope(method)
+
+            with metrics.Timer('request.network', operation=method):
+                res = self._send(method, data, stream=True)
+
+            metrics.size('request.sent', len(data), operation=method)
+            span.set_attribute('gsx.request_size', len(data))
+
+            if res.status_code > 200:
+                try:
+                    error = self._fault(method, res)
+                except READ_ERRORS as e:
+                    raise self._read_failed(method, e)
+                except Exception:
+                    self._breaker.failure()
+                    raise
+                self._received(res)
+                span.set_attribute('gsx.fault_code', error.code)
+                raise error
+
+            return res
+
+    def _stream_attachments(self, method, res, files, chunk_size=None):
+        """
+        Decodes the attachments of a response from _stream() into files,
+        see objectify.stream_attachments(). Failing to read or parse the
+        response raises GsxError.
+        """
+        chunks = res.iter_content(chunk_size or GSX_CHUNK_SIZE)
 
-        response = response or self._response
-        self.objects = objectify.parse(xml, response)
-        return self.objects
+        try:
+            result = objectify.stream_attachments(chunks, files)
+        except READ_ERRORS as e:
+            raise self._read_failed(method, e)
+        except (xml.sax.SAXException, binascii.Error) as e:
+            raise self._invalid(method, e)
+        except Exception:
+            self._breaker.failure()
+            raise
+        finally:
+            res.close()
+
+        self._received(res)
+        return result
 
     def __unicode__(self):
         return ET.tostring(self.env)
@@ -403,7 +940,7 @@ class GsxResponse:
 
     def get_response(self):
         if self.response is None:
-            raise GsxError('GSX request returned empty result')
+            raise GsxEmptyResult()
 
         return self.response if len(self.response) > 1 else self.response[0]
 
@@ -466,9 +1003,14 @@ class GsxObject(object):
         self._req = GsxRequest(**{arg: self})
         result = self._req._submit(method, ret, raw)
         if result is None:
-            raise GsxError('GSX request returned empty result')
+            raise GsxEmptyResult()
         return result if len(result) > 1 else result[0]
 
+    def _submit_dicts(self, arg, method, ret=None):
+        """Like _submit() but returns a list of objectify.to_dict() dicts."""
+        self._req = GsxRequest(**{arg: self})
+        return self._req._submit(method, ret, dicts=True)
+
     def to_xml(self, root):
         """
         Returns this object as an XML Element
@@ -485,6 +1027,8 @@ class GsxObject(object):
                     if isinstance(e, GsxObject):
                         i = ET.SubElement(root, k)
                         i.extend(e.to_xml(k))
+                    if isinstance(e, basestring):
+                        ET.SubElement(root, k).text = e
             else:
                 el = ET.SubElement(root, k)
                 if isinstance(v, basestring):
@@ -534,9 +1078,13 @@ class GsxSession(GsxObject):
         session_id.text = self._session_id
         return session
 
-    def login(self):
+    def login(self, refresh=False):
+        """
+        Returns the cached session or authenticates a new one,
+        refresh=True always authenticates.
+        """
         global GSX_SESSION
-        session = self._cache.get("session")
+        session = None if refresh else self._cache.get("session")
 
         if session is not None:
             GSX_SESSION = session
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
-from core import GsxObject, GsxError
+from lxml import etree
+
+from core import GsxObject, GsxError, GsxEmptyResult, validate, pmap
 
 
 class Diagnostics(GsxObject):
@@ -75,4 +77,177 @@ class Diagnostics(GsxObject):
         self._submit("diagnosticTestRequestData", "RunDiagnosticTest",
                      "diagnosticTestResponseData")
         return self._req.objects
-        
\ No newline at end of file
+
+
+def event_numbers(device):
+    """
+    Returns the diagnostic event numbers of a device
+    by serial number or IMEI, [] if it has none.
+    """
+    if validate(device, 'alternateDeviceId'):
+        diags = Diagnostics(alternateDeviceId=device)
+    else:
+        diags = Diagnostics(serialNumber=device)
+
+    try:
+        events = diags.events()
+    except GsxEmptyResult:
+        return []
+
+    return [unicode(t).strip() for e in events for t in e.itertext() if t.strip()]
+
+
+def harvest(devices, sink, store=(), workers=None):
+    """
+    Fetches the details of every diagnostic event of one or many devices
+    that isn't already in store (anything supporting "in", keyed by
+    diagnosticEventNumber). Event details are fetched concurrently and
+    passed to sink(event_number, details) as they arrive.
+    Returns a list of (device or event number, GsxError) tuples.
+
+    >>> harvest('DGKFL06JDHJP', lambda n, d: None) # doctest: +SKIP
+    []
+    """
+    errors = []
+
+    if isinstance(devices, basestring):
+        devices = [devices]
+
+    def missing():
+        for device, numbers in pmap(event_numbers, devices, workers):
+            if isinstance(numbers, GsxError):
+                errors.append((device, numbers))
+                continue
+            for n in numbers:
+                if n not in store:
+                    yield n
+
+    def fetch(number):
+        return Diagnostics(diagnosticEventNumber=number).fetch()
+
+    for number, details in pmap(fetch, missing(), workers):
+        if isinstance(details, GsxError):
+            errors.append((number, details))
+        else:
+            sink(number, details)
+
+    return errors
+
+
+def _numbers(values):
+    """
+    Returns values as floats, None for the ones that aren't numbers.
+
+    >>> _numbers(['1', '0.5', 'fliPhone', None])
+    [1.0, 0.5, None, None]
+    """
+    result = []
+    for v in values:
+        try:
+            result.append(float(v))
+        except (TypeError, ValueError):
+            result.append(None)
+    return result
+
+
+class DiagnosticsTable(object):
+    """
+    Columnar view of the test results and profile keys of any number
+    of diagnostic responses, one row per result or key.
+    Report data isn't included.
+    Raw response XML is read with a plain lxml parser in one pass
+    so no GsxElement attribute access is involved.
+
+    >>> t = DiagnosticsTable()
+    >>> t.extend(open('tests/fixtures/ios_diagnostics.xml').read())
+    >>> t.results['name'][0]
+    'BATTERY_HEALTH'
+    """
+    RESULT_COLUMNS = ('serialNumber', 'eventNumber', 'name', 'value', 'information',)
+    PROFILE_COLUMNS = ('serialNumber', 'eventNumber', 'section', 'name', 'value',)
+    # Numeric copies of text columns added by to_numpy() and to_arrow(),
+    # missing where the value isn't a number. Column types never depend
+    # on the data, so the tables of different batches always concatenate.
+    NUMERIC_COLUMNS = {'value': 'numericValue'}
+
+    def __init__(self):
+        self.results = dict((c, []) for c in self.RESULT_COLUMNS)
+        self.profile = dict((c, []) for c in self.PROFILE_COLUMNS)
+
+    def __len__(self):
+        return len(self.results['name']) + len(self.profile['name'])
+
+    def extend(self, response):
+        """
+        Appends the rows of one response, given either as the XML
+        returned by GSX or as an already parsed element.
+        """
+        if isinstance(response, basestring):
+            response = etree.fromstring(response)
+
+        sn = response.findtext('.//serialNumber')
+        event = response.findtext('.//diagnosticEventNumber')
+
+        for el in response.iterfind('.//testResult/result'):
+            self._append(self.results, el, sn, event)
+            self.results['information'].append(el.findtext('information'))
+
+        for el in response.iterfind('.//profile/*/key'):
+            self._append(self.profile, el, sn, event)
+            self.profile['section'].append(el.getparent().tag)
+
+    def _append(self, columns, el, sn, event):
+        columns['serialNumber'].append(sn)
+        columns['eventNumber'].append(event)
+        columns['name'].append(el.findtext('name'))
+        columns['value'].append(el.findtext('value'))
+
+    def concat(self, other):
+        """Appends all rows of another DiagnosticsTable."""
+        for c in self.RESULT_COLUMNS:
+            self.results[c].extend(other.results[c])
+        for c in self.PROFILE_COLUMNS:
+            self.profile[c].extend(other.profile[c])
+
+    def _typed(self, columns, names):
+        """
+        Returns (name, values, numeric) tuples of the text columns
+        followed by their numeric copies.
+        """
+        result = [(k, columns[k], False) for k in names]
+        for k in names:
+            if k in self.NUMERIC_COLUMNS:
+                result.append((self.NUMERIC_COLUMNS[k], _numbers(columns[k]), True))
+        return result
+
+    def to_numpy(self):
+        """
+        Returns the results and profile columns as NumPy arrays,
+        float (NaN where missing) for the numeric ones and object for the rest.
+        """
+        import numpy
+
+        def arrays(columns, names):
+            return dict((k, numpy.array([numpy.nan if n is None else n for n in v])
+                         if numeric else numpy.array(v, dtype=object))
+                        for k, v, numeric in self._typed(columns, names))
+
+        return (arrays(self.results, self.RESULT_COLUMNS),
+                arrays(self.profile, self.PROFILE_COLUMNS))
+
+    def to_arrow(self):
+        """
+        Returns the results and profile columns as Arrow tables,
+        float64 for the numeric ones and string for the rest.
+        """
+        import pyarrow
+
+        def table(columns, names):
+            typed = self._typed(columns, names)
+            return pyarrow.Table.from_arrays(
+                [pyarrow.array(v, type=pyarrow.float64() if numeric else pyarrow.string())
+                 for k, v, numeric in typed],
+                [k for k, v, numeric in typed])
+
+        return (table(self.results, self.RESULT_COLUMNS),
+                table(self.profile, self.PROFILE_COLUMNS))
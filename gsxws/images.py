@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+Disk cache for product and part images.
+
+Images are stored once per content hash and looked up by URL. Stale
+entries are revalidated with If-None-Match/If-Modified-Since, the least
+recently used images are evicted when the cache grows over max_size and
+concurrent requests for the same URL share a single download.
+
+    >>> cache = ImageCache('/tmp/gsx_images')
+    >>> cache.get(part_image_url('661-5571')) # doctest: +ELLIPSIS
+    '/tmp/gsx_images/...gif'
+    >>> paths = dict(cache.prefetch(part_image_url(p) for p in ('661-5571', '922-7913')))
+"""
+
+import os
+import shelve
+import hashlib
+import logging
+import urlparse
+import tempfile
+import threading
+import requests
+
+from datetime import datetime, timedelta
+
+from core import GsxError, pmap
+
+IMAGE_URL = "https://km.support.apple.com.edgekey.net/kb/imageService.jsp?image=%s"
+
+IMAGE_TIMEOUT = 30
+IMAGE_MAX_AGE = timedelta(days=1)  # how long an image is used before revalidating
+IMAGE_MAX_SIZE = 100 * 1024 * 1024
+
+
+def part_image_url(part_number):
+    return IMAGE_URL % ("%s_350_350.gif" % part_number)
+
+
+def image_ext(url):
+    """
+    Returns the file extension of the image at url, taken from the
+    image= parameter of imageService URLs, otherwise from the path.
+
+    >>> image_ext(part_image_url('661-5571'))
+    '.gif'
+    >>> image_ext('http://example.com/img.png?w=100')
+    '.png'
+    """
+    parts = urlparse.urlparse(url)
+    image = urlparse.parse_qs(parts.query).get('image')
+    name = urlparse.urlparse(image[0]).path if image else parts.path
+    return os.path.splitext(name)[1][:5] or '.img'
+
+
+class ImageCache(object):
+    def __init__(self, directory=None, max_size=IMAGE_MAX_SIZE, max_age=IMAGE_MAX_AGE):
+        self.directory = directory or os.path.join(tempfile.gettempdir(), 'gsxws_images')
+        self.max_size = max_size
+        self.max_age = max_age
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        self.index = shelve.open(os.path.join(self.directory, 'index'), protocol=-1)
+        self._lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+        self._inflight = {}  # url -> (Event, [path or error])
+
+    def _path(self, entry):
+        return os.path.join(self.directory, entry['hash'] + entry['ext'])
+
+    def _key(self, url):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        return hashlib.sha1(url).hexdigest()
+
+    def _lookup(self, url):
+        with self._lock:
+            entry = self.index.get(self._key(url))
+
+        if entry and os.path.exists(self._path(entry)):
+            return entry
+
+    def _save(self, url, entry):
+        with self._lock:
+            self.index[self._key(url)] = entry
+            self.index.sync()
+
+    def _store(self, url, res):
+        """Writes the image to its content addressed file."""
+        data = res.content
+        entry = {
+            'hash': hashlib.sha256(data).hexdigest(),
+            'ext': image_ext(url),
+            'etag': res.headers.get('etag'),
+            'modified': res.headers.get('last-modified'),
+            'checked': datetime.now(),
+        }
+        path = self._path(entry)
+
+        # a blob shared with another URL is now recently used, too
+        if not self._touch(path):
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.part')
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(data)
+            os.rename(tmp, path)
+            self.evict(keep=path)
+
+        self._save(url, entry)
+        return path
+
+    def _touch(self, path):
+        """Marks path as recently used, False if it has been evicted."""
+        try:
+            os.utime(path, None)
+            return True
+        except OSError:
+            return False
+
+    def _fetch(self, url):
+        entry = self._lookup(url)
+
+        if entry and datetime.now() - entry['checked'] < self.max_age:
+            path = self._path(entry)
+            if self._touch(path):
+                return path
+            entry = None
+
+        headers = {}
+
+        if entry:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['modified']:
+                headers['If-Modified-Since'] = entry['modified']
+
+        try:
+            res = requests.get(url, headers=headers, timeout=IMAGE_TIMEOUT)
+        except Exception as e:
+            raise GsxError("Failed to fetch image: %s" % e)
+
+        if res.status_code == 304 and entry:
+            entry['checked'] = datetime.now()
+            self._save(url, entry)
+            path = self._path(entry)
+            if self._touch(path):
+                return path
+            # evicted meanwhile
+            res = requests.get(url, timeout=IMAGE_TIMEOUT)
+
+        if res.status_code != 200:
+            raise GsxError("Failed to fetch image: HTTP %d" % res.status_code)
+
+        return self._store(url, res)
+
+    def get(self, url):
+        """
+        Returns the path of the cached image at url, downloading or
+        revalidating it first if needed.
+        """
+        with self._lock:
+            if url in self._inflight:
+                event, result = self._inflight[url]
+                owner = False
+            else:
+                event, result = self._inflight[url] = (threading.Event(), [])
+                owner = True
+
+        if not owner:
+            event.wait()
+            if isinstance(result[0], Exception):
+                raise result[0]
+            return result[0]
+
+        try:
+            result.append(self._fetch(url))
+            return result[0]
+        except GsxError as e:
+            result.append(e)
+            raise
+        except Exception as e:
+            # disk errors, so that prefetch() reports them per URL
+            result.append(GsxError("Failed to cache image: %s" % e))
+            raise result[0]
+        finally:
+            with self._lock:
+                del self._inflight[url]
+            event.set()
+
+    def prefetch(self, urls, workers=None):
+        """Fetches urls concurrently, yields (url, path or GsxError) tuples."""
+        return pmap(self.get, urls, workers)
+
+    def size(self):
+        return sum(os.path.getsize(p) for p, m in self._blobs())
+
+    def _blobs(self):
+        for f in os.listdir(self.directory):
+            path = os.path.join(self.directory, f)
+            if f.startswith('index') or f.endswith('.part'):
+                continue
+            yield path, os.path.getmtime(path)
+
+    def evict(self, keep=None):
+        """Removes the least recently used images until the cache fits max_size."""
+        with self._evict_lock:
+            blobs = sorted(self._blobs(), key=lambda b: b[1])
+            total = sum(os.path.getsize(p) for p, m in blobs)
+
+            for path, mtime in blobs:
+                if total <= self.max_size:
+                    break
+                if path == keep:
+                    continue
+                total -= os.path.getsize(path)
+                logging.debug("Evicting %s from image cache" % path)
+                os.remove(path)
+
+    def close(self):
+        self.index.close()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def default_cache():
+    """Returns the cache shared by Product and Part.fetch_image()."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ImageCache()
+        return _cache
@@ -1,11 +1,33 @@
 # -*- coding: utf-8 -*-
 
+import os
+import json
 import base64
+import hashlib
 import logging
 import tempfile
-from datetime import date
+from datetime import date, timedelta
 
-from core import GsxObject, connect
+from tracing import traced
+from records import PartInfo, RepairSummary
+from core import GsxObject, GsxError, GsxEmptyResult, GsxRequest, connect, pmap
+
+# RepairLookup never returns more than this many repairs
+REPAIR_LOOKUP_LIMIT = 2500
+
+
+class HashingWriter(object):
+    """Writes to a file object while computing the SHA-256 of the data."""
+    def __init__(self, fp):
+        self.fp = fp
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.fp.write(data)
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
 
 
 class Lookup(GsxObject):
@@ -17,17 +39,25 @@ class Lookup(GsxObject):
         result = self._submit("lookupRequestData", method, response)
         return [result] if isinstance(result, dict) else result
 
-    def parts(self):
+    @traced('Lookup.parts')
+    def parts(self, record=False):
         """
         The Parts Lookup API allows users to access part and part pricing data prior to
         creating a repair or order. Parts lookup is also a good way to search for
         part numbers by various attributes of a part
         (config code, EEE code, serial number, etc.).
+        Returns a list of PartInfo records with record=True.
         """
         self._namespace = "core:"
+
+        if record:
+            dicts = self._submit_dicts("lookupRequestData", "PartsLookup", "parts")
+            return [PartInfo.from_dict(d) for d in dicts]
+
         return self.lookup("PartsLookup", "parts")
 
-    def repairs(self):
+    @traced('Lookup.repairs')
+    def repairs(self, record=False):
         """
         The Repair Lookup API mimics the front-end repair search functionality.
         It fetches up to 2500 repairs in a given criteria.
@@ -36,8 +66,19 @@ class Lookup(GsxObject):
 
         >>> Lookup(serialNumber='DGKFL06JDHJP').repairs() # doctest: +ELLIPSIS
         [{'customerName': 'Lepalaan,Filipp',...
+
+        Returns a list of RepairSummary records with record=True.
         """
-        return self.lookup("RepairLookup")
+        if record:
+            dicts = self._submit_dicts("lookupRequestData", "RepairLookup", "lookupResponseData")
+            result = [RepairSummary.from_dict(d) for d in dicts]
+        else:
+            result = self.lookup("RepairLookup")
+
+        if len(result) >= REPAIR_LOOKUP_LIMIT:
+            logging.warning("RepairLookup returned %d repairs, results may be truncated" % len(result))
+
+        return result
 
     def invoices(self):
         """
@@ -62,6 +103,43 @@ class Lookup(GsxObject):
         result.invoiceData = outfile.name
         return result
 
+    def save_invoice(self, path):
+        """
+        Streams the invoice for the given invoice id straight into
+        the file at path and returns the SHA-256 of the PDF.
+
+        >>> Lookup(invoiceID=9670348809).save_invoice('/tmp/9670348809.pdf') # doctest: +ELLIPSIS
+        '...'
+        """
+        self._req = GsxRequest(lookupRequestData=self)
+        fp = None
+
+        try:
+            try:
+                # open the file first, so that a failing open() doesn't
+                # leave the response unread
+                fp = open(path + '.part', 'wb')
+                writer = HashingWriter(fp)
+                res = self._req._stream("InvoiceDetailsLookup")
+                result = self._req._stream_attachments("InvoiceDetailsLookup", res,
+                                                       {'invoiceData': writer})
+            finally:
+                if fp is not None:
+                    fp.close()
+        except Exception as e:
+            if fp is not None:
+                os.remove(path + '.part')
+            if isinstance(e, GsxError):
+                raise
+            raise GsxError('Failed to save invoice: %s' % e)
+
+        if 'invoiceData' not in result.found:
+            os.remove(path + '.part')
+            raise GsxError(' '.join(result.messages) or 'GSX returned no invoice')
+
+        os.rename(path + '.part', path)
+        return writer.hexdigest()
+
     def component_check(self, parts=[]):
         """
         The Component Check API allows service providers to send 
@@ -75,6 +153,58 @@ class Lookup(GsxObject):
         return self._submit("repairData", "ComponentCheck", "componentCheckDetails")
 
 
+def harvest_invoices(ship_to, start, end, directory, workers=None):
+    """
+    Downloads every invoice of ship_to dated between start and end into
+    directory. Invoice IDs are looked up one day at a time and checked
+    against the manifest.json in directory, so invoices that were
+    already harvested are skipped. New invoices are streamed to disk
+    concurrently and recorded in the manifest with their SHA-256.
+    Yields (invoice ID, manifest entry) tuples for new invoices and
+    (invoice ID or date, GsxError) tuples for failures.
+    """
+    path = os.path.join(directory, 'manifest.json')
+    manifest = json.load(open(path)) if os.path.exists(path) else {}
+    days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+
+    def lookup(day):
+        try:
+            return Lookup(shipTo=ship_to, invoiceDate=day).invoices()
+        except GsxEmptyResult:
+            return []  # no invoices that day
+
+    def invoices():
+        seen = set()  # so that no two workers write the same file
+        for day, result in pmap(lookup, days, workers):
+            if isinstance(result, GsxError):
+                logging.error("InvoiceIDLookup for %s failed: %s" % (day, result))
+                errors.append((day, result))
+                continue
+            for i in result:
+                invoice_id = unicode(i.invoiceID) if i.invoiceID else None
+                if invoice_id and invoice_id not in manifest and invoice_id not in seen:
+                    seen.add(invoice_id)
+                    yield invoice_id
+
+    def download(invoice_id):
+        filename = '%s.pdf' % invoice_id
+        sha256 = Lookup(invoiceID=invoice_id).save_invoice(os.path.join(directory, filename))
+        return {'file': filename, 'sha256': sha256}
+
+    errors = []
+
+    for invoice_id, result in pmap(download, invoices(), workers):
+        if not isinstance(result, GsxError):
+            manifest[invoice_id] = result
+            with open(path + '.tmp', 'w') as fp:
+                json.dump(manifest, fp, indent=2)
+            os.rename(path + '.tmp', path)
+        yield invoice_id, result
+
+    for error in errors:
+        yield error
+
+
 if __name__ == '__main__':
     import sys
     import doctest
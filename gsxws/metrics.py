@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Metrics for GSX calls.
+
+Every GsxRequest reports the time spent serializing the envelope,
+waiting on the network and parsing the response, the request and
+response sizes and any faults. Register a callback to receive them:
+
+    >>> import metrics
+    >>> metrics.register(lambda kind, name, value, tags: None)
+    >>> metrics.register(metrics.StatsdAdapter('localhost', 8125))
+
+Callbacks are called with (kind, name, value, tags) where kind is one of
+'timing' (seconds), 'size' (bytes) or 'counter', and tags is a dict
+such as {'operation': 'WarrantyStatus'}.
+"""
+
+import time
+import socket
+import logging
+import threading
+
+TIMING = 'timing'
+SIZE = 'size'
+COUNTER = 'counter'
+
+_callbacks = []
+
+
+def register(callback):
+    """Adds a callback that receives every metric."""
+    _callbacks.append(callback)
+    return callback
+
+
+def unregister(callback):
+    _callbacks.remove(callback)
+
+
+def emit(kind, name, value, **tags):
+    for callback in list(_callbacks):
+        try:
+            callback(kind, name, value, tags)
+        except Exception:
+            logging.exception("Metrics callback %r failed" % callback)
+
+
+def timing(name, seconds, **tags):
+    emit(TIMING, name, seconds, **tags)
+
+
+def size(name, nbytes, **tags):
+    emit(SIZE, name, nbytes, **tags)
+
+
+def incr(name, value=1, **tags):
+    emit(COUNTER, name, value, **tags)
+
+
+class Timer(object):
+    """
+    Context manager that reports the time spent in its block.
+
+    >>> with Timer('request.serialize', operation='WarrantyStatus'):
+    ...     pass
+    """
+    def __init__(self, name, **tags):
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        timing(self.name, time.time() - self.start, **self.tags)
+
+
+class StatsdAdapter(object):
+    """
+    Sends metrics to a StatsD server over UDP.
+    Tags are appended to the metric name (gsxws.request.network.WarrantyStatus)
+    or, with dogstatsd=True, sent as DogStatsD tags.
+    """
+    TYPES = {TIMING: 'ms', SIZE: 'h', COUNTER: 'c'}
+
+    def __init__(self, host='localhost', port=8125, prefix='gsxws', dogstatsd=False):
+        self.addr = (host, port)
+        self.prefix = prefix
+        self.dogstatsd = dogstatsd
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def format(self, kind, name, value, tags):
+        if kind == TIMING:
+            value = int(round(value * 1000))
+
+        name = '%s.%s' % (self.prefix, name)
+
+        if self.dogstatsd:
+            line = '%s:%s|%s' % (name, value, self.TYPES[kind])
+            if tags:
+                line += '|#' + ','.join('%s:%s' % i for i in sorted(tags.items()))
+            return line
+
+        for k, v in sorted(tags.items()):
+            name += '.%s' % str(v).replace('.', '_')
+
+        return '%s:%s|%s' % (name, value, self.TYPES[kind])
+
+    def __call__(self, kind, name, value, tags):
+        try:
+            self.sock.sendto(self.format(kind, name, value, tags), self.addr)
+        except socket.error:
+            pass
+
+
+class PrometheusAdapter(object):
+    """
+    Records metrics with prometheus_client: timings and sizes as
+    histograms, counters as counters, all labelled with their tags.
+    """
+    def __init__(self, prefix='gsxws', registry=None):
+        import prometheus_client
+        self.client = prometheus_client
+        self.prefix = prefix
+        self.registry = registry or prometheus_client.REGISTRY
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def get(self, kind, name, labels):
+        key = (kind, name, labels)
+        with self._lock:
+            if key not in self.metrics:
+                metric = '%s_%s' % (self.prefix, name.replace('.', '_'))
+                if kind == TIMING:
+                    m = self.client.Histogram(metric + '_seconds', name, labels,
+                                              registry=self.registry)
+                elif kind == SIZE:
+                    m = self.client.Histogram(metric + '_bytes', name, labels,
+                                              registry=self.registry,
+                                              buckets=[2 ** i for i in range(8, 26, 2)])
+                else:
+                    m = self.client.Counter(metric + '_total', name, labels,
+                                            registry=self.registry)
+                self.metrics[key] = m
+            return self.metrics[key]
+
+    def __call__(self, kind, name, value, tags):
+        labels = tuple(sorted(tags))
+        metric = self.get(kind, name, labels)
+
+        if labels:
+            metric = metric.labels(**tags)
+
+        if kind == COUNTER:
+            metric.inc(value)
+        else:
+            metric.observe(value)
@@ -2,17 +2,24 @@
 
 import os
 import re
+import json
 import base64
 import tempfile
+import xml.sax
 
 from lxml import objectify
-from datetime import datetime
+from datetime import date, datetime
 
 DATETIME_TYPES  = ('dispatchSentDate',)
 STRING_TYPES    = ('alternateDeviceId', 'imeiNumber',)
 BASE64_TYPES    = ('packingList', 'proformaFileData', 'returnLabelFileData',)
 FLOAT_TYPES     = ('totalFromOrder', 'exchangePrice', 'stockPrice', 'netPrice',)
 DIAGS_TIMESTAMP_TYPES = ('startTimeStamp', 'endTimeStamp',)
+YN = re.compile(r'^[YN]$')
+
+# Elements that to_dict() always returns as lists, even when there's only one
+LIST_TYPES      = ('parts', 'partsInfo', 'orderLines', 'note', 'error',
+                   'diagnosis', 'reportData',)
 
 TZMAP = {
     'GMT'   : '',      # Greenwich Mean Time
@@ -94,6 +101,72 @@ def gsx_diags_timestamp(value):
     return datetime.strptime(value, "%d-%b-%y %I:%M:%S")
 
 
+class AttachmentHandler(xml.sax.handler.ContentHandler):
+    """
+    Decodes base64 element content into file objects as it's parsed,
+    holding no more than one parser chunk of it in memory.
+    """
+    def __init__(self, files):
+        xml.sax.handler.ContentHandler.__init__(self)
+        self.files = files
+        self.found = set()
+        self.messages = []
+        self._fp = None
+        self._buf = ''
+        self._message = None
+
+    def startElement(self, name, attrs):
+        name = name.split(':')[-1]
+        if name in self.files:
+            self._fp = self.files[name]
+            self.found.add(name)
+        if name in ('faultstring', 'message',):
+            self._message = ''
+
+    def characters(self, content):
+        if self._message is not None:
+            self._message += content
+
+        if self._fp is not None:
+            self._buf += re.sub(r'\s', '', content)
+            n = len(self._buf) // 4 * 4
+            self._fp.write(base64.b64decode(self._buf[:n]))
+            self._buf = self._buf[n:]
+
+    def endElement(self, name):
+        if self._fp is not None and self._buf:
+            self._fp.write(base64.b64decode(self._buf))
+        if self._message is not None:
+            self.messages.append(self._message)
+
+        self._fp, self._buf, self._message = None, '', None
+
+
+def stream_attachments(chunks, files):
+    """
+    Incrementally parses the response XML in chunks, decoding the base64
+    content of the elements named in files straight into the corresponding
+    file objects. Returns the handler with the names of the elements found
+    and any fault messages.
+
+    >>> import StringIO
+    >>> fp = StringIO.StringIO()
+    >>> 'pdf' in stream_attachments(['<a><pdf>c3Bh', 'bQ==</pdf></a>'], {'pdf': fp}).found
+    True
+    >>> fp.getvalue()
+    'spam'
+    """
+    handler = AttachmentHandler(files)
+    parser = xml.sax.make_parser()
+    parser.setContentHandler(handler)
+
+    for chunk in chunks:
+        parser.feed(chunk)
+
+    parser.close()
+    return handler
+
+
 class GsxElement(objectify.ObjectifiedElement):
     """
     Each element in the GSX response tree should be a GsxElement
@@ -118,31 +191,182 @@ class GsxElement(objectify.ObjectifiedElement):
             return result.pyval
 
         if isinstance(result, objectify.StringElement):
-            name = result.tag
-            result = result.text or ''
-            result = unicode(result)
-
-            if not result:
-                return
-
-            if name in DATETIME_TYPES:
-                return gsx_datetime(result)
-            if name in DIAGS_TIMESTAMP_TYPES:
-                return gsx_diags_timestamp(result)
-            if name in BASE64_TYPES:
-                return gsx_attachment(result)
-            if name in FLOAT_TYPES:
-                return gsx_price(result)
-            if name.endswith('Date'):
-                return gsx_date(result)
-            if name.endswith('Timestamp'):
-                return gsx_timestamp(result)
-            if re.search(r'^[YN]$', result):
-                return gsx_boolean(result)
+            return convert(result.tag, unicode(result.text or ''))
 
         return result
 
 
+def convert(name, value):
+    """
+    Converts the text of the element called name to its Python type.
+
+    >>> convert('purchaseDate', '08/25/10')
+    datetime.date(2010, 8, 25)
+    >>> convert('netPrice', 'EUR 1,234.50')
+    1234.5
+    """
+    if not value:
+        return
+
+    if name in DATETIME_TYPES:
+        return gsx_datetime(value)
+    if name in DIAGS_TIMESTAMP_TYPES:
+        return gsx_diags_timestamp(value)
+    if name in BASE64_TYPES:
+        return gsx_attachment(value)
+    if name in FLOAT_TYPES:
+        return gsx_price(value)
+    if name.endswith('Date'):
+        return gsx_date(value)
+    if name.endswith('Timestamp'):
+        return gsx_timestamp(value)
+    if YN.search(value):
+        return gsx_boolean(value)
+
+    return value
+
+
+# Called through the class to skip GsxElement.__getattribute__
+_iterchildren = objectify.ObjectifiedElement.iterchildren
+
+
+def to_dict(el, lists=LIST_TYPES):
+    """
+    Converts the children of a response element to plain Python values in
+    one pass, with the same conversions as attribute access. Repeated
+    elements and those named in lists become lists.
+
+    >>> to_dict(parse('tests/fixtures/parts_lookup.xml', 'parts'))['stockPrice']
+    [17.1, 17.1]
+    """
+    result = {}
+    repeated = set()
+
+    for child in _iterchildren(el):
+        tag = child.tag
+        cls = type(child)
+
+        if cls is objectify.StringElement:
+            if tag in STRING_TYPES:
+                value = unicode(child.text or '')
+            else:
+                value = convert(tag, unicode(child.text or ''))
+        elif not isinstance(tag, basestring):
+            continue  # comments and processing instructions
+        elif not issubclass(cls, objectify.ObjectifiedDataElement):
+            value = to_dict(child, lists)
+        elif tag in STRING_TYPES:
+            value = unicode(child.text or '')
+        elif issubclass(cls, objectify.NoneElement):
+            value = None
+        else:
+            value = child.pyval
+
+        if tag in repeated:
+            result[tag].append(value)
+        elif tag in lists:
+            result[tag] = [value]
+            repeated.add(tag)
+        elif tag in result:
+            result[tag] = [result[tag], value]
+            repeated.add(tag)
+        else:
+            result[tag] = value
+
+    return result
+
+
+class Missing(object):
+    """Marks a key a packed dict didn't have, pickles as a reference."""
+
+
+def pack(dicts):
+    """
+    Returns a list of dicts as (keys, rows) which pickles smaller.
+
+    >>> pack([{'a': 1}, {'a': 2, 'b': 3}])[1][1]
+    (2, 3)
+    """
+    keys = sorted(set(k for d in dicts for k in d))
+    return keys, [tuple(d.get(k, Missing) for k in keys) for d in dicts]
+
+
+def unpack(packed):
+    """
+    Returns the dicts that were packed.
+
+    >>> unpack(pack([{'a': 1}, {'a': 2, 'b': 3}]))
+    [{'a': 1}, {'a': 2, 'b': 3}]
+    """
+    keys, rows = packed
+    return [dict((k, v) for k, v in zip(keys, row) if v is not Missing) for row in rows]
+
+
+def parse_packed(xml, response):
+    """
+    Parses xml into packed to_dict() dicts, runs in the parse processes.
+    Errors are raised as ValueError, lxml's exceptions can't be unpickled.
+    """
+    try:
+        root = parse(xml, response)
+        return pack([to_dict(e) for e in root] if root is not None else [])
+    except Exception as e:
+        raise ValueError('%s: %s' % (e.__class__.__name__, e))
+
+
+def _default(value):
+    if isinstance(value, (date, datetime,)):
+        return value.isoformat()
+    raise TypeError('%r is not serializable' % value)
+
+
+def to_json(el, **kwargs):
+    """Returns el as JSON, dates and times as ISO 8601 strings."""
+    return json.dumps(to_dict(el), default=_default, **kwargs)
+
+
+def _text_keys(value):
+    """
+    Returns value with unicode dict keys, msgpack packs str as bin.
+
+    >>> _text_keys({'a': [{'b': 1}]})
+    {u'a': [{u'b': 1}]}
+    """
+    if isinstance(value, dict):
+        return dict((unicode(k), _text_keys(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [_text_keys(v) for v in value]
+    return value
+
+
+def to_msgpack(el):
+    """Returns el packed with msgpack, dates and times as ISO 8601 strings."""
+    import msgpack
+    return msgpack.packb(_text_keys(to_dict(el)), default=_default, use_bin_type=True)
+
+
+def make_parser():
+    parser = objectify.makeparser(remove_blank_text=True)
+    lookup = objectify.ObjectifyElementClassLookup(tree_class=GsxElement)
+    parser.set_element_class_lookup(lookup)
+    return parser
+
+
+def parse_chunks(chunks, response):
+    """
+    Like parse() but builds the tree as the chunks of the document arrive.
+
+    >>> parse_chunks(['<a><b><c>', 'spam</c></b></a>'], 'c')
+    'spam'
+    """
+    parser = make_parser()
+
+    for chunk in chunks:
+        parser.feed(chunk)
+
+    return parser.close().find('*//%s' % response)
+
+
 def parse(root, response):
     """
     >>> parse('tests/fixtures/warranty_status.xml', 'warrantyDetailInfo').warrantyStatus
@@ -153,9 +377,7 @@ def parse(root, response):
     True
     >>> parse('tests/fixtures/warranty_status.xml', 'warrantyDetailInfo').isPersonalized
     """
-    parser = objectify.makeparser(remove_blank_text=True)
-    lookup = objectify.ObjectifyElementClassLookup(tree_class=GsxElement)
-    parser.set_element_class_lookup(lookup)
+    parser = make_parser()
 
     if isinstance(root, basestring) and os.path.exists(root):
         root = objectify.parse(root, parser)
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+Durable outbox for GSX write operations.
+
+Creating a repair or an order is queued in a SQLite database under a
+client generated idempotency key and sent by a background thread, with
+retries. When a send failed in a way that leaves it unclear whether GSX
+processed the request (a dropped connection, or a crash while sending)
+repairs are looked up with RepairLookup before sending them again.
+A repair is only matched by its serial and PO number, one that can't be
+matched that way (no PO number, or only an alternateDeviceId) fails for
+manual review instead of being sent again.
+
+    >>> outbox = Outbox('/var/lib/gsx/outbox.db').start()
+    >>> key = outbox.enqueue(repair, callback=lambda entry: notify(entry))
+    >>> outbox.status(key)['state']
+    'queued'
+"""
+
+import time
+import uuid
+import json
+import pickle
+import random
+import sqlite3
+import logging
+import threading
+
+from datetime import date
+
+from objectify import to_dict
+from repairs import Repair
+from lookups import Lookup
+from core import GsxError, GsxCircuitOpen
+
+QUEUED = 'queued'
+SENDING = 'sending'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    key TEXT PRIMARY KEY,
+    operation TEXT NOT NULL,
+    payload BLOB NOT NULL,
+    state TEXT NOT NULL,
+    uncertain INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    created REAL NOT NULL,
+    first_sent REAL,
+    confirmation TEXT,
+    result TEXT,
+    error TEXT
+)
+"""
+
+COLUMNS = ('key', 'operation', 'state', 'uncertain', 'attempts', 'created',
+           'first_sent', 'confirmation', 'result', 'error',)
+
+
+def _json(value):
+    return json.dumps(value, default=lambda v: v.isoformat())
+
+
+class Unresolved(Exception):
+    """Raised when it can't be told whether GSX already has a repair."""
+
+
+def reconcile_repair(repair, since):
+    """
+    Returns the confirmation number of a repair that an earlier attempt to
+    create repair created in GSX, None if there isn't one. Raises Unresolved
+    if that can't be told.
+    """
+    sn = repair._data.get('serialNumber')
+    po = repair._data.get('poNumber') or repair._data.get('purchaseOrderNumber')
+
+    if not sn:
+        raise Unresolved('Repair may have been created, it has no serial number to look it up')
+
+    found = Lookup(serialNumber=sn, fromDate=since, toDate=date.today()).repairs(record=True)
+
+    if po is None:
+        if found:
+            # any of them could be someone else's
+            raise Unresolved('Repair may have been created, %s has %d repairs since %s '
+                             'and there is no PO number to match' % (sn, len(found), since))
+        return
+
+    for r in found:
+        if unicode(r.purchaseOrderNumber) == unicode(po):
+            return r.repairConfirmationNumber
+
+
+def is_ambiguous(error):
+    """True if GSX may have processed a request that failed with error."""
+    return not error.codes and not isinstance(error, GsxCircuitOpen)
+
+
+def is_retryable(error):
+    return is_ambiguous(error) or isinstance(error, GsxCircuitOpen)
+
+
+class Outbox(object):
+    """
+    SQLite backed queue of GsxObject operations such as
+    CarryInRepair.create or StockingOrder.submit.
+    Callbacks are kept in memory and called from the sending thread.
+    """
+    def __init__(self, path, retries=5, backoff=5, max_backoff=600, poll=1):
+        self.path = path
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.poll = poll
+        self.callbacks = {}
+        self._local = threading.local()
+        self._done = threading.Condition()
+        self._stop = threading.Event()
+        self._threads = []
+        self.db.execute(SCHEMA)
+        self.db.commit()
+
+    @property
+    def db(self):
+        if not hasattr(self._local, 'db'):
+            self._local.db = sqlite3.connect(self.path, timeout=30)
+        return self._local.db
+
+    def enqueue(self, obj, operation='create', key=None, callback=None):
+        """
+        Queues obj.operation() and returns its idempotency key.
+        Queueing a key that's already in the outbox does nothing.
+        """
+        key = key or uuid.uuid4().hex
+        payload = sqlite3.Binary(pickle.dumps(obj, 2))
+        now = time.time()
+
+        with self.db:
+            self.db.execute("INSERT OR IGNORE INTO outbox (key, operation, payload, state, "
+                            "next_attempt, created) VALUES (?, ?, ?, ?, ?, ?)",
+                            (key, operation, payload, QUEUED, now, now))
+
+        if callback is not None:
+            self.callbacks[key] = callback
+
+        return key
+
+    def status(self, key):
+        """Returns the outbox entry of key as a dict, None if there isn't one."""
+        row = self.db.execute("SELECT %s FROM outbox WHERE key = ?" % ', '.join(COLUMNS),
+                              (key,)).fetchone()
+        if row is not None:
+            return dict(zip(COLUMNS, row))
+
+    def pending(self):
+        rows = self.db.execute("SELECT key FROM outbox WHERE state IN (?, ?) ORDER BY created",
+                               (QUEUED, SENDING))
+        return [r[0] for r in rows]
+
+    def _claim(self):
+        """Marks the next due entry as being sent and returns it."""
+        with self.db:
+            row = self.db.execute("SELECT key, operation, payload, state, uncertain, attempts, "
+                                  "first_sent FROM outbox WHERE state IN (?, ?) AND "
+                                  "next_attempt <= ? ORDER BY created LIMIT 1",
+                                  (QUEUED, SENDING, time.time())).fetchone()
+            if row is None:
+                return
+
+            key, operation, payload, state, uncertain, attempts, first_sent = row
+            # An entry left in SENDING was interrupted, GSX may have it already
+            uncertain = uncertain or state == SENDING
+            cursor = self.db.execute("UPDATE outbox SET state = ?, uncertain = ?, "
+                                     "attempts = attempts + 1, first_sent = ?, "
+                                     "next_attempt = ? WHERE key = ? AND attempts = ?",
+                                     (SENDING, uncertain, first_sent or time.time(),
+                                      time.time() + self.max_backoff, key, attempts))
+            if cursor.rowcount != 1:
+                return  # another thread got it
+
+        return key, operation, pickle.loads(str(payload)), uncertain, attempts + 1, first_sent
+
+    def _finish(self, key, state, confirmation=None, result=None, error=None):
+        with self.db:
+            self.db.execute("UPDATE outbox SET state = ?, confirmation = ?, result = ?, "
+                            "error = ? WHERE key = ?",
+                            (state, confirmation, result, error, key))
+
+        callback = self.callbacks.pop(key, None)
+
+        if callback is not None:
+            try:
+                callback(self.status(key))
+            except Exception:
+                logging.exception("Outbox callback for %s failed" % key)
+
+        with self._done:
+            self._done.notify_all()
+
+    def _retry(self, key, attempts, error, uncertain):
+        if attempts >= self.retries:
+            return self._finish(key, FAILED, error=unicode(error))
+
+        delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+        delay += random.uniform(0, self.backoff)
+
+        with self.db:
+            self.db.execute("UPDATE outbox SET state = ?, uncertain = ?, next_attempt = ?, "
+                            "error = ? WHERE key = ?",
+                            (QUEUED, uncertain, time.time() + delay, unicode(error), key))
+
+    def _reconcile(self, obj, first_sent):
+        if isinstance(obj, Repair) and first_sent:
+            return reconcile_repair(obj, date.fromtimestamp(first_sent))
+
+    def process(self):
+        """Sends the next due entry, returns False if there was none."""
+        claimed = self._claim()
+
+        if claimed is None:
+            return False
+
+        key, operation, obj, uncertain, attempts, first_sent = claimed
+
+        if uncertain:
+            try:
+                confirmation = self._reconcile(obj, first_sent)
+            except Unresolved as e:
+                logging.warning("Outbox %s needs manual review: %s" % (key, e))
+                self._finish(key, FAILED, error=unicode(e))
+                return True
+            except Exception as e:
+                # still don't know if GSX has it, a lookup fault is no reason to give up
+                logging.warning("Outbox %s lookup failed: %s" % (key, e))
+                self._retry(key, attempts, e, True)
+                return True
+            if confirmation:
+                logging.info("Outbox %s was already created as %s" % (key, confirmation))
+                self._finish(key, DONE, confirmation)
+                return True
+
+        try:
+            result = getattr(obj, operation)()
+        except GsxError as e:
+            if is_retryable(e):
+                self._retry(key, attempts, e, uncertain or is_ambiguous(e))
+            else:
+                self._finish(key, FAILED, error=unicode(e))
+            return True
+        except Exception as e:
+            # we can't tell how far it got, so look before sending it again
+            logging.exception("Outbox %s failed" % key)
+            self._retry(key, attempts, e, True)
+            return True
+
+        confirmation = getattr(result, 'confirmationNumber', None)
+        data = to_dict(result) if hasattr(result, 'iterchildren') else None
+        self._finish(key, DONE, confirmation and unicode(confirmation), _json(data))
+        return True
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                busy = self.process()
+            except Exception:
+                logging.exception("Outbox failed")
+                busy = False
+            if not busy:
+                self._stop.wait(self.poll)
+
+    def start(self, workers=1):
+        """Starts sending in the background."""
+        self._stop.clear()
+        for i in range(workers):
+            t = threading.Thread(target=self.run)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def wait(self, key, timeout=None):
+        """Waits until key is done or has failed, returns its entry."""
+        deadline = None if timeout is None else time.time() + timeout
+
+        with self._done:
+            while True:
+                entry = self.status(key)
+                if entry is None or entry['state'] in (DONE, FAILED):
+                    return entry
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return entry
+                self._done.wait(remaining if remaining is not None else self.poll)
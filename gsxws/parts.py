@@ -1,10 +1,8 @@
 # -*- coding: utf-8 -*-
 
-import urllib
-import tempfile
-
 from lookups import Lookup
-from core import GsxObject, GsxError
+from core import GsxObject, GsxError, pmap
+from images import IMAGE_URL, default_cache, part_image_url
 
 REASON_CODES = (
     ('A', 'Part not needed'),
@@ -14,8 +12,6 @@ REASON_CODES = (
     ('E', 'Customer refused order'),
 )
 
-IMAGE_URL = "https://km.support.apple.com.edgekey.net/kb/imageService.jsp?image=%s"
-
 
 class Part(GsxObject):
     """A service part.
@@ -27,23 +23,30 @@ class Part(GsxObject):
         lookup = Lookup(**self._data)
         return lookup.parts()
 
-    def fetch_image(self):
+    def fetch_image(self, cache=None):
         """
-        Tries the fetch the product image for this service part
+        Tries the fetch the product image for this service part,
+        returns the path of the image in the image cache
         """
         if self.partNumber is None:
             raise GsxError("Cannot fetch part image without part number")
 
-        image = "%s_350_350.gif" % self.partNumber
-        url = IMAGE_URL % image
-        tmpfile = tempfile.mkstemp(suffix=image)
-
         try:
-            return urllib.urlretrieve(url, tmpfile[1])[0]
+            return (cache or default_cache()).get(part_image_url(self.partNumber))
         except Exception as e:
             raise GsxError("Failed to fetch part image: %s" % e)
 
 
+def prefetch_images(part_numbers, cache=None, workers=None):
+    """
+    Downloads the images of part_numbers concurrently into the image cache,
+    yields (part number, path or GsxError) tuples.
+    """
+    cache = cache or default_cache()
+    fetch = lambda pn: cache.get(part_image_url(pn))
+    return pmap(fetch, part_numbers, workers)
+
+
 if __name__ == '__main__':
     import sys
     import doctest
@@ -3,10 +3,26 @@
 https://gsxwsut.apple.com/apidocs/ut/html/WSAPIChangeLog.html?user=asp
 """
 
+import os
 import re
-import urllib
+import time
+import shelve
+import logging
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 
 from lookups import Lookup
+from tracing import traced
+from records import WarrantyInfo, ActivationInfo, ModelInfo
+from images import default_cache
 from diagnostics import Diagnostics
 from core import GsxObject, GsxError, validate
 
@@ -22,6 +38,150 @@ def models():
     return yaml.load(open(filepath, 'r'))
 
 
+def serial_suffix(sn):
+    """
+    Returns the part of the serial number that encodes the configuration,
+    None for serial numbers that don't have one.
+
+    >>> serial_suffix('DGKFL06JDHJP')
+    'DHJP'
+    >>> serial_suffix('W874939YX92')
+    'X92'
+    """
+    if not sn or not validate(sn, 'serialNumber'):
+        return
+    return str(sn[-4:] if len(sn) == 12 else sn[-3:])
+
+
+class ModelIndex(object):
+    """
+    Remembers the model of each configuration (serial number suffix) seen
+    in model() and warranty() responses so that Product.model(record=True)
+    can answer for other devices of the same configuration without calling
+    GSX. With verify=True the first local answer for each configuration is
+    checked against GSX in the background.
+    The shelf at path can only be open in one process at a time.
+    """
+    FIELDS = ('configDescription', 'productLine', 'configCode',)
+
+    def __init__(self, path=None, verify=False):
+        self.path = path or os.path.join(tempfile.gettempdir(), 'gsxws_models')
+        self._lockfile = open(self.path + '.lock', 'a')
+
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                self._lockfile.close()
+                raise GsxError('Model index %s is in use by another process' % self.path)
+
+        self.shelf = shelve.open(self.path, protocol=-1)
+        self.verify = verify
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.learned = 0
+        self.checked = 0
+        self.mismatches = 0
+        self._verified = set()
+
+    def _complete(self, entry):
+        return entry is not None and all(entry.get(f) for f in self.FIELDS)
+
+    def lookup(self, sn):
+        """
+        Returns the ModelInfo of sn or None if it's not known. Configurations
+        only learned from warranty(), which has no product line or config
+        code, aren't answered for.
+        """
+        key = serial_suffix(sn)
+
+        with self.lock:
+            entry = self.shelf.get(key) if key else None
+            if self._complete(entry):
+                self.hits += 1
+            else:
+                self.misses += 1
+                return
+
+            verify = self.verify and key not in self._verified
+            self._verified.add(key)
+
+        if verify:
+            t = threading.Thread(target=self._verify, args=(sn,))
+            t.daemon = True
+            t.start()
+
+        return ModelInfo.from_dict(entry)
+
+    def learn(self, sn, **info):
+        """
+        Adds what a GSX response said about the model of sn. A model()
+        response that disagrees with what's stored counts as a mismatch.
+        """
+        key = serial_suffix(sn)
+        info = dict((k, unicode(v)) for k, v in info.items() if v is not None and k in self.FIELDS)
+
+        if not key or not info:
+            return
+
+        with self.lock:
+            entry = self.shelf.get(key) or {}
+
+            if len(info) == len(self.FIELDS) and self._complete(entry):
+                self.checked += 1
+                if any(entry.get(k) not in (None, v) for k, v in info.items()):
+                    self.mismatches += 1
+                    logging.warning('Model index had the wrong model for %s' % key)
+
+            if not entry:
+                self.learned += 1
+
+            entry.update(info)
+            self.shelf[key] = entry
+            self.shelf.sync()
+
+    def _verify(self, sn):
+        try:
+            Product(sn)._fetch_model()
+        except Exception as e:
+            logging.warning('Could not verify the model of %s: %s' % (sn, e))
+
+    def stats(self):
+        with self.lock:
+            size = len(self.shelf)
+            hits, misses = self.hits, self.misses
+            checked, mismatches = self.checked, self.mismatches
+            learned = self.learned
+
+        lookups = hits + misses
+        return {
+            'size': size,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / float(lookups) if lookups else 0,
+            'learned': learned,
+            'checked': checked,
+            'mismatches': mismatches,
+            'precision': 1 - mismatches / float(checked) if checked else None,
+        }
+
+    def close(self):
+        with self.lock:
+            self.shelf.close()
+            self._lockfile.close()  # releases the lock
+
+
+MODEL_INDEX = None  # ModelIndex used by Product.model() and warranty()
+
+
+def use_model_index(path=None, verify=False):
+    """Makes Product.model(record=True) answer from and learn into a ModelIndex."""
+    global MODEL_INDEX
+    MODEL_INDEX = ModelIndex(path, verify)
+    return MODEL_INDEX
+
+
 class Product(object):
     """
     Something serviceable made by Apple
@@ -39,20 +199,45 @@ class Product(object):
 
         self._gsx._namespace = "glob:"
 
-    def model(self):
+    @traced('Product.model')
+    def model(self, record=False):
         """
-        Returns the model description of this Product
+        Returns the model description of this Product. With record=True
+        returns a ModelInfo instead of the tree, answered from the
+        MODEL_INDEX without calling GSX if it knows the configuration.
 
         >>> Product('DGKFL06JDHJP').model().configDescription
         'iMac (27-inch, Mid 2011)'
         """
-        result = self._gsx._submit("productModelRequest", "FetchProductModel")
+        result = None
+        sn = getattr(self, 'serialNumber', None)
+
+        if record and MODEL_INDEX is not None and sn:
+            result = MODEL_INDEX.lookup(sn)
+
+        if result is None:
+            result = self._fetch_model()
+            if record:
+                result = ModelInfo.from_element(result)
+
         self.configDescription = result.configDescription
         self.productLine = result.productLine
         self.configCode = result.configCode
         return result
 
-    def warranty(self, parts=[], date_received=None, ship_to=None):
+    def _fetch_model(self):
+        result = self._gsx._submit("productModelRequest", "FetchProductModel")
+
+        if MODEL_INDEX is not None and hasattr(self, 'serialNumber'):
+            MODEL_INDEX.learn(self.serialNumber,
+                              configDescription=result.configDescription,
+                              productLine=result.productLine,
+                              configCode=result.configCode)
+
+        return result
+
+    @traced('Product.warranty')
+    def warranty(self, parts=[], date_received=None, ship_to=None, record=False):
         """
         The Warranty Status API retrieves the same warranty details
         displayed on the GSX Coverage screen.
@@ -70,6 +255,8 @@ class Product(object):
         AttributeError: no such child: blaa
         >>> Product('WQ8094DW0P1').warranty([(u'661-5070', u'Z26',)]).warrantyStatus
         'Out Of Warranty (No Coverage)'
+        >>> Product('DGKFL06JDHJP').warranty(record=True) # doctest: +ELLIPSIS
+        WarrantyInfo(serialNumber=u'DGKFL06JDHJP', ...
         """
         if self.should_check_activation:
             ad = self.activation()
@@ -94,21 +281,35 @@ class Product(object):
         self._gsx._submit("unitDetail", "WarrantyStatus", "warrantyDetailInfo")
 
         self.warrantyDetails = self._gsx._req.objects
+        self.repair_strategies = []
+
+        if record:
+            self.warrantyDetails = WarrantyInfo.from_element(self.warrantyDetails)
+            self._gsx._req.objects = None
+            strategies = self.warrantyDetails.availableRepairStrategies or {}
+            strategies = strategies.get('availableRepairStrategy') or []
+            if not isinstance(strategies, list):
+                strategies = [strategies]
+            self.repair_strategies = strategies
+        else:
+            try:
+                for i in self.warrantyDetails.availableRepairStrategies:
+                    self.repair_strategies.append(i.availableRepairStrategy)
+            except (AttributeError, TypeError):
+                pass
+
+        if MODEL_INDEX is not None:
+            MODEL_INDEX.learn(self._gsx._data.get('serialNumber'),
+                              configDescription=self.warrantyDetails.configDescription)
+
         self.imageURL = self.warrantyDetails.imageURL
         self.productDescription = self.warrantyDetails.productDescription
         self.description = self.productDescription.lstrip('~VIN,')
 
-        self.repair_strategies = []
-
-        try:
-            for i in self.warrantyDetails.availableRepairStrategies:
-                self.repair_strategies.append(i.availableRepairStrategy)
-        except (AttributeError, TypeError):
-            pass
-
         return self.warrantyDetails
 
-    def parts(self):
+    @traced('Product.parts')
+    def parts(self, record=False):
         """
         >>> Product('DGKFL06JDHJP').parts() # doctest: +ELLIPSIS
         <Element parts at...
@@ -116,10 +317,11 @@ class Product(object):
         <Element parts at...
         """
         try:
-            return Lookup(serialNumber=self.serialNumber).parts()
+            return Lookup(serialNumber=self.serialNumber).parts(record)
         except AttributeError:
-            return Lookup(productName=self.productName).parts()
+            return Lookup(productName=self.productName).parts(record)
 
+    @traced('Product.repairs')
     def repairs(self):
         """
         >>> Product(serialNumber='DGKFL06JDHJP').repairs() # doctest: +ELLIPSIS
@@ -127,6 +329,7 @@ class Product(object):
         """
         return Lookup(serialNumber=self.serialNumber).repairs()
 
+    @traced('Product.diagnostics')
     def diagnostics(self):
         """
         >>> Product('DGKFL06JDHJP').diagnostics()
@@ -138,7 +341,7 @@ class Product(object):
             
         return diags.fetch()
 
-    def fetch_image(self, url=None):
+    def fetch_image(self, url=None, cache=None):
         """
         >>> Product('DGKFL06JDHJP').fetch_image() # doctest: +ELLIPSIS
         Traceback (most recent call last):
@@ -151,11 +354,12 @@ class Product(object):
             raise GsxError("No URL to fetch product image")
 
         try:
-            return urllib.urlretrieve(url)[0]
+            return (cache or default_cache()).get(url)
         except Exception as e:
             raise GsxError("Failed to fetch product image: %s" % e)
 
-    def activation(self):
+    @traced('Product.activation')
+    def activation(self, record=False):
         """
         The Fetch iOS Activation Details API is used to
         fetch activation details of iOS Devices.
@@ -168,9 +372,14 @@ class Product(object):
         GsxError: Provided serial number does not belong to an iOS Device...
         """
         self._gsx._namespace = "glob:"
-        return self._gsx._submit("FetchIOSActivationDetailsRequest",
-                                 "FetchIOSActivationDetails",
-                                 "activationDetailsInfo")
+        result = self._gsx._submit("FetchIOSActivationDetailsRequest",
+                                   "FetchIOSActivationDetails",
+                                   "activationDetailsInfo")
+        if record:
+            self._gsx._req.objects = None
+            return ActivationInfo.from_element(result)
+
+        return result
 
     @property
     def fmip_status(self, wty=None):
@@ -258,6 +467,97 @@ class Product(object):
             return False
 
 
+INTAKE_CALLS = ('warranty', 'model', 'parts', 'repairs', 'diagnostics',)
+
+# Calls that can return records instead of trees
+RECORD_CALLS = ('warranty', 'model', 'parts', 'activation',)
+
+
+class Dossier(object):
+    """
+    What intake() found out about a device. Calls that failed or
+    didn't finish in time have their exception in errors instead.
+    """
+    def __init__(self, sn):
+        self.sn = sn
+        self.serialNumber = None
+        self.results = {}
+        self.errors = {}
+        self.timings = {}
+        self.elapsed = 0
+
+    def __getitem__(self, name):
+        return self.results[name]
+
+    def get(self, name, default=None):
+        return self.results.get(name, default)
+
+    @property
+    def complete(self):
+        return not self.errors
+
+
+def intake(sn, deadline=None, calls=INTAKE_CALLS, record=False):
+    """
+    Runs the lookups needed when checking in a device concurrently and
+    returns a Dossier of the results. An IMEI is resolved to the serial
+    number with the activation details first. Calls still running after
+    deadline seconds are left behind and reported as errors.
+
+    >>> intake('013348005376007', deadline=10)['warranty'].warrantyStatus
+    u'Apple Limited Warranty'
+    """
+    start = time.time()
+    dossier = Dossier(sn)
+    pool = ThreadPool(len(calls) + 1)
+
+    def run(name, number):
+        started = time.time()
+        method = getattr(Product(number), name)
+        try:
+            return method(record=record) if name in RECORD_CALLS else method()
+        finally:
+            dossier.timings[name] = time.time() - started
+
+    def remaining():
+        if deadline is not None:
+            return max(deadline - (time.time() - start), 0)
+
+    def wait(name, result):
+        try:
+            dossier.results[name] = result.get(remaining())
+        except TimeoutError:
+            dossier.errors[name] = GsxError('%s did not finish in %s seconds' % (name, deadline))
+        except Exception as e:
+            dossier.errors[name] = e
+
+    try:
+        if validate(sn, 'alternateDeviceId'):
+            wait('activation', pool.apply_async(run, ('activation', sn,)))
+            activation = dossier.get('activation')
+
+            if activation is None:
+                error = dossier.errors['activation']
+                for name in calls:
+                    dossier.errors[name] = error
+                return dossier
+
+            dossier.serialNumber = activation.serialNumber
+        else:
+            dossier.serialNumber = sn
+
+        pending = [(name, pool.apply_async(run, (name, dossier.serialNumber,)))
+                   for name in calls if name not in dossier.results]
+
+        for name, result in pending:
+            wait(name, result)
+    finally:
+        pool.close()
+        dossier.elapsed = time.time() - start
+
+    return dossier
+
+
 if __name__ == '__main__':
     import sys
     import doctest
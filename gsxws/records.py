@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Lightweight records for the most used GSX responses.
+
+The records are immutable namedtuples built from the parsed response in
+one pass, so they don't keep the lxml tree alive and pickle compactly.
+Pass record=True to get one instead of the tree:
+
+    >>> wty = Product('DGKFL06JDHJP').warranty(record=True)
+    >>> wty.warrantyStatus
+    u'Apple Limited Warranty'
+
+Elements without a field of their own are kept in the extra dict and can
+still be read as attributes. Missing ones are None, like with the tree.
+Nested dicts and lists are frozen into FrozenDicts and tuples, so records
+can be hashed. to_dict() returns plain dicts and lists again.
+"""
+
+from collections import namedtuple
+
+from objectify import to_dict
+
+
+class FrozenDict(dict):
+    """A dict that can't be changed and can be hashed."""
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('FrozenDict is immutable')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _immutable
+
+    def __hash__(self):
+        return hash(frozenset(self.items()))
+
+    def __reduce__(self):
+        return FrozenDict, (dict(self),)
+
+
+def freeze(value):
+    """
+    >>> freeze({'a': [1, {'b': 2}]})
+    {'a': (1, {'b': 2})}
+    """
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def thaw(value):
+    if isinstance(value, dict):
+        return dict((k, thaw(v)) for k, v in value.items())
+    if isinstance(value, tuple):
+        return [thaw(v) for v in value]
+    return value
+
+
+def record(name, fields):
+    """Returns an immutable record type called name with fields and extra."""
+    base = namedtuple(name, fields + ('extra',))
+
+    class Record(base):
+        __slots__ = ()
+
+        @classmethod
+        def from_dict(cls, data):
+            data = dict(data)
+            values = [freeze(data.pop(f, None)) for f in fields]
+            return cls(*values, extra=freeze(data) or None)
+
+        @classmethod
+        def from_element(cls, el):
+            return cls.from_dict(to_dict(el))
+
+        @classmethod
+        def from_elements(cls, el):
+            """Returns a list of records of el and its siblings."""
+            return [cls.from_element(e) for e in el] if el is not None else []
+
+        def __getattr__(self, name):
+            if name.startswith('_'):
+                raise AttributeError(name)
+            return (self.extra or {}).get(name)
+
+        def to_dict(self):
+            result = thaw(self.extra or {})
+            result.update((f, thaw(v)) for f, v in zip(fields, self))
+            return result
+
+    Record.__name__ = name
+    return Record
+
+
+WarrantyInfo = record('WarrantyInfo', (
+    'serialNumber', 'warrantyStatus', 'coverageStartDate', 'coverageEndDate',
+    'daysRemaining', 'estimatedPurchaseDate', 'registrationDate',
+    'purchaseCountry', 'productDescription', 'configDescription',
+    'imageURL', 'explodedViewURL', 'manualURL', 'laborCovered',
+    'partCovered', 'limitedWarranty', 'contractType', 'contractCoverageStartDate',
+    'contractCoverageEndDate', 'onsiteStartDate', 'onsiteEndDate',
+    'activationLockStatus', 'availableRepairStrategies', 'acPlusFlag',
+))
+
+ActivationInfo = record('ActivationInfo', (
+    'serialNumber', 'imeiNumber', 'meid', 'iccID', 'partDescription',
+    'productVersion', 'unbricked', 'unlocked', 'unlockDate',
+    'firstUnbrickDate', 'lastUnbrickDate', 'lastRestoreDate',
+    'appliedActivationPolicyID', 'appliedActivationDetails',
+    'nextTetherPolicyID', 'nextTetherPolicyDetails',
+))
+
+RepairDetails = record('RepairDetails', (
+    'repairConfirmationNumber', 'dispatchId', 'serialNumber', 'soldToCode',
+    'sroNumber', 'purchaseOrderNumber', 'referenceNumber', 'productName',
+    'configuration', 'warrantyDescription', 'coverageStatusDescription',
+    'dispatchSentDate', 'notes', 'primaryAddress', 'partsInfo', 'acPlusFlag',
+))
+
+RepairStatus = record('RepairStatus', (
+    'repairConfirmationNumber', 'repairStatus', 'purchaseOrderNumber',
+    'sroNumber', 'receivedDate', 'repairLastUpdatedDate',
+))
+
+ModelInfo = record('ModelInfo', (
+    'configDescription', 'productLine', 'configCode',
+))
+
+RepairSummary = record('RepairSummary', (
+    'repairConfirmationNumber', 'repairNumber', 'repairType', 'repairStatus',
+    'purchaseOrderNumber', 'serialNumber', 'shipToCode', 'customerFirstName',
+    'customerLastName', 'customerEmailAddress', 'technicianFirstName',
+    'technicianLastName',
+))
+
+PartInfo = record('PartInfo', (
+    'partNumber', 'partDescription', 'partType', 'originalPartNumber',
+    'componentCode', 'eeeCode', 'laborTier', 'isSerialized',
+    'exchangePrice', 'stockPrice',
+))
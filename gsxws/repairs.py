@@ -2,10 +2,22 @@
 "gsxws/repairs.py"
 
 import sys
+import shelve
 import logging
+from datetime import date, timedelta
 
-from core import GsxObject, GsxError, validate
-from lookups import Lookup
+from core import GsxObject, GsxError, GsxEmptyResult, validate, chunked, pmap, submit_batch
+from lookups import Lookup, REPAIR_LOOKUP_LIMIT
+from tracing import traced
+from objectify import to_dict
+from records import RepairDetails, RepairStatus
+
+# Maximum number of confirmation numbers per RepairStatus request
+STATUS_BATCH_SIZE = 50
+# Maximum number of confirmation numbers per MarkRepairComplete request
+COMPLETE_BATCH_SIZE = 50
+# Per repair outcomes of MarkRepairComplete that mean it wasn't marked complete
+COMPLETE_FAILED = ('STOP', 'FAILURE', 'ERROR',)
 
 REPAIR_TYPES = (
     ('CA', 'Carry-In/Non-Replinished'),
@@ -179,6 +191,7 @@ class Repair(GsxObject):
                             "UpdateKGBSerialNumber",
                             "UpdateKGBSerialNumberResponse")
 
+    @traced('Repair.lookup')
     def lookup(self):
         """
         Description:
@@ -202,6 +215,7 @@ class Repair(GsxObject):
         """
         pass
 
+    @traced('Repair.mark_complete')
     def mark_complete(self, numbers=None):
         """
         The Mark Repair Complete API allows a single or an array of
@@ -212,7 +226,8 @@ class Repair(GsxObject):
                             "MarkRepairComplete",
                             "MarkRepairCompleteResponse")
 
-    def status(self, numbers=None):
+    @traced('Repair.status')
+    def status(self, numbers=None, record=False):
         """
         The Repair Status API retrieves the status
         for the submitted repair confirmation number(s).
@@ -222,11 +237,17 @@ class Repair(GsxObject):
         """
         self.repairConfirmationNumbers = self.dispatchId
         status = self._submit("RepairStatusRequest", "RepairStatus", "repairStatus")
+
+        if record:
+            self._req.objects = None
+            status = RepairStatus.from_element(status)
+
         self.repairStatus = status.repairStatus
         self._status = status
         return status
 
-    def details(self):
+    @traced('Repair.details')
+    def details(self, record=False):
         """
         The Repair Details API includes the shipment information
         similar to the Repair Lookup API.
@@ -237,6 +258,18 @@ class Repair(GsxObject):
         self._namespace = "core:"
         details = self._submit("RepairDetailsRequest", "RepairDetails", "lookupResponseData")
 
+        if record:
+            self._req.objects = None
+            details = to_dict(details)
+
+            for p in details.get('partsInfo', []):
+                if p.get('carrierURL'):
+                    p['carrierURL'] = p['carrierURL'].replace('<<TRKNO>>',
+                                                              str(p.get('deliveryTrackingNumber')))
+
+            self._details = RepairDetails.from_dict(details)
+            return self._details
+
         # fix tracking URL, if available
         for i, p in enumerate(details.partsInfo):
             try:
@@ -272,6 +305,7 @@ class CarryInRepair(Repair):
     >>> CarryInRepair(requestReviewByApple=True).requestReviewByApple
     'Y'
     """
+    @traced('CarryInRepair.create')
     def create(self):
         """
         GSX validates the information and if all of the validations go through,
@@ -287,6 +321,7 @@ class CarryInRepair(Repair):
         self.dispatchId = result.confirmationNumber
         return result
 
+    @traced('CarryInRepair.update')
     def update(self, newdata):
         """
         The Update Carry-In Repair API allows the service providers
@@ -387,6 +422,225 @@ class MailInRepair(Repair):
         return self._submit("repairData", "CreateMailInRepair", "repairConfirmation")
         
 
+def _submit_batches(submit, numbers, size, workers=None):
+    """
+    Packs numbers into batches of size and submits them concurrently.
+    Yields (dispatch ID, result) tuples as the batches complete.
+    """
+    batches = chunked(numbers, size)
+    for batch, results in pmap(lambda b: submit_batch(submit, b), batches, workers):
+        for n in batch:
+            yield n, results[n]
+
+
+def _fetch_status(numbers):
+    rep = Repair()
+    rep.repairConfirmationNumbers = numbers
+    result = rep._submit("RepairStatusRequest", "RepairStatus", "repairStatus")
+    return dict((unicode(s.repairConfirmationNumber), s) for s in result)
+
+
+def status_many(numbers, size=STATUS_BATCH_SIZE, workers=None):
+    """
+    Fetches the status of any number of repairs with as few
+    RepairStatus requests as possible.
+    Yields (dispatch ID, status) tuples, where status is either
+    the repairStatus element or the GsxError for that dispatch ID.
+
+    >>> dict(status_many(['G135773004', 'G135762375'])) # doctest: +ELLIPSIS
+    {'G135773004': <Element repairStatus at...
+    """
+    return _submit_batches(_fetch_status, numbers, size, workers)
+
+
+def _completed(c):
+    """
+    Returns the confirmation element c of MarkRepairComplete, or a GsxError
+    if its outcome or error fields say that repair wasn't marked complete.
+    """
+    fields = to_dict(c)
+    outcome = unicode(fields.get('outcome') or fields.get('outCome') or '').upper()
+
+    if outcome not in COMPLETE_FAILED and not fields.get('errorCode'):
+        return c
+
+    messages = fields.get('messages') or fields.get('errorMessage') or outcome
+    if isinstance(messages, list):
+        messages = ' '.join(unicode(m) for m in messages)
+
+    error = GsxError(unicode(messages))
+    error.codes.append(unicode(fields.get('errorCode') or outcome))
+    return error
+
+
+def _mark_complete(numbers):
+    rep = Repair()
+    rep.repairConfirmationNumbers = numbers
+    result = rep._submit("MarkRepairCompleteRequest", "MarkRepairComplete",
+                         "MarkRepairCompleteResponse")
+    return dict((unicode(c.confirmationNumber), _completed(c))
+                for c in result.repairConfirmationNumbers)
+
+
+def mark_complete_many(numbers, size=COMPLETE_BATCH_SIZE, workers=None):
+    """
+    Marks any number of repairs complete with as few
+    MarkRepairComplete requests as possible.
+    Dispatch IDs are checked locally before anything is sent.
+    Yields (dispatch ID, result) tuples, where result is either the
+    confirmation element, a GsxError (also when GSX reports that one
+    repair couldn't be marked complete) or a ValueError for an invalid ID.
+
+    >>> dict(mark_complete_many(['G135773004', 'blaa']))['blaa']
+    ValueError('Invalid dispatch ID: blaa',)
+    """
+    invalid = []
+
+    def valid(numbers):
+        for n in numbers:
+            if isinstance(n, basestring) and validate(n, 'dispatchId'):
+                yield n
+            else:
+                invalid.append(n)
+
+    for result in _submit_batches(_mark_complete, valid(numbers), size, workers):
+        yield result
+
+    for n in invalid:
+        yield n, ValueError('Invalid dispatch ID: %s' % n)
+
+
+EVENT_NEW = 'new'
+EVENT_STATUS = 'status'
+EVENT_CLOSED = 'closed'
+
+
+class RepairSync(object):
+    """
+    Keeps a local shelf of repairs in sync with GSX.
+
+    The first run walks RepairLookup from start to today in date windows,
+    splitting any window that hits the RepairLookup limit in half until
+    the results fit. The last synced date is stored as a high-water mark
+    so later runs only look up repairs created since then. Repairs that
+    are still open in the store are refreshed with status_many().
+
+    >>> RepairSync('/tmp/repairs', shipToCode='677592').sync() # doctest: +ELLIPSIS
+    [('new', 'G135773004', None, {...
+    """
+    HWM_KEY = '__hwm__'
+
+    def __init__(self, path, start=None, window=timedelta(days=30),
+                 workers=None, **criteria):
+        self.shelf = shelve.open(path, protocol=-1)
+        self.start = start or date.today() - timedelta(days=365)
+        self.window = window
+        self.workers = workers
+        self.criteria = criteria
+        self.errors = []
+
+    @property
+    def high_water_mark(self):
+        return self.shelf.get(self.HWM_KEY)
+
+    def windows(self, start, end):
+        """Splits the range from start to end into sync windows."""
+        while start <= end:
+            stop = min(start + self.window - timedelta(days=1), end)
+            yield start, stop
+            start = stop + timedelta(days=1)
+
+    def _lookup(self, window):
+        fromDate, toDate = window
+        try:
+            return Lookup(fromDate=fromDate, toDate=toDate, **self.criteria).lookup("RepairLookup")
+        except GsxEmptyResult:
+            return []  # no repairs in this window
+
+    def fetch(self, start, end):
+        """
+        Yields every repair created between start and end, fetching
+        windows concurrently and splitting the ones that are capped.
+        """
+        pending = list(self.windows(start, end))
+
+        while pending:
+            split = []
+            for window, result in pmap(self._lookup, pending, self.workers):
+                if isinstance(result, GsxError):
+                    logging.error("RepairLookup %s - %s failed: %s" % (window + (result,)))
+                    self.errors.append((window, result))
+                    continue
+
+                first, last = window
+                if len(result) >= REPAIR_LOOKUP_LIMIT and first < last:
+                    middle = first + (last - first) // 2
+                    split += [(first, middle), (middle + timedelta(days=1), last)]
+                    continue
+
+                if len(result) >= REPAIR_LOOKUP_LIMIT:
+                    logging.warning("Repairs for %s truncated to %d" % (first, len(result)))
+
+                for r in result:
+                    yield dict((c.tag, c.text) for c in r.iterchildren())
+
+            pending = split
+
+    def _update(self, number, repair, events):
+        old = self.shelf.get(number)
+        status = repair.get('repairStatus') or ''
+
+        if old is None:
+            events.append((EVENT_NEW, number, None, repair))
+        elif old.get('repairStatus') != repair.get('repairStatus'):
+            event = EVENT_CLOSED if 'Closed' in status else EVENT_STATUS
+            events.append((event, number, old, repair))
+
+        self.shelf[number] = repair
+
+    def refresh(self, events):
+        """Refreshes the status of all open repairs in the store."""
+        numbers = [k for k, v in self.shelf.items()
+                   if k != self.HWM_KEY and 'Closed' not in (v.get('repairStatus') or '')]
+
+        for number, status in status_many(numbers, workers=self.workers):
+            if isinstance(status, GsxError):
+                self.errors.append((number, status))
+                continue
+
+            repair = dict(self.shelf[number])
+            repair['repairStatus'] = status.repairStatus
+            self._update(number, repair, events)
+
+    @traced('RepairSync.sync')
+    def sync(self, until=None):
+        """
+        Brings the store up to date and returns the list of changes
+        as (event, dispatch ID, old repair, new repair) tuples.
+        """
+        events = []
+        self.errors = []
+        until = until or date.today()
+        start = self.high_water_mark or self.start
+
+        self.refresh(events)
+        failed = len(self.errors)
+
+        for repair in self.fetch(start, until):
+            number = str(repair['repairConfirmationNumber'])
+            self._update(number, repair, events)
+
+        # Restart from the same day next time since it may not be over yet
+        if len(self.errors) == failed:
+            self.shelf[self.HWM_KEY] = until
+
+        self.shelf.sync()
+        return events
+
+    def close(self):
+        self.shelf.close()
+
+
 if __name__ == '__main__':
     import doctest
     from core import connect
@@ -1,6 +1,11 @@
 # -*- coding: utf-8 -*-
 
-from core import GsxObject, validate
+import os
+
+from core import GsxObject, GsxError, GsxRequest, validate, chunked, pmap, submit_batch
+
+# Maximum number of parts per RegisterPartsForBulkReturn request
+BULK_RETURN_SIZE = 50
 
 RETURN_TYPES = (
     (1, "Dead On Arrival"),
@@ -58,10 +63,7 @@ class Return(GsxObject):
 
         >>> Return(repairType='CA').get_pending()  # doctest: +SKIP
         """
-        dt = self._make_type('ns1:partsPendingReturnRequestType')
-        dt.repairData = self.data
-
-        return self._submit('PartsPendingReturn', dt, 'partsPendingResponse')
+        return self._submit("repairData", "PartsPendingReturn", "partsPendingResponse")
 
     def get_report(self):
         """
@@ -86,6 +88,49 @@ class Return(GsxObject):
         self._submit("ReturnLabelRequest", "ReturnLabel", "returnLabelData")
         return self._req.objects
 
+    def save_label(self, part_number, path, packing_list=None):
+        """
+        Streams the Return Label for a given Return Order Number
+        straight into the file at path, optionally saving the packing list too.
+        The label is decoded as it's downloaded and only appears
+        at path once it's complete.
+
+        >>> Return('7458231326').save_label('661-5852', '/tmp/7458231326.pdf')
+        '/tmp/7458231326.pdf'
+        """
+        if not validate(part_number, 'partNumber'):
+            raise ValueError("%s is not a valid part number" % part_number)
+
+        self.partNumber = part_number
+        self._req = GsxRequest(ReturnLabelRequest=self)
+        files = {}
+
+        try:
+            try:
+                # open the files first, so that a failing open() doesn't
+                # leave the response unread
+                files['returnLabelFileData'] = open(path + '.part', 'wb')
+                if packing_list is not None:
+                    files['packingList'] = open(packing_list, 'wb')
+                res = self._req._stream("ReturnLabel")
+                result = self._req._stream_attachments("ReturnLabel", res, files)
+            finally:
+                for fp in files.values():
+                    fp.close()
+        except Exception as e:
+            for fp in files.values():
+                os.remove(fp.name)
+            if isinstance(e, GsxError):
+                raise
+            raise GsxError('Failed to save return label: %s' % e)
+
+        if 'returnLabelFileData' not in result.found:
+            os.remove(path + '.part')
+            raise GsxError(' '.join(result.messages) or 'GSX returned no return label')
+
+        os.rename(path + '.part', path)
+        return path
+
     def get_proforma(self):
         """
         The View Bulk Return Proforma API allows you to view the proforma label
@@ -127,6 +172,109 @@ class Return(GsxObject):
         return self._req.objects
 
 
+def _field(part, name, default=None):
+    if isinstance(part, dict):
+        return part.get(name, default)
+    value = getattr(part, name, None)
+    return default if value is None else value
+
+
+def _part_key(part):
+    return (str(_field(part, 'returnOrderNumber')), str(_field(part, 'partNumber')))
+
+
+def register_bulk(parts, shipment, size=BULK_RETURN_SIZE, workers=None):
+    """
+    Registers any number of pending parts for bulk return.
+    Parts (pending return elements or dicts) are grouped by ship-to,
+    packed into registrations of up to size parts and submitted
+    concurrently. A registration that GSX faults on is split up until
+    the failing parts are isolated. Shipment holds the carrier, tracking
+    and package details shared by all registrations.
+    Yields ((return order number, part number), result) tuples, where result
+    is the bulk registration or the GsxError for that part.
+    Raises ValueError before registering anything if a part has no ship-to.
+
+    >>> pending = Return(repairType='CA').get_pending() # doctest: +SKIP
+    >>> dict(register_bulk(pending, {'shipToCode': 677592, 'carrierCode': 'XUPSN',\
+    'trackingNumber': '12341234'})) # doctest: +SKIP
+    """
+    groups = {}
+    default = shipment.get('shipToCode')
+
+    for p in parts:
+        ship_to = _field(p, 'shipTo', default)
+        if ship_to is None or not unicode(ship_to).strip():
+            raise ValueError('No ship-to for part %s of %s' % (_field(p, 'partNumber'),
+                                                               _field(p, 'returnOrderNumber')))
+        groups.setdefault(unicode(ship_to), {})[_part_key(p)] = p
+
+    batches = [(ship_to, keys) for ship_to, g in groups.items()
+               for keys in chunked(sorted(g), size)]
+
+    def register(batch):
+        ship_to, keys = batch
+
+        def submit(keys):
+            ret = Return(**shipment)
+            ret.shipToCode = ship_to
+            order = [GsxObject(returnOrderNumber=_field(p, 'returnOrderNumber'),
+                               partNumber=_field(p, 'partNumber'),
+                               boxNumber=_field(p, 'boxNumber', 1))
+                     for p in (groups[ship_to][k] for k in keys)]
+            result = ret.register_parts(order)
+            return dict((k, result) for k in keys)
+
+        return submit_batch(submit, keys)
+
+    for (ship_to, keys), results in pmap(register, batches, workers):
+        for k in keys:
+            yield k, results[k]
+
+
+def update_parts_many(updates, workers=None):
+    """
+    Runs PartsReturnUpdate concurrently for many repairs.
+    Updates is a dict or an iterable of (confirmation number, parts) pairs.
+    Yields (confirmation number, result) tuples, where result is the
+    response or the GsxError for that repair.
+    """
+    if isinstance(updates, dict):
+        updates = updates.items()
+
+    def update(item):
+        confirmation, parts = item
+        return Return().update_parts(confirmation, parts)
+
+    for (confirmation, parts), result in pmap(update, updates, workers):
+        yield confirmation, result
+
+
+def download_labels(labels, directory, workers=None):
+    """
+    Downloads the return labels for (return order number, part number) pairs
+    concurrently into directory, skipping the ones already on disk.
+    Yields ((return order number, part number), result) tuples, where result
+    is the path of the label or the GsxError for that label.
+    """
+    todo = []
+
+    for order, part in labels:
+        filename = '%s_%s.pdf' % (order, part.replace('/', '-'))
+        path = os.path.join(directory, filename)
+        if os.path.exists(path):
+            yield (order, part), path
+        else:
+            todo.append((order, part, path))
+
+    def download(label):
+        order, part, path = label
+        return Return(order).save_label(part, path)
+
+    for (order, part, path), result in pmap(download, todo, workers):
+        yield (order, part), result
+
+
 if __name__ == '__main__':
     import sys
     import doctest
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Background refresh of reference data and sessions.
+
+Registered jobs run on a daemon thread before their data expires, so the
+first request after an expiry reads the refreshed copy instead of paying
+for the fetch. A failing job keeps its last value and is retried with
+exponential backoff.
+
+    >>> refresher = reference_data(session=GsxSession(...)).start()
+    >>> refresher['comptia'] # doctest: +ELLIPSIS
+    {u'A': ...
+
+refresher[name] never fetches, it's None until the job first succeeds.
+
+CompTIA codes and sessions are also written to their GsxCache, so
+CompTIA().fetch() and connect() hit a warm cache as well. The articles
+are only kept in memory, read them with refresher['articles'].
+"""
+
+import time
+import random
+import itertools
+import atexit
+import logging
+import threading
+import weakref
+
+import metrics
+
+JITTER = 0.1  # jobs run up to this fraction of the interval early
+BACKOFF = 5
+MAX_BACKOFF = 300
+
+SESSION_INTERVAL = 15 * 60  # GsxCache keeps the session for 20 minutes
+COMPTIA_INTERVAL = 6 * 60 * 60
+ARTICLES_INTERVAL = 30 * 60
+
+_order = itertools.count()
+_running = weakref.WeakSet()
+
+
+class Job(object):
+    def __init__(self, name, func, interval, jitter=JITTER):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.value = None
+        self.error = None
+        self.failures = 0
+        self.refreshed = None
+        self.next_run = 0
+        self.order = next(_order)
+        self.lock = threading.Lock()
+
+    def run(self):
+        """Calls the job, returns the delay until it should run again."""
+        with self.lock:
+            start = time.time()
+            try:
+                value = self.func()
+            except Exception as e:
+                self.failures += 1
+                self.error = e
+                metrics.incr('refresh.failed', job=self.name)
+                delay = min(BACKOFF * 2 ** (self.failures - 1), MAX_BACKOFF, self.interval)
+                logging.warning("Refreshing %s failed, retrying in %ds: %s" % (self.name, delay, e))
+                return delay * random.uniform(1, 1 + self.jitter)
+
+            metrics.timing('refresh', time.time() - start, job=self.name)
+            self.value = value
+            self.error = None
+            self.failures = 0
+            self.refreshed = time.time()
+            return self.interval * (1 - random.uniform(0, self.jitter))
+
+    def __repr__(self):
+        return '<Job %s>' % self.name
+
+
+class Refresher(object):
+    """
+    Runs jobs periodically on a background thread.
+    Jobs run one at a time, in the order they're due.
+    """
+    def __init__(self):
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._hooks = []
+
+    def register(self, name, func, interval, jitter=JITTER):
+        """Runs func every interval seconds, the first time right away."""
+        job = Job(name, func, interval, jitter)
+        with self._lock:
+            self.jobs[name] = job
+        self._wake.set()
+        return job
+
+    def unregister(self, name):
+        with self._lock:
+            del self.jobs[name]
+
+    def __getitem__(self, name):
+        """
+        Returns the last value of job name, None if it has never succeeded.
+        A stale value is returned as is.
+        """
+        return self.jobs[name].value
+
+    def _due(self):
+        with self._lock:
+            jobs = sorted(self.jobs.values(), key=lambda j: (j.next_run, j.order))
+        now = time.time()
+        return [j for j in jobs if j.next_run <= now], (jobs[0].next_run - now if jobs else None)
+
+    def run_pending(self):
+        """Runs the jobs that are due, returns the seconds until the next one."""
+        due, wait = self._due()
+
+        for job in due:
+            if self._stopped.is_set():
+                break
+            job.next_run = time.time() + job.run()
+
+        if due:
+            due, wait = self._due()
+
+        return wait
+
+    def run(self):
+        while not self._stopped.is_set():
+            self._wake.clear()
+            try:
+                wait = self.run_pending()
+            except Exception:
+                logging.exception("Refresher failed")
+                wait = BACKOFF
+            self._wake.wait(wait)
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self.run, name='gsxws-refresher')
+            self._thread.daemon = True
+            self._thread.start()
+            _running.add(self)
+        return self
+
+    def on_stop(self, hook):
+        """Calls hook() when the refresher is stopped, e.g. to log out."""
+        self._hooks.append(hook)
+        return hook
+
+    def stop(self, timeout=None):
+        """Stops the thread and runs the shutdown hooks."""
+        if self._stopped.is_set():
+            return
+
+        self._stopped.set()
+        self._wake.set()
+        _running.discard(self)
+
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+        for hook in self._hooks:
+            try:
+                hook()
+            except Exception:
+                logging.exception("Refresher shutdown hook %r failed" % hook)
+
+
+def reference_data(session=None, refresher=None):
+    """
+    Returns a refresher with CompTIA codes, the communication articles
+    and, if given, session renewal registered.
+    """
+    from comptia import CompTIA
+    from comms import fetch
+
+    refresher = refresher or Refresher()
+
+    if session is not None:
+        refresher.register('session', lambda: session.login(refresh=True), SESSION_INTERVAL)
+
+    refresher.register('comptia', lambda: CompTIA().fetch(refresh=True), COMPTIA_INTERVAL)
+    refresher.register('articles', fetch, ARTICLES_INTERVAL)
+
+    return refresher
+
+
+@atexit.register
+def _stop_all():
+    for refresher in list(_running):
+        refresher.stop()
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Tracing hooks for GSX calls.
+
+High-level methods such as Product.warranty() open a parent span and every
+SOAP call made underneath it gets a child span with the operation, region,
+environment, payload sizes and fault code as attributes. Nothing is
+recorded until a tracer is set:
+
+    >>> import tracing
+    >>> tracing.use_opentelemetry()       # any OpenTelemetry SDK setup
+    >>> tracer = tracing.set_tracer(tracing.InMemoryTracer())
+
+A tracer is anything with an OpenTelemetry-style start_as_current_span().
+"""
+
+import time
+import threading
+import functools
+from contextlib import contextmanager
+
+_tracer = None
+
+
+class NoopSpan(object):
+    def set_attribute(self, key, value):
+        pass
+
+    def record_exception(self, exception):
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+
+
+def set_tracer(tracer):
+    """Sets the tracer used for all GSX spans, None disables tracing."""
+    global _tracer
+    _tracer = tracer
+    return tracer
+
+
+def get_tracer():
+    return _tracer
+
+
+def use_opentelemetry(name='gsxws'):
+    """Traces with the globally configured OpenTelemetry tracer provider."""
+    from opentelemetry import trace
+    return set_tracer(trace.get_tracer(name))
+
+
+@contextmanager
+def span(name, **attributes):
+    """Opens a span as a child of the current one."""
+    tracer = _tracer
+
+    if tracer is None:
+        yield NOOP_SPAN
+        return
+
+    with tracer.start_as_current_span(name) as s:
+        for k, v in attributes.items():
+            s.set_attribute(k, v)
+        yield s
+
+
+def traced(name):
+    """Decorator that runs the function inside a span called name."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class RecordedSpan(object):
+    def __init__(self, name, parent):
+        self.name = name
+        self.parent = parent
+        self.attributes = {}
+        self.exception = None
+        self.start = time.time()
+        self.end = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def record_exception(self, exception):
+        self.exception = exception
+
+    @property
+    def duration(self):
+        return (self.end or time.time()) - self.start
+
+    def __repr__(self):
+        return '<RecordedSpan %s>' % self.name
+
+
+class InMemoryTracer(object):
+    """
+    Keeps finished spans in memory, mostly for tests.
+    Spans are nested per thread.
+    """
+    def __init__(self):
+        self.spans = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def start_as_current_span(self, name):
+        stack = self._stack()
+        s = RecordedSpan(name, stack[-1] if stack else None)
+        stack.append(s)
+
+        try:
+            yield s
+        except Exception as e:
+            s.record_exception(e)
+            raise
+        finally:
+            stack.pop()
+            s.end = time.time()
+            with self._lock:
+                self.spans.append(s)
+
+    def find(self, name):
+        return [s for s in self.spans if s.name == name]
+
+    def clear(self):
+        with self._lock:
+            self.spans = []
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the envelope build -> send -> parse -> objectify path.
+
+Each stage is timed in isolation against the fixtures, and end to end
+against the local GSX stand-in. Package import time is measured in fresh
+interpreters, both for a bare "import gsxws" and with every submodule
+loaded. Results can be saved as JSON and compared with an earlier run:
+
+    $ python -m tests.benchmark --save before.json
+    $ python -m tests.benchmark --compare before.json --threshold 0.1
+
+--quick times a single call of each benchmark, to check that they run.
+"""
+
+import os
+import sys
+import json
+import glob
+import timeit
+import platform
+import subprocess
+import xml.etree.ElementTree as ET
+
+from gsxws import core, objectify, repairs
+from gsxws.products import Product
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORTS = [
+    ('import.package', 'import gsxws'),
+    ('import.core', 'import gsxws.core'),
+    ('import.all', 'import gsxws; gsxws.__all__'),
+]
+
+
+def fixture(name):
+    return open(os.path.join(FIXTURES, name), 'rb').read()
+
+
+def make_repair():
+    rep = repairs.CarryInRepair(serialNumber='DGKFL06JDHJP',
+                                unitReceivedDate='01/01/14',
+                                shipTo='677592', poNumber='123456',
+                                symptom='Does not power on',
+                                diagnosis='Replaced logic board')
+    rep.customerAddress = repairs.Customer(firstName='First', lastName='Last',
+                                           emailAddress='test@example.com')
+    rep.orderLines = [repairs.RepairOrderLine(partNumber='661-5571',
+                                              comptiaCode='X01',
+                                              comptiaModifier='A')]
+    return rep
+
+
+def read_all(el):
+    for c in el.iterchildren():
+        getattr(el, c.tag)
+
+
+def walk(el):
+    """Builds a dict by walking every attribute, what to_dict() replaces."""
+    result = {}
+    for c in el.iterchildren():
+        value = getattr(el, c.tag)
+        if isinstance(value, objectify.GsxElement):
+            value = walk(value)
+        result[c.tag] = value
+    return result
+
+
+def benchmarks():
+    """Returns a list of (name, callable) pairs to time."""
+    session = ET.Element('userSession')
+    ET.SubElement(session, 'userSessionId').text = 'benchmark'
+    core.GSX_SESSION = session
+
+    repair = make_repair()
+    wty = objectify.parse(os.path.join(FIXTURES, 'warranty_status.xml'), 'warrantyDetailInfo')
+    parts = objectify.parse(os.path.join(FIXTURES, 'parts_lookup.xml'), 'parts')
+    multierror = fixture('multierror.xml')
+
+    result = [
+        ('object.construct', make_repair),
+        ('object.to_xml', lambda: repair.to_xml('repairData')),
+        ('request.envelope', lambda: core.GsxRequest(repairData=repair)._envelope('CreateCarryIn')),
+        ('element.warranty', lambda: read_all(wty)),
+        ('element.parts', lambda: [read_all(p) for p in parts]),
+        ('convert.walk.warranty', lambda: walk(wty)),
+        ('convert.to_dict.warranty', lambda: objectify.to_dict(wty)),
+        ('convert.walk.parts', lambda: [walk(p) for p in parts]),
+        ('convert.to_dict.parts', lambda: [objectify.to_dict(p) for p in parts]),
+        ('convert.to_json.warranty', lambda: objectify.to_json(wty)),
+        ('validate', lambda: [core.validate(v) for v in ('661-5571', 'G135773004',
+                                                         'DGKFL06JDHJP', '013348005376007')]),
+        ('error.parse', lambda: core.GsxError(xml=multierror).errors),
+    ]
+
+    for path in sorted(glob.glob(os.path.join(FIXTURES, '*.xml'))):
+        xml = open(path, 'rb').read()
+        name = os.path.basename(path)[:-4]
+        result.append(('parse.%s' % name, lambda xml=xml: objectify.parse(xml, '*')))
+
+    return result
+
+
+def end_to_end():
+    """Returns (name, callable) pairs that go through the local stand-in."""
+    from tests.server import GsxStubServer
+    server = GsxStubServer().start()
+    server.configure()
+    core.connect('benchmark', '123456')
+    return server, [
+        ('e2e.warranty', lambda: Product('DGKFL06JDHJP').warranty()),
+        ('e2e.parts', lambda: Product('DGKFL06JDHJP').parts()),
+        ('e2e.repairs', lambda: Product('DGKFL06JDHJP').repairs()),
+    ]
+
+
+def import_time(statement, repeat=5):
+    """Times statement in a fresh interpreter, returns the same as measure()."""
+    code = ("import time; t = time.time(); %s; "
+            "print(repr(time.time() - t))" % statement)
+    times = [float(subprocess.check_output([sys.executable, '-c', code], cwd=ROOT))
+             for i in range(repeat)]
+    return {'min': min(times), 'mean': sum(times) / len(times), 'number': 1}
+
+
+def measure(func, repeat=5, seconds=0.2):
+    """Returns the best and mean time per call of func in seconds."""
+    timer = timeit.Timer(func)
+    number, elapsed = 1, timer.timeit(1)
+
+    while elapsed * number < seconds and number < 100000:
+        number *= 10
+
+    times = [t / number for t in timer.repeat(repeat, number)]
+    return {'min': min(times), 'mean': sum(times) / len(times), 'number': number}
+
+
+def run(names=None, e2e=True, quick=False):
+    results = {}
+    repeat, seconds = (1, 0) if quick else (5, 0.2)
+    server = None
+    todo = benchmarks()
+
+    if e2e:
+        server, calls = end_to_end()
+        todo += calls
+
+    todo += [(name, statement) for name, statement in IMPORTS]
+
+    try:
+        for name, func in todo:
+            if names and not any(name.startswith(n) for n in names):
+                continue
+            if isinstance(func, basestring):
+                results[name] = import_time(func, repeat)
+            else:
+                results[name] = measure(func, repeat, seconds)
+            print('%-40s %10.1f us' % (name, results[name]['min'] * 1e6))
+    finally:
+        if server:
+            server.stop()
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Returns the benchmarks that got slower than baseline by more than threshold."""
+    slower = []
+
+    for name, r in sorted(results.items()):
+        if name not in baseline:
+            continue
+        change = r['min'] / baseline[name]['min'] - 1
+        print('%-40s %+7.1f%%' % (name, change * 100))
+        if change > threshold:
+            slower.append((name, change))
+
+    return slower
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark py-gsxws")
+    parser.add_argument("names", nargs="*", help="only run benchmarks starting with these")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare with the results in this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="fail if a benchmark is this much slower (default 0.1)")
+    parser.add_argument("--no-e2e", action="store_true", help="skip the end to end benchmarks")
+    parser.add_argument("--quick", action="store_true", help="time a single call of each")
+
+    args = parser.parse_args()
+    results = run(args.names, not args.no_e2e, args.quick)
+    meta = {'version': core.VERSION, 'python': platform.python_version()}
+
+    if args.save:
+        json.dump({'meta': meta, 'results': results}, open(args.save, 'w'), indent=2)
+
+    if args.compare:
+        baseline = json.load(open(args.compare))['results']
+        slower = compare(results, baseline, args.threshold)
+        for name, change in slower:
+            print('REGRESSION %s: %+.1f%%' % (name, change * 100))
+        sys.exit(1 if slower else 0)
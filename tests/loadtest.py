@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Load generator for the GSX client.
+
+Drives warranty lookups, repair lookups or repair creation from a number
+of threads against GSX or the local stand-in and reports throughput,
+latency percentiles, errors and the client CPU time spent per call:
+
+    $ python -m tests.loadtest warranty --threads 16 --duration 30 --stub --latency 0.2
+    $ python -m tests.loadtest repairs --threads 4 --user me@example.com --sold-to 123456
+
+With --stub the stand-in runs in the same process, so its CPU time
+is included in the per-call figure. The create scenario opens real
+repairs, so it only runs with --stub unless --allow-writes is given.
+"""
+
+import os
+import time
+import logging
+import threading
+
+from gsxws import core, repairs
+from gsxws.lookups import Lookup
+from gsxws.products import Product
+
+
+def create_repair(sn):
+    rep = repairs.CarryInRepair(serialNumber=sn, shipTo=os.getenv('GSX_SHIPTO', '677592'),
+                                poNumber='123456', symptom='Load test',
+                                diagnosis='Load test')
+    rep.customerAddress = repairs.Customer(firstName='Load', lastName='Test',
+                                           emailAddress='test@example.com')
+    rep.orderLines = [repairs.RepairOrderLine(partNumber='661-5571',
+                                              comptiaCode='X01', comptiaModifier='A')]
+    return rep.create()
+
+
+SCENARIOS = {
+    'warranty': lambda sn: Product(sn).warranty(),
+    'repairs': lambda sn: Lookup(serialNumber=sn).repairs(),
+    'create': create_repair,
+}
+
+# scenarios that change data in GSX
+WRITES = ('create',)
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of a sorted list.
+
+    >>> percentile(range(1, 101), 95)
+    95
+    """
+    if not values:
+        return 0
+    k = max(int(round(p / 100.0 * len(values))) - 1, 0)
+    return values[min(k, len(values) - 1)]
+
+
+class LoadTest(object):
+    def __init__(self, scenario, sn, threads=4, duration=10, requests=None,
+                 allow_writes=False):
+        if scenario in WRITES and not allow_writes:
+            raise ValueError("The %s scenario changes data in GSX" % scenario)
+        self.call = SCENARIOS[scenario]
+        self.sn = sn
+        self.threads = threads
+        self.duration = duration
+        self.requests = requests
+        self.samples = []  # (latency, error code or None)
+        self._lock = threading.Lock()
+        self._sent = 0
+
+    def _next(self):
+        with self._lock:
+            if self.requests is not None and self._sent >= self.requests:
+                return False
+            self._sent += 1
+            return True
+
+    def _work(self, deadline):
+        while time.time() < deadline and self._next():
+            start = time.time()
+            try:
+                self.call(self.sn)
+                error = None
+            except core.GsxError as e:
+                error = e.code
+            except Exception as e:
+                # count anything else too instead of losing the worker
+                error = e.__class__.__name__
+            self.samples.append((time.time() - start, error))
+
+    def run(self):
+        cpu = sum(os.times()[:2])
+        start = time.time()
+        deadline = start + self.duration
+        workers = [threading.Thread(target=self._work, args=(deadline,))
+                   for i in range(self.threads)]
+
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+        self.elapsed = time.time() - start
+        self.cpu = sum(os.times()[:2]) - cpu
+        return self.report()
+
+    def report(self):
+        calls = len(self.samples)
+        latencies = sorted(s[0] for s in self.samples)
+        errors = {}
+
+        for latency, code in self.samples:
+            if code is not None:
+                errors[code] = errors.get(code, 0) + 1
+
+        return {
+            'calls': calls,
+            'threads': self.threads,
+            'throughput': calls / self.elapsed if self.elapsed else 0,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'max': latencies[-1] if latencies else 0,
+            'error_rate': sum(errors.values()) / float(calls) if calls else 0,
+            'errors': errors,
+            'cpu_per_call': self.cpu / calls if calls else 0,
+        }
+
+
+def print_report(r):
+    print('%(calls)d calls from %(threads)d threads, %(throughput).1f calls/s' % r)
+    print('latency p50 %.1f ms, p95 %.1f ms, p99 %.1f ms, max %.1f ms' % tuple(
+        r[k] * 1000 for k in ('p50', 'p95', 'p99', 'max')))
+    print('client CPU %.2f ms per call' % (r['cpu_per_call'] * 1000))
+    print('error rate %.2f%%' % (r['error_rate'] * 100))
+    for code, count in sorted(r['errors'].items()):
+        print('  %s: %d' % (code, count))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Load test the GSX client")
+    parser.add_argument("scenario", choices=sorted(SCENARIOS))
+    parser.add_argument("--sn", default=os.getenv('GSX_SN', 'DGKFL06JDHJP'))
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run")
+    parser.add_argument("--requests", type=int, help="stop after this many calls")
+    parser.add_argument("--user", default=os.getenv('GSX_USER'))
+    parser.add_argument("--sold-to", default=os.getenv('GSX_SOLDTO'))
+    parser.add_argument("--environment", default=os.getenv('GSX_ENV', core.GSX_ENV))
+    parser.add_argument("--region", default=core.GSX_REGION)
+    parser.add_argument("--url", help="GSX URL template, e.g. http://host:port/{env}/{region}")
+    parser.add_argument("--stub", action="store_true", help="run against the local stand-in")
+    parser.add_argument("--allow-writes", action="store_true",
+                        help="allow scenarios that create repairs without --stub")
+    parser.add_argument("--latency", type=float, default=0, help="stand-in latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0, help="stand-in fault rate")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.scenario in WRITES and not (args.stub or args.allow_writes):
+        parser.error("the %s scenario creates real repairs, "
+                     "use --stub or --allow-writes" % args.scenario)
+
+    server = None
+
+    if args.stub:
+        from tests.server import GsxStubServer
+        server = GsxStubServer(latency=args.latency, error_rate=args.error_rate).start()
+        server.configure()
+        args.user, args.sold_to = args.user or 'loadtest', args.sold_to or '123456'
+    elif args.url:
+        core.GSX_URL = args.url
+
+    core.connect(args.user, args.sold_to, environment=args.environment, region=args.region)
+
+    try:
+        test = LoadTest(args.scenario, args.sn, args.threads, args.duration, args.requests,
+                        allow_writes=True)
+        print_report(test.run())
+    finally:
+        if server:
+            server.stop()
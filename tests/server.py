@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+A stand-in for the GSX Web Services endpoint.
+
+Routes requests on their SOAPAction and answers with recorded responses,
+the XML fixtures or the JSON fixtures (wrapped in a SOAP envelope).
+Latency, faults and throughput can be configured to exercise the client's
+concurrency, error handling and caching without a connection to Apple.
+
+    >>> from gsxws import connect, Product
+    >>> server = GsxStubServer(latency=0.05, error_rate=0.01).start()
+    >>> server.configure()
+    >>> connect('user', 'soldto')
+    >>> Product('DGKFL06JDHJP').warranty().warrantyStatus
+    u'Apple Limited Warranty'
+    >>> server.stop()
+"""
+
+import os
+import re
+import zlib
+import json
+import time
+import random
+import socket
+import hashlib
+import logging
+import threading
+import collections
+import xml.etree.ElementTree as ET
+
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+# SOAPAction -> (fixture, response element for JSON fixtures)
+METHODS = {
+    'WarrantyStatus':                   ('warranty_status.xml', None),
+    'PartsLookup':                      ('parts_lookup.xml', None),
+    'FetchIOSActivationDetails':        ('ios_activation.xml', None),
+    'FetchIOSDiagnostic':               ('ios_diagnostics.xml', None),
+    'RepairDetails':                    ('repair_details_ca.xml', None),
+    'GeneralEscalationDetailsLookup':   ('escalation_details_lookup.xml', None),
+    'OnsiteDispatchDetail':             ('onsite_dispatch_detail.xml', None),
+    'RepairLookup':                     ('repair_lookup.json', 'lookupResponseData'),
+    'CreateCarryIn':                    ('create_carryin_repair.json', 'repairConfirmation'),
+    'UpdateCarryIn':                    ('update_carryin_repair.json', 'repairConfirmation'),
+    'CreateWholeUnitExchange':          ('create_whole_unit_exchange.json', 'repairConfirmation'),
+    'CreateStockingOrder':              ('create_stocking_order.json', 'orderConfirmation'),
+    'FetchCommunicationArticles':       ('fetch_communication_articles.json', 'communicationMessage'),
+    'FetchCommunicationContent':        ('fetch_communication_content.json', 'communicationMessage'),
+}
+
+ENVELOPE = """<?xml version='1.0' encoding='UTF-8'?>
+<S:Envelope xmlns:S="http://schemas.xmlsoap.org/soap/envelope/">
+<S:Body>
+<ns2:{method}Response xmlns:ns2="http://gsxws.apple.com/elements/global">
+<{method}Response>
+<operationId>{operation}</operationId>
+{body}
+</{method}Response>
+</ns2:{method}Response>
+</S:Body>
+</S:Envelope>"""
+
+FAULT = """<?xml version='1.0' encoding='UTF-8'?>
+<S:Envelope xmlns:S="http://schemas.xmlsoap.org/soap/envelope/">
+<S:Body>
+<S:Fault>
+<faultcode>{code}</faultcode>
+<faultstring>{message}</faultstring>
+</S:Fault>
+</S:Body>
+</S:Envelope>"""
+
+
+def to_xml(tag, value):
+    """
+    Converts JSON fixture data into XML elements.
+
+    >>> ET.tostring(to_xml('a', {'b': ['1', '2']}))
+    '<a><b>1</b><b>2</b></a>'
+    """
+    el = ET.Element(tag)
+
+    if isinstance(value, dict):
+        for k, v in sorted(value.items()):
+            for i in (v if isinstance(v, list) else [v]):
+                el.append(to_xml(k, i))
+    else:
+        el.text = unicode(value)
+
+    return el
+
+
+class Throttle(object):
+    """Token bucket limiting the requests served per second."""
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        time.sleep(delay)
+
+
+class GsxRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        method = self.headers.getheader('soapaction', '').strip('"')
+        compressed = self.headers.getheader('content-encoding') == 'gzip'
+
+        if compressed:
+            if server.reject_compressed:
+                server.count(method, 415)
+                return self.reply(415, 'Compressed requests not supported')
+            body = zlib.decompress(body, zlib.MAX_WBITS | 16)
+
+        server.received.append((method, compressed))
+
+        if server.throttle:
+            server.throttle.wait()
+
+        latency = server.latency
+        if isinstance(latency, tuple):
+            latency = random.uniform(*latency)
+        time.sleep(latency)
+
+        status, response = server.respond(method, body)
+        server.count(method, status)
+        self.reply(status, response)
+
+    def do_GET(self):
+        """Serves the images with ETag revalidation."""
+        server = self.server
+        time.sleep(server.latency if not isinstance(server.latency, tuple) else server.latency[0])
+        data = server.images.get(self.path)
+
+        if data is None:
+            status = 404
+        else:
+            etag = '"%s"' % hashlib.md5(data).hexdigest()
+            status = 304 if self.headers.getheader('if-none-match') == etag else 200
+
+        server.count('GET', status)
+        self.send_response(status)
+
+        if data is not None:
+            self.send_header('ETag', etag)
+        if status == 200:
+            self.send_header('Content-Type', 'image/gif')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    def reply(self, status, response):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+
+        if self.server.compress and 'gzip' in self.headers.getheader('accept-encoding', ''):
+            c = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+            response = c.compress(response) + c.flush()
+            self.send_header('Content-Encoding', 'gzip')
+
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+
+        if self.server.stall:
+            half = len(response) // 2
+            self.wfile.write(response[:half])
+            self.wfile.flush()
+            time.sleep(self.server.stall)
+            response = response[half:]
+
+        try:
+            self.wfile.write(response)
+        except socket.error:
+            pass  # the client gave up on a stalled response
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+class GsxStubServer(ThreadingMixIn, HTTPServer):
+    """
+    Fake GSX endpoint listening on localhost.
+
+    latency     -- seconds to wait before answering, or a (min, max) tuple
+    error_rate  -- probability of answering any request with a SOAP fault
+    errors      -- dict of SOAPAction -> fault code to always fail with
+    max_rps     -- limit of requests answered per second
+    sessions    -- directory of recorded responses saved as <SOAPAction>.xml,
+                   these take precedence over the fixtures
+    compress    -- gzip the responses to clients that accept it
+    reject_compressed -- answer compressed requests with 415
+    images      -- dict of path -> image data served to GET requests
+    stall       -- seconds to stop for halfway through each response body
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, fixtures=FIXTURES, sessions=None, latency=0,
+                 error_rate=0, errors=None, max_rps=None, compress=False,
+                 reject_compressed=False, images=None, stall=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), GsxRequestHandler)
+        self.fixtures = fixtures
+        self.sessions = sessions
+        self.latency = latency
+        self.error_rate = error_rate
+        self.errors = errors or {}
+        self.throttle = Throttle(max_rps) if max_rps else None
+        self.compress = compress
+        self.images = images or {}
+        self.reject_compressed = reject_compressed
+        self.stall = stall
+        self.received = collections.deque(maxlen=1000)  # (SOAPAction, compressed)
+        self.stats = {}
+        self._lock = threading.Lock()
+        self._counter = 0
+        self._thread = None
+
+    def image_url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.server_port, path)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/gsx-ws{env}/services/{region}/asp' % self.server_port
+
+    def configure(self):
+        """Points the gsxws client at this server."""
+        from gsxws import core
+        core.GSX_URL = self.url
+        # requests insists on the certificate files existing
+        os.environ.setdefault('GSX_CERT', os.devnull)
+        os.environ.setdefault('GSX_KEY', os.devnull)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def count(self, method, status):
+        with self._lock:
+            self.stats.setdefault(method, {}).setdefault(status, 0)
+            self.stats[method][status] += 1
+
+    def operation_id(self):
+        with self._lock:
+            self._counter += 1
+            return self._counter
+
+    def fault(self, code, message):
+        return 500, FAULT.format(code=code, message=message)
+
+    def envelope(self, method, body):
+        return ENVELOPE.format(method=method, body=body, operation=self.operation_id())
+
+    def respond(self, method, body):
+        """Returns the HTTP status and response body for a SOAPAction."""
+        if method in self.errors:
+            return self.fault(self.errors[method], 'Injected fault for %s' % method)
+
+        if random.random() < self.error_rate:
+            return self.fault('STUB.ERR.001', 'Injected random fault')
+
+        if method == 'Authenticate':
+            return 200, self.envelope(method, '<userSessionId>stub</userSessionId>')
+
+        if self.sessions:
+            path = os.path.join(self.sessions, '%s.xml' % method)
+            if os.path.exists(path):
+                return 200, open(path, 'rb').read()
+
+        fixture, element = METHODS.get(method, (None, None))
+
+        if fixture is None:
+            # Try the fixture naming convention: WarrantyStatus -> warranty_status
+            name = re.sub(r'(?<!^)([A-Z])', r'_\1', method).lower()
+            for ext in ('.xml', '.json',):
+                if os.path.exists(os.path.join(self.fixtures, name + ext)):
+                    fixture = name + ext
+
+        if fixture is None:
+            return self.fault('STUB.NOT.FOUND', 'No fixture for %s' % method)
+
+        path = os.path.join(self.fixtures, fixture)
+
+        if fixture.endswith('.xml'):
+            return 200, open(path, 'rb').read()
+
+        data = json.load(open(path))
+        if element == 'repairConfirmation':
+            data['confirmationNumber'] = 'G%09d' % self.operation_id()
+
+        el = to_xml(element or method[0].lower() + method[1:] + 'ResponseData', data)
+        return 200, self.envelope(method, ET.tostring(el))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run a stand-in GSX endpoint")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--fixtures", default=FIXTURES)
+    parser.add_argument("--sessions", default=None)
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--max-rps", type=float, default=None)
+    parser.add_argument("--compress", action="store_true")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG)
+    server = GsxStubServer(**vars(args))
+    print(server.url)
+    server.serve_forever()
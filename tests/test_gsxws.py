@@ -43,6 +43,84 @@ class CommsTestCase(TestCase):
         self.assertEqual(result.acknowledgeType, 'UNREAD')
 
 
+class CommsSyncTestCase(TestCase):
+    def setUp(self):
+        import tempfile
+        self.fetch = comms.fetch
+        self.content = comms.content
+        self.acknowledge = comms.Communication.acknowledge
+        self.fetched = []
+        self.acked = []
+        comms.fetch = self.fake_fetch
+        comms.content = self.fake_content
+        comms.Communication.acknowledge = lambda c: self.acked.append(c.acknowledgement)
+        self.dir = tempfile.mkdtemp()
+        self.sync = comms.CommsSync(os.path.join(self.dir, 'comms'), batch_size=2)
+
+    def tearDown(self):
+        import shutil
+        comms.fetch = self.fetch
+        comms.content = self.content
+        comms.Communication.acknowledge = self.acknowledge
+        self.sync.shelf.close()
+        shutil.rmtree(self.dir)
+
+    def fake_fetch(self, **kwargs):
+        xml = '<Body><Response>%s</Response></Body>' % ''.join(
+            '<communicationMessage><articleID>SN%d</articleID></communicationMessage>' % i
+            for i in range(3))
+        return parse(xml, 'communicationMessage')
+
+    def fake_content(self, id):
+        self.fetched.append(id)
+        xml = '<Body><Response><communicationMessage><languageCode>en</languageCode>'\
+              '</communicationMessage></Response></Body>'
+        return parse(xml, 'communicationMessage')
+
+    def test_sync(self):
+        self.assertEqual(sorted(self.sync.sync()), ['SN0', 'SN1', 'SN2'])
+        self.assertEqual(self.sync.sync(), [])
+        self.assertEqual(len(self.fetched), 3)
+        self.assertEqual(self.sync['SN1']['content']['languageCode'], 'en')
+
+    def test_no_articles(self):
+        from gsxws.core import GsxEmptyResult
+
+        def fetch(**kwargs):
+            raise GsxEmptyResult()
+
+        comms.fetch = fetch
+        self.assertEqual(self.sync.sync(), [])
+
+    def test_ack(self):
+        self.sync.ack('SN0', 'READ')
+        self.assertEqual(self.acked, [])
+        self.sync.ack('SN1', 'READ')
+        self.sync.ack('SN2', 'READ')
+        self.sync.flush()
+        self.assertEqual([len(a) for a in self.acked], [2, 1])
+
+    def test_ack_failed(self):
+        from gsxws.core import GsxError
+
+        def acknowledge(c):
+            self.acked.append(c.acknowledgement)
+            if len(self.acked) == 1:
+                raise GsxError('Service unavailable')
+
+        comms.Communication.acknowledge = acknowledge
+        self.sync.batch_size = 10
+        for i in range(5):
+            self.sync.ack('SN%d' % i, 'READ')
+        self.sync.batch_size = 2
+        self.assertRaises(GsxError, self.sync.flush)
+        self.assertEqual([len(a) for a in self.acked], [2, 2, 1])
+        self.sync.flush()
+        self.assertEqual([a.articleID for a in self.acked[3]], ['SN0', 'SN1'])
+        self.sync.flush()
+        self.assertEqual(len(self.acked), 4)
+
+
 class RemoteTestCase(TestCase):
     def setUp(self):
         from gsxws.core import connect
@@ -167,6 +245,373 @@ class CoreFunctionTestCase(TestCase):
         c = GsxCache('test').set('spam', 'eggs')
         self.assertEquals(c.get('spam'), 'eggs')
 
+    def test_cache_shared(self):
+        GsxCache('test').set('spam', 'eggs')
+        c = GsxCache('test').set('spam', 'ham' * 1000)  # still open
+        self.assertEqual(GsxCache('test').get('spam'), 'ham' * 1000)
+
+
+class TestBatchFunctions(TestCase):
+    def setUp(self):
+        self.calls = []
+
+    def submit(self, numbers):
+        self.calls.append(numbers)
+        if 'G000000000' in numbers:
+            error = GsxError('Invalid repair confirmation number')
+            error.codes.append('RPR.STA.001')
+            raise error
+        return dict((n, 'Closed') for n in numbers if n != 'G999999999')
+
+    def test_chunked(self):
+        from gsxws.core import chunked
+        self.assertEqual(list(chunked(iter(range(5)), 2)), [[0, 1], [2, 3], [4]])
+
+    def test_pmap_errors(self):
+        from gsxws.core import pmap
+
+        def items():
+            yield 1
+            raise ValueError('Broken input')
+
+        with self.assertRaises(ValueError):
+            list(pmap(lambda i: i, items()))
+
+    def test_batches(self):
+        numbers = ['G%09d' % i for i in range(1, 121)]
+        result = dict(repairs._submit_batches(self.submit, numbers, 50))
+        self.assertEqual(len(self.calls), 3)
+        self.assertEqual(len(result), 120)
+        self.assertEqual(result['G000000120'], 'Closed')
+
+    def test_isolate_errors(self):
+        numbers = ['G135773004', 'G000000000', 'G999999999', 'G135762375']
+        result = dict(repairs._submit_batches(self.submit, numbers, 50))
+        self.assertIsInstance(result['G000000000'], GsxError)
+        self.assertIsInstance(result['G999999999'], GsxError)
+        self.assertEqual(result['G135773004'], 'Closed')
+        self.assertEqual(result['G135762375'], 'Closed')
+
+    def test_connection_errors(self):
+        from gsxws.core import GsxCircuitOpen
+        numbers = ['G%09d' % i for i in range(1, 51)]
+
+        for error in (GsxError('GSX connection failed'), GsxCircuitOpen('stub', None)):
+            def submit(numbers):
+                self.calls.append(numbers)
+                raise error
+
+            self.calls = []
+            result = dict(repairs._submit_batches(submit, numbers, 50))
+            self.assertEqual(len(self.calls), 1)
+            self.assertTrue(all(r is error for r in result.values()))
+
+    def test_complete_invalid(self):
+        result = dict(repairs.mark_complete_many(['blaa', None]))
+        self.assertIsInstance(result['blaa'], ValueError)
+        self.assertIsInstance(result[None], ValueError)
+
+    def test_list_xml(self):
+        rep = repairs.Repair(repairConfirmationNumbers=['G135773004', 'G135762375'])
+        self.assertEqual(rep.dumps().count('<repairConfirmationNumbers>'), 2)
+
+
+class TestRepairSync(TestCase):
+    def setUp(self):
+        import tempfile
+        from datetime import timedelta
+        self.limit = repairs.REPAIR_LOOKUP_LIMIT
+        repairs.REPAIR_LOOKUP_LIMIT = 3
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'repairs')
+        self.sync = repairs.RepairSync(self.path, start=date(2014, 1, 1),
+                                       window=timedelta(days=8))
+        self.sync._lookup = self.lookup
+        self.status = 'Open'
+        self.windows = []
+
+    def tearDown(self):
+        import shutil
+        repairs.REPAIR_LOOKUP_LIMIT = self.limit
+        self.sync.close()
+        shutil.rmtree(self.dir)
+
+    def lookup(self, window):
+        # One repair per day
+        self.windows.append(window)
+        days = (window[1] - window[0]).days + 1
+        xml = '<Body><Response><lookupResponseData>%s</lookupResponseData></Response></Body>'
+        lines = ['<repairConfirmationNumber>G%09d</repairConfirmationNumber>'
+                 '<repairStatus>%s</repairStatus>' % (window[0].day + i, self.status)
+                 for i in range(days)]
+        return parse(xml % '</lookupResponseData><lookupResponseData>'.join(lines),
+                     'lookupResponseData')
+
+    def test_split_windows(self):
+        events = self.sync.sync(until=date(2014, 1, 8))
+        self.assertEqual(len(events), 8)
+        self.assertEqual(events[0][0], repairs.EVENT_NEW)
+        self.assertTrue(all((w[1] - w[0]).days < 2 for w in self.windows[-4:]))
+        self.assertEqual(self.sync.high_water_mark, date(2014, 1, 8))
+
+    def test_closed(self):
+        self.sync.sync(until=date(2014, 1, 1))
+        self.sync.refresh = lambda events: None
+        self.status = 'Closed and Completed'
+        events = self.sync.sync(until=date(2014, 1, 1))
+        self.assertEqual(events[0][0], repairs.EVENT_CLOSED)
+
+    def test_empty_window(self):
+        from gsxws.core import GsxEmptyResult
+
+        def empty(lookup, method):
+            raise GsxEmptyResult()
+
+        del self.sync._lookup
+        lookup, lookups.Lookup.lookup = lookups.Lookup.lookup, empty
+        try:
+            events = self.sync.sync(until=date(2014, 1, 8))
+        finally:
+            lookups.Lookup.lookup = lookup
+        self.assertEqual(events, [])
+        self.assertEqual(self.sync.errors, [])
+        self.assertEqual(self.sync.high_water_mark, date(2014, 1, 8))
+
+
+class TestBulkReturn(TestCase):
+    def setUp(self):
+        self.register_parts = returns.Return.register_parts
+        self.calls = []
+        returns.Return.register_parts = lambda ret, parts: self.fake_register(ret, parts)
+
+    def tearDown(self):
+        returns.Return.register_parts = self.register_parts
+
+    def fake_register(self, ret, parts):
+        if ret.shipToCode == '0':
+            raise GsxError('Invalid ship-to')
+        if any(p.partNumber == '661-0000' for p in parts):
+            error = GsxError('Invalid part number')
+            error.codes.append('RTN.BLK.001')
+            raise error
+        self.calls.append((ret.shipToCode, len(parts)))
+        return 'BR%d' % len(self.calls)
+
+    def test_register(self):
+        parts = [{'returnOrderNumber': '74446400%02d' % i, 'partNumber': '661-6028'}
+                 for i in range(5)]
+        parts.append({'returnOrderNumber': '7444640099', 'partNumber': '661-6028',
+                      'shipTo': '0'})
+        result = dict(returns.register_bulk(parts, {'shipToCode': 677592}, size=2))
+        self.assertEqual(sorted(self.calls), [('677592', 1), ('677592', 2), ('677592', 2)])
+        self.assertIsInstance(result[('7444640099', '661-6028')], GsxError)
+        self.assertTrue(result[('7444640000', '661-6028')].startswith('BR'))
+
+    def test_register_isolate(self):
+        parts = [{'returnOrderNumber': '74446400%02d' % i, 'partNumber': '661-6028'}
+                 for i in range(4)]
+        parts.append({'returnOrderNumber': '7444640099', 'partNumber': '661-0000'})
+        result = dict(returns.register_bulk(parts, {'shipToCode': 677592}))
+        self.assertIsInstance(result[('7444640099', '661-0000')], GsxError)
+        self.assertEqual(len([r for r in result.values() if isinstance(r, GsxError)]), 1)
+        self.assertEqual(sum(n for s, n in self.calls), 4)
+
+    def test_register_no_ship_to(self):
+        parts = [{'returnOrderNumber': '7444640000', 'partNumber': '661-6028'}]
+        with self.assertRaises(ValueError):
+            list(returns.register_bulk(parts, {'carrierCode': 'XUPSN'}))
+        self.assertEqual(self.calls, [])
+
+
+class TestReturnLabels(TestCase):
+    def setUp(self):
+        import tempfile
+        self.dir = tempfile.mkdtemp()
+        self.save_label = returns.Return.save_label
+        returns.Return.save_label = lambda r, part, path: open(path, 'w').close() or path
+
+    def tearDown(self):
+        import shutil
+        returns.Return.save_label = self.save_label
+        shutil.rmtree(self.dir)
+
+    def test_stream(self):
+        import base64
+        from StringIO import StringIO
+        from gsxws.objectify import stream_attachments
+        data = os.urandom(10000)
+        xml = '<S:Envelope xmlns:S="s"><S:Body><returnLabelData>'\
+              '<returnLabelFileData>%s</returnLabelFileData>'\
+              '</returnLabelData></S:Body></S:Envelope>' % base64.encodestring(data)
+        fp = StringIO()
+        chunks = [xml[i:i + 333] for i in range(0, len(xml), 333)]
+        result = stream_attachments(chunks, {'returnLabelFileData': fp})
+        self.assertIn('returnLabelFileData', result.found)
+        self.assertEqual(fp.getvalue(), data)
+
+    def test_resume(self):
+        open(os.path.join(self.dir, '7438971408_NF661-5769.pdf'), 'w').close()
+        labels = [('7438971408', 'NF661-5769'), ('7438971409', '661-5852')]
+        result = dict(returns.download_labels(labels, self.dir))
+        self.assertEqual(len(os.listdir(self.dir)), 2)
+        self.assertTrue(result[labels[1]].endswith('7438971409_661-5852.pdf'))
+
+
+class TestInvoiceHarvest(TestCase):
+    def setUp(self):
+        import json
+        import tempfile
+        self.dir = tempfile.mkdtemp()
+        json.dump({'9670348809': {}}, open(os.path.join(self.dir, 'manifest.json'), 'w'))
+        self.invoices = lookups.Lookup.invoices
+        self.save_invoice = lookups.Lookup.save_invoice
+        lookups.Lookup.invoices = lambda l: parse(
+            '<Body><Response><lookupResponseData><invoiceID>%d</invoiceID>'
+            '</lookupResponseData><lookupResponseData><invoiceID>9670348809</invoiceID>'
+            '</lookupResponseData></Response></Body>' % int(l.invoiceDate.replace('/', '')),
+            'lookupResponseData')
+        lookups.Lookup.save_invoice = lambda l, path: 'abc'
+
+    def tearDown(self):
+        import shutil
+        lookups.Lookup.invoices = self.invoices
+        lookups.Lookup.save_invoice = self.save_invoice
+        shutil.rmtree(self.dir)
+
+    def test_harvest(self):
+        import json
+        result = dict(lookups.harvest_invoices(677592, date(2014, 1, 1),
+                                               date(2014, 1, 3), self.dir))
+        self.assertEqual(len(result), 3)
+        manifest = json.load(open(os.path.join(self.dir, 'manifest.json')))
+        self.assertEqual(len(manifest), 4)
+        self.assertEqual(manifest['10214']['sha256'], 'abc')
+
+    def test_empty_day(self):
+        from gsxws.core import GsxEmptyResult
+        invoices = lookups.Lookup.invoices
+
+        def lookup(l):
+            if l.invoiceDate == '01/02/14':
+                raise GsxEmptyResult()
+            return invoices(l)
+
+        lookups.Lookup.invoices = lookup
+        result = dict(lookups.harvest_invoices(677592, date(2014, 1, 1),
+                                               date(2014, 1, 3), self.dir))
+        self.assertEqual(sorted(result), ['10114', '10314'])
+
+    def test_duplicate(self):
+        saved = []
+
+        def save_invoice(l, path):
+            saved.append(l.invoiceID)
+            return 'abc'
+
+        lookups.Lookup.invoices = lambda l: parse(
+            '<Body><Response><lookupResponseData><invoiceID>9670348810</invoiceID>'
+            '</lookupResponseData></Response></Body>', 'lookupResponseData')
+        lookups.Lookup.save_invoice = save_invoice
+        result = dict(lookups.harvest_invoices(677592, date(2014, 1, 1),
+                                               date(2014, 1, 3), self.dir))
+        self.assertEqual(list(result), ['9670348810'])
+        self.assertEqual(saved, ['9670348810'])
+
+
+class TestMetrics(TestCase):
+    def test_statsd(self):
+        from gsxws.metrics import StatsdAdapter
+        statsd = StatsdAdapter()
+        self.assertEqual(statsd.format('timing', 'request.network', 0.25,
+                                       {'operation': 'WarrantyStatus'}),
+                         'gsxws.request.network.WarrantyStatus:250|ms')
+        statsd.dogstatsd = True
+        self.assertEqual(statsd.format('counter', 'request.fault', 1, {'code': 'RPR.LKP.01'}),
+                         'gsxws.request.fault:1|c|#code:RPR.LKP.01')
+
+    def test_cache(self):
+        from gsxws import metrics
+        collected = []
+        callback = metrics.register(lambda *m: collected.append(m[1]))
+        try:
+            c = GsxCache('test').set('spam', 'eggs')
+            c.get('spam')
+            c.get('ham')
+        finally:
+            metrics.unregister(callback)
+        self.assertEqual(collected, ['cache.hit', 'cache.miss'])
+
+
+class TestCircuitBreaker(TestCase):
+    def setUp(self):
+        from gsxws import core
+        self.core = core
+        self.url = core.GSX_URL
+        os.environ.setdefault('GSX_CERT', os.devnull)
+        os.environ.setdefault('GSX_KEY', os.devnull)
+        core.GSX_URL = 'http://127.0.0.1:1/gsx-ws{env}/{region}'  # refuses connections
+        core.CircuitBreaker.reset_all()
+
+    def tearDown(self):
+        self.core.GSX_URL = self.url
+        self.core.CircuitBreaker.reset_all()
+
+    def test_open(self):
+        core = self.core
+        send = lambda: core.GsxRequest()._send('WarrantyStatus', '<a/>')
+
+        for i in range(core.GSX_BREAKER_THRESHOLD):
+            with self.assertRaises(GsxError) as cm:
+                send()
+            self.assertNotIsInstance(cm.exception, core.GsxCircuitOpen)
+
+        with self.assertRaises(core.GsxCircuitOpen) as cm:
+            send()
+        self.assertEqual(cm.exception.code, 'GSX.CIRCUIT.OPEN')
+
+        status = core.circuit_status()
+        self.assertEqual(len(status), 1)
+        self.assertEqual(status.values()[0]['state'], 'open')
+
+    def test_half_open(self):
+        breaker = self.core.CircuitBreaker('test', threshold=2, timeout=0)
+        breaker.failure()
+        self.assertEqual(breaker.state, 'closed')
+        breaker.failure()
+        self.assertEqual(breaker.state, 'half-open')
+        breaker.before()  # the trial request
+        self.assertRaises(self.core.GsxCircuitOpen, breaker.before)
+        breaker.failure()
+        breaker.timeout = 60
+        self.assertEqual(breaker.state, 'open')
+        self.assertRaises(self.core.GsxCircuitOpen, breaker.before)
+        breaker.timeout = 0
+        breaker.before()
+        breaker.success()
+        self.assertEqual(breaker.state, 'closed')
+        self.assertEqual(breaker.failures, 0)
+
+
+class TestLazyImport(TestCase):
+    def test_exports(self):
+        """Lazy names resolve like the old star imports did."""
+        import gsxws
+        import importlib
+        for name in gsxws.__all__:
+            value = None
+            for m in gsxws.MODULES:
+                value = getattr(importlib.import_module('gsxws.' + m), name, value)
+            self.assertEqual(getattr(gsxws, name), value, name)
+        self.assertEqual(gsxws.fetch, comptia.fetch)
+
+    def test_import(self):
+        import sys
+        import subprocess
+        code = "import sys, gsxws; print('requests' in sys.modules or 'lxml' in sys.modules)"
+        out = subprocess.check_output([sys.executable, '-c', code],
+                                      cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual(out.strip(), 'False')
+
 
 class TestTypes(TestCase):
     def setUp(self):
@@ -187,6 +632,91 @@ class TestTypes(TestCase):
             self.assertIsInstance(x.text, str)
 
 
+class TestConvert(TestCase):
+    def test_attributes(self):
+        """to_dict() gives the same values as attribute access."""
+        from gsxws.objectify import to_dict
+        for fixture, response in (('warranty_status.xml', 'warrantyDetailInfo'),
+                                  ('ios_activation.xml', 'activationDetailsInfo'),
+                                  ('escalation_details_lookup.xml', 'lookupResponseData'),):
+            el = parse('tests/fixtures/' + fixture, response)
+            d = to_dict(el)
+            for k, v in d.items():
+                if not isinstance(v, (dict, list)):
+                    self.assertEqual(v, getattr(el, k), k)
+        self.assertEqual(d['escalationNotes']['note'][0], 'blaa')
+
+    def test_lists(self):
+        from gsxws.objectify import to_dict
+        parts = parse('tests/fixtures/parts_lookup.xml', 'parts')
+        self.assertEqual(to_dict(parts)['stockPrice'], [17.1, 17.1])
+        details = to_dict(parse('tests/fixtures/repair_details_ca.xml', 'lookupResponseData'))
+        self.assertIsInstance(details['partsInfo'], list)
+
+    def test_json(self):
+        import json
+        from gsxws.objectify import to_json
+        wty = parse('tests/fixtures/warranty_status.xml', 'warrantyDetailInfo')
+        data = json.loads(to_json(wty))
+        self.assertEqual(data['estimatedPurchaseDate'], '2010-08-25')
+        self.assertEqual(data['serialNumber'], '70033CDFA4S')
+
+    def test_pack(self):
+        import pickle
+        from gsxws.objectify import pack, unpack
+        dicts = [{'repairStatus': 'Open', 'notes': 'x'}, {'repairStatus': 'Closed'},
+                 {'notes': None}]
+        self.assertEqual(unpack(pickle.loads(pickle.dumps(pack(dicts), 2))), dicts)
+
+    def test_msgpack_keys(self):
+        from gsxws.objectify import to_dict, _text_keys
+        details = _text_keys(to_dict(parse('tests/fixtures/repair_details_ca.xml',
+                                           'lookupResponseData')))
+        self.assertTrue(all(isinstance(k, unicode) for k in details))
+        self.assertTrue(all(isinstance(k, unicode) for k in details['partsInfo'][0]))
+
+
+class TestRecords(TestCase):
+    def setUp(self):
+        self.xml = open('tests/fixtures/warranty_status.xml', 'rb').read()
+        self.el = parse(self.xml, 'warrantyDetailInfo')
+
+    def test_warranty(self):
+        from gsxws.records import WarrantyInfo
+        wty = WarrantyInfo.from_element(self.el)
+        self.assertEqual(wty.warrantyStatus, self.el.warrantyStatus)
+        self.assertEqual(wty.estimatedPurchaseDate, date(2010, 8, 25))
+        self.assertEqual(wty.globalWarranty, None)  # in extra
+        self.assertIn('triCareFlag', wty.extra)
+        self.assertEqual(wty.blaa, None)
+        self.assertRaises(AttributeError, setattr, wty, 'warrantyStatus', 'spam')
+        self.assertEqual(wty.to_dict()['serialNumber'], '70033CDFA4S')
+
+    def test_pickle(self):
+        import pickle
+        from gsxws.records import WarrantyInfo
+        wty = WarrantyInfo.from_element(self.el)
+        data = pickle.dumps(wty, 2)
+        self.assertEqual(pickle.loads(data), wty)
+        self.assertLess(len(data), len(self.xml) / 2)
+
+    def test_parts(self):
+        from gsxws.records import PartInfo
+        parts = PartInfo.from_elements(parse('tests/fixtures/parts_lookup.xml', 'parts'))
+        self.assertEqual(len(parts), 3)
+        self.assertEqual(parts[0].partNumber, '661-4448')
+
+    def test_frozen(self):
+        from gsxws.objectify import to_dict
+        from gsxws.records import RepairDetails
+        el = parse('tests/fixtures/repair_details_ca.xml', 'lookupResponseData')
+        details = RepairDetails.from_element(el)
+        self.assertIsInstance(details.partsInfo, tuple)
+        self.assertRaises(TypeError, details.partsInfo[0].update, {'partNumber': 'spam'})
+        self.assertEqual(len(set([details, RepairDetails.from_element(el)])), 1)
+        self.assertEqual(details.to_dict(), to_dict(el))
+
+
 class TestErrorFunctions(TestCase):
     def setUp(self):
         xml = open('tests/fixtures/multierror.xml', 'r').read()
@@ -478,6 +1008,74 @@ class TestIosDiagnostics(TestCase):
         self.assertEqual(data.reportData.key[0].name, "LAST_USAGE_LENGTH")
 
 
+class TestDiagnosticsHarvest(TestCase):
+    def setUp(self):
+        self.fetch = diagnostics.Diagnostics.fetch
+        self.numbers = diagnostics.event_numbers
+        diagnostics.Diagnostics.fetch = lambda d: d.diagnosticEventNumber
+        diagnostics.event_numbers = lambda sn: ['%s%d' % (sn, i) for i in range(3)]
+
+    def tearDown(self):
+        diagnostics.Diagnostics.fetch = self.fetch
+        diagnostics.event_numbers = self.numbers
+
+    def test_harvest(self):
+        result = {}
+        errors = diagnostics.harvest(['A', 'B'], result.__setitem__, store=['A0'])
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(result), ['A1', 'A2', 'B0', 'B1', 'B2'])
+
+
+class TestDiagnosticsTable(TestCase):
+    def setUp(self):
+        self.xml = open('tests/fixtures/ios_diagnostics.xml', 'r').read()
+        self.table = diagnostics.DiagnosticsTable()
+        self.table.extend(self.xml)
+
+    def test_results(self):
+        self.assertEqual(self.table.results['name'][1], 'FULLY_CHARGED')
+        self.assertEqual(self.table.results['information'][0], 'GREEN')
+        self.assertEqual(self.table.results['eventNumber'][0], '36558205')
+
+    def test_profile(self):
+        self.assertEqual(self.table.profile['section'][1], 'unit')
+        self.assertEqual(self.table.profile['value'][1], 'fliPhone')
+
+    def test_no_report_data(self):
+        self.assertEqual(len(self.table.results['name']), 4)
+        self.assertEqual(set(self.table.profile['section']), set(['unit']))
+        self.assertNotIn('HIGH_TEMP', self.table.profile['name'])
+
+    def test_typed(self):
+        table = self.table
+        results = dict((k, (v, numeric)) for k, v, numeric
+                       in table._typed(table.results, table.RESULT_COLUMNS))
+        self.assertEqual(results['numericValue'], ([1.0, 1.0, 1.0, 1.0], True))
+        self.assertEqual(results['value'], (table.results['value'], False))
+        self.assertFalse(results['name'][1])
+        profile = dict((k, v) for k, v, numeric
+                       in table._typed(table.profile, table.PROFILE_COLUMNS))
+        self.assertEqual(profile['value'][1], 'fliPhone')
+        self.assertEqual(profile['numericValue'][1], None)
+
+    def test_batch_types(self):
+        """Every batch has the same columns and types, whatever the values."""
+        other = diagnostics.DiagnosticsTable()
+        other.extend(self.xml.replace('<value>1</value>', '<value>PASS</value>', 1))
+        types = lambda t: [(k, numeric) for k, v, numeric
+                           in t._typed(t.results, t.RESULT_COLUMNS)]
+        self.assertEqual(types(other), types(self.table))
+        self.assertEqual(other._typed(other.results, other.RESULT_COLUMNS)[-1][1][:2],
+                         [None, 1.0])
+
+    def test_parsed(self):
+        table = diagnostics.DiagnosticsTable()
+        table.extend(parse('tests/fixtures/ios_diagnostics.xml', 'lookupResponseData'))
+        table.concat(self.table)
+        self.assertEqual(len(table), 2 * len(self.table))
+        self.assertEqual(table.profile['name'], 2 * self.table.profile['name'])
+
+
 class TestOnsiteCoverage(RemoteTestCase):
     def setUp(self):
         super(TestOnsiteCoverage, self).setUp()
@@ -583,6 +1181,801 @@ class TestCarryinRepairDetail(TestCase):
         self.assertEqual(self.data.primaryAddress.firstName, u'Ääkköset')
 
 
+class StubTestCase(TestCase):
+    """Tests against the local GSX stand-in."""
+    @classmethod
+    def setUpClass(cls):
+        import tempfile
+        from gsxws import core
+        from tests.server import GsxStubServer
+        cls.url = core.GSX_URL
+        cls.sessions = tempfile.mkdtemp()
+        cls.server = GsxStubServer(sessions=cls.sessions,
+                                   errors={'RepairDetails': 'RPR.LKP.01'}).start()
+        cls.server.configure()
+        core.connect('stub', '123456')
+
+    @classmethod
+    def tearDownClass(cls):
+        import shutil
+        from gsxws import core
+        cls.server.stop()
+        core.GSX_URL = cls.url
+        shutil.rmtree(cls.sessions)
+
+    def test_warranty(self):
+        calls = self.server.stats.get('WarrantyStatus', {}).get(200, 0)
+        wty = Product('DGKFL06JDHJP').warranty()
+        self.assertEqual(wty.warrantyStatus, 'Apple Limited Warranty')
+        self.assertEqual(self.server.stats['WarrantyStatus'][200], calls + 1)
+
+    def test_metrics(self):
+        from gsxws import metrics
+        collected = []
+        callback = metrics.register(lambda *m: collected.append(m))
+        try:
+            Product('DGKFL06JDHJP').warranty()
+            self.assertRaises(GsxError, repairs.Repair('G135773004').details)
+        finally:
+            metrics.unregister(callback)
+        names = [(m[0], m[1]) for m in collected]
+        self.assertIn(('timing', 'request.network'), names)
+        self.assertIn(('timing', 'request.parse'), names)
+        self.assertIn(('size', 'request.received'), names)
+        self.assertIn(('counter', 'request.fault', 1, {'operation': 'RepairDetails',
+                                                       'code': 'RPR.LKP.01'}), collected)
+
+    def test_compressed_response(self):
+        from gsxws import metrics
+        sizes = {}
+        callback = metrics.register(lambda k, name, v, tags: sizes.setdefault(name, v))
+        self.server.compress = True
+        try:
+            parts = Product('DGKFL06JDHJP').parts()
+        finally:
+            self.server.compress = False
+            metrics.unregister(callback)
+        self.assertEqual(parts[0].partNumber, '661-4448')
+        self.assertLess(sizes['request.received.wire'], sizes['request.received'])
+
+    def test_compressed_request(self):
+        from gsxws import core
+        core.GSX_COMPRESS_MIN = 0
+        try:
+            Product('DGKFL06JDHJP').warranty()
+            self.assertEqual(self.server.received[-1], ('WarrantyStatus', True))
+            self.server.reject_compressed = True
+            Product('DGKFL06JDHJP').warranty()
+            self.assertEqual(self.server.received[-1], ('WarrantyStatus', False))
+            self.assertEqual(len(core.GsxRequest.uncompressed), 1)
+        finally:
+            core.GSX_COMPRESS_MIN = 8192
+            self.server.reject_compressed = False
+            core.GsxRequest.uncompressed.clear()
+
+    def test_stalled_response(self):
+        from gsxws import core
+        timeout, core.GSX_TIMEOUT = core.GSX_TIMEOUT, 0.2
+        self.server.stall = 0.5
+        try:
+            with self.assertRaises(GsxError) as cm:
+                Product('DGKFL06JDHJP').parts()
+        finally:
+            core.GSX_TIMEOUT = timeout
+            self.server.stall = 0
+        self.assertIn('GSX connection failed', unicode(cm.exception))
+        failures = [b['failures'] for b in core.circuit_status().values()]
+        core.CircuitBreaker.reset_all()
+        self.assertIn(1, failures)
+
+    def half_open(self):
+        """Opens the breaker of the stub server so that the next request is a trial."""
+        from gsxws import core
+        url = core.GSX_URL.format(env=core.GSX_HOSTS[core.GSX_ENV], region=core.GSX_REGION)
+        breaker = core.CircuitBreaker.get(url)
+        breaker.threshold, breaker.timeout = 1, 0
+        breaker.failure()
+        self.assertEqual(breaker.state, 'half-open')
+        return breaker
+
+    def test_trial_invalid_response(self):
+        from gsxws import core
+        path = os.path.join(self.sessions, 'PartsLookup.xml')
+        open(path, 'w').write('<html><body>Service Unavailable')
+        breaker = self.half_open()
+        try:
+            self.assertRaises(Exception, Product('DGKFL06JDHJP').parts)
+            self.assertFalse(breaker.trial)
+            os.remove(path)
+            self.assertEqual(Product('DGKFL06JDHJP').parts()[0].partNumber, '661-4448')
+            self.assertEqual(breaker.state, 'closed')
+        finally:
+            core.CircuitBreaker.reset_all()
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_trial_invalid_label(self):
+        import tempfile
+        from gsxws import core
+        path = os.path.join(self.sessions, 'ReturnLabel.xml')
+        open(path, 'w').write('<html><body>Service Unavailable')
+        directory = tempfile.mkdtemp(dir=self.sessions)
+        breaker = self.half_open()
+        try:
+            with self.assertRaises(GsxError) as cm:
+                returns.Return('7438971408').save_label('661-5769', os.path.join(directory, 'a.pdf'))
+            self.assertIn('Invalid ReturnLabel response', unicode(cm.exception))
+            self.assertFalse(breaker.trial)
+            # failing to open the file doesn't send the trial request at all
+            self.assertRaises(GsxError, returns.Return('7438971408').save_label,
+                              '661-5769', os.path.join(directory, 'missing', 'a.pdf'))
+            self.assertFalse(breaker.trial)
+            self.assertEqual(os.listdir(directory), [])
+        finally:
+            core.CircuitBreaker.reset_all()
+            os.remove(path)
+
+    def test_trial_compressed_request(self):
+        from gsxws import core
+        core.GSX_COMPRESS_MIN = 0
+        self.server.reject_compressed = True
+        breaker = self.half_open()
+        try:
+            Product('DGKFL06JDHJP').warranty()
+            self.assertEqual(self.server.received[-1], ('WarrantyStatus', False))
+            self.assertEqual(breaker.state, 'closed')
+        finally:
+            core.GSX_COMPRESS_MIN = 8192
+            self.server.reject_compressed = False
+            core.GsxRequest.uncompressed.clear()
+            core.CircuitBreaker.reset_all()
+
+    def test_tracing(self):
+        from gsxws import tracing
+        tracer = tracing.set_tracer(tracing.InMemoryTracer())
+        try:
+            Product('013348005376007').warranty()
+            self.assertRaises(GsxError, repairs.Repair('G135773004').details)
+        finally:
+            tracing.set_tracer(None)
+        parent = tracer.find('Product.warranty')[0]
+        soap = tracer.find('gsx.WarrantyStatus')[0]
+        self.assertIs(soap.parent, parent)
+        self.assertIs(tracer.find('Product.activation')[0].parent, parent)
+        self.assertEqual(soap.attributes['gsx.operation'], 'WarrantyStatus')
+        self.assertGreater(soap.attributes['gsx.response_size'], 0)
+        self.assertEqual(tracer.find('gsx.RepairDetails')[0].attributes['gsx.fault_code'],
+                         'RPR.LKP.01')
+
+    def test_records(self):
+        product = Product('DGKFL06JDHJP')
+        wty = product.warranty(record=True)
+        self.assertEqual(wty.warrantyStatus, 'Apple Limited Warranty')
+        self.assertTrue(product.has_warranty)
+        self.assertIsNone(product._gsx._req.objects)
+        parts = product.parts(record=True)
+        self.assertEqual(parts[0].partNumber, '661-4448')
+
+    def test_parse_offload(self):
+        from gsxws import core, metrics, lookups
+        collected = []
+        callback = metrics.register(lambda *m: collected.append(m[1]))
+        local = lookups.Lookup(serialNumber='DGKFL06JDHJP').repairs(record=True)
+        core.GSX_PARSE_PROCESSES, core.GSX_PARSE_MIN = 1, 0
+        try:
+            offloaded = lookups.Lookup(serialNumber='DGKFL06JDHJP').repairs(record=True)
+            parts = lookups.Lookup(serialNumber='DGKFL06JDHJP').parts(record=True)
+        finally:
+            core.GSX_PARSE_PROCESSES, core.GSX_PARSE_MIN = 0, 1024 * 1024
+            core.parse_pool().terminate()
+            core._parse_pool = None
+            metrics.unregister(callback)
+        self.assertEqual(offloaded, local)
+        self.assertEqual(local[0].serialNumber, 'W874939YX92')
+        self.assertEqual(parts[0].partNumber, '661-4448')
+        self.assertEqual(collected.count('request.offload'), 2)
+
+    def test_parse_offload_rows(self):
+        from gsxws import core
+        from tests.server import ENVELOPE
+        xml = ENVELOPE.format(method='RepairLookup', operation=1, body=(
+            '<lookupResponseData><repairConfirmationNumber>G1</repairConfirmationNumber>'
+            '<repairStatus>Open</repairStatus><notes>x</notes></lookupResponseData>'
+            '<lookupResponseData><repairConfirmationNumber>G2</repairConfirmationNumber>'
+            '<repairStatus>Closed</repairStatus></lookupResponseData>'))
+        path = os.path.join(self.sessions, 'RepairLookup.xml')
+        open(path, 'w').write(xml)
+        try:
+            local = lookups.Lookup(serialNumber='DGKFL06JDHJP').repairs(record=True)
+            core.GSX_PARSE_PROCESSES, core.GSX_PARSE_MIN = 1, 0
+            offloaded = lookups.Lookup(serialNumber='DGKFL06JDHJP').repairs(record=True)
+        finally:
+            core.GSX_PARSE_PROCESSES, core.GSX_PARSE_MIN = 0, 1024 * 1024
+            core.parse_pool().terminate()
+            core._parse_pool = None
+            os.remove(path)
+        self.assertEqual([r.to_dict() for r in offloaded], [r.to_dict() for r in local])
+        self.assertEqual(offloaded[0].extra, {'notes': 'x'})
+        self.assertEqual(offloaded[1].extra, None)
+
+    def test_parse_offload_invalid(self):
+        from gsxws import core
+        path = os.path.join(self.sessions, 'RepairLookup.xml')
+        open(path, 'w').write('<Envelope><Body>' + '<lookupResponseData><repairStatus>Open'
+                              '</repairStatus></lookupResponseData>' * 100)
+        core.GSX_PARSE_PROCESSES, core.GSX_PARSE_MIN = 1, 1024
+        try:
+            with self.assertRaises(GsxError) as cm:
+                lookups.Lookup(serialNumber='DGKFL06JDHJP').repairs(record=True)
+            self.assertIn('Invalid RepairLookup response', unicode(cm.exception))
+            os.remove(path)
+            core.GSX_PARSE_MIN = 0
+            # the pool still answers
+            repairs = lookups.Lookup(serialNumber='DGKFL06JDHJP').repairs(record=True)
+        finally:
+            core.GSX_PARSE_PROCESSES, core.GSX_PARSE_MIN = 0, 1024 * 1024
+            core.parse_pool().terminate()
+            core._parse_pool = None
+            if os.path.exists(path):
+                os.remove(path)
+        self.assertEqual(repairs[0].serialNumber, 'W874939YX92')
+
+    def test_parse_offload_timeout(self):
+        import multiprocessing
+        from gsxws import core
+        terminated = []
+
+        class Pool(object):
+            def apply_async(self, func, args):
+                return self
+
+            def get(self, timeout):
+                raise multiprocessing.TimeoutError()
+
+            def terminate(self):
+                terminated.append(True)
+
+        core._parse_pool = Pool()
+        try:
+            self.assertRaises(GsxError, core.parse_offloaded, 'RepairLookup', '<a/>', 'a')
+        finally:
+            core._parse_pool = None
+        self.assertEqual(terminated, [True])
+
+    def test_intake(self):
+        from gsxws.products import intake
+        self.server.latency = 0.1
+        try:
+            dossier = intake('013348005376007', deadline=5)
+        finally:
+            self.server.latency = 0
+        self.assertEqual(dossier.serialNumber, '2J141331A4S')
+        self.assertEqual(dossier['warranty'].warrantyStatus, 'Apple Limited Warranty')
+        self.assertIn('parts', dossier.results)
+        self.assertIn('diagnostics', dossier.errors)  # no fixture for diagnostics
+        self.assertLess(dossier.elapsed, 0.45)  # activation + the slowest call
+
+    def test_intake_deadline(self):
+        from gsxws.products import intake
+        self.server.latency = 0.3
+        try:
+            dossier = intake('DGKFL06JDHJP', deadline=0.1, calls=('repairs', 'parts',))
+        finally:
+            self.server.latency = 0
+        self.assertFalse(dossier.complete)
+        self.assertEqual(sorted(dossier.errors), ['parts', 'repairs'])
+        self.assertLess(dossier.elapsed, 0.3)
+
+    def test_model_index(self):
+        import time
+        from gsxws import products
+        path = os.path.join(self.sessions, 'models')
+        index = products.use_model_index(path, verify=True)
+        try:
+            calls = self.server.stats.get('FetchProductModel', {}).get(200, 0)
+            model = Product('DGKFL06JDHJP').model(record=True)
+            self.assertIsInstance(model, products.ModelInfo)
+            self.assertEqual(model.productLine, 'CPU')
+            model = Product('C02KFL06DHJP').model(record=True)
+            self.assertEqual(model.configDescription, 'iMac (27-inch, Mid 2011)')
+            self.assertIsInstance(model, products.ModelInfo)
+            Product('C02KFL07DHJP').model(record=True)
+            for i in range(100):  # wait for the background verification
+                if index.checked:
+                    break
+                time.sleep(0.01)
+            stats = index.stats()
+        finally:
+            products.MODEL_INDEX = None
+            index.close()
+        self.assertEqual(self.server.stats['FetchProductModel'][200], calls + 2)
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['checked'], 1)
+        self.assertEqual(stats['precision'], 1)
+
+    def test_model_index_partial(self):
+        from gsxws import products
+        path = os.path.join(self.sessions, 'partial_models')
+        index = products.use_model_index(path)
+        try:
+            index.learn('C02KFL06DHJP', configDescription='iMac (27-inch, Mid 2011)')
+            self.assertIsNone(index.lookup('C02KFL07DHJP'))
+            calls = self.server.stats.get('FetchProductModel', {}).get(200, 0)
+            product = Product('C02KFL07DHJP')
+            product.model(record=True)
+            self.assertEqual(product.productLine, 'CPU')
+            self.assertEqual(self.server.stats['FetchProductModel'][200], calls + 1)
+            self.assertEqual(index.lookup('C02KFL08DHJP').configCode, 'DHJP')
+            # without record=True it's always the tree from GSX
+            self.assertFalse(isinstance(Product('C02KFL08DHJP').model(), products.ModelInfo))
+            self.assertEqual(self.server.stats['FetchProductModel'][200], calls + 2)
+        finally:
+            products.MODEL_INDEX = None
+            index.close()
+
+    def test_model_index_locked(self):
+        from gsxws import products
+        path = os.path.join(self.sessions, 'locked_models')
+        index = products.ModelIndex(path)
+        try:
+            if products.fcntl is not None:
+                # flock locks are per open file, like a second process has
+                self.assertRaises(GsxError, products.ModelIndex, path)
+        finally:
+            index.close()
+        products.ModelIndex(path).close()
+
+    def test_event_numbers(self):
+        self.assertEqual(diagnostics.event_numbers('DGKFL06JDHJP'),
+                         ['12942008007242012052919', '36558205'])
+
+    def test_mark_complete_many(self):
+        from tests.server import ENVELOPE
+        xml = ENVELOPE.format(method='MarkRepairComplete', operation=1, body=(
+            '<repairConfirmationNumbers><confirmationNumber>G135773004</confirmationNumber>'
+            '<outcome>SUCCESS</outcome></repairConfirmationNumbers>'
+            '<repairConfirmationNumbers><confirmationNumber>G135762375</confirmationNumber>'
+            '<outcome>STOP</outcome><errorCode>RPR.COM.001</errorCode>'
+            '<messages>Repair is already closed</messages></repairConfirmationNumbers>'))
+        path = os.path.join(self.sessions, 'MarkRepairComplete.xml')
+        open(path, 'w').write(xml)
+        try:
+            result = dict(repairs.mark_complete_many(['G135773004', 'G135762375']))
+        finally:
+            os.remove(path)
+        self.assertEqual(result['G135773004'].outcome, 'SUCCESS')
+        self.assertIsInstance(result['G135762375'], GsxError)
+        self.assertEqual(result['G135762375'].code, 'RPR.COM.001')
+        self.assertIn('already closed', result['G135762375'].message)
+
+    def test_no_event_numbers(self):
+        from tests.server import ENVELOPE
+        xml = ENVELOPE.format(method='FetchDiagnosticEventNumbers', operation=1, body='')
+        path = os.path.join(self.sessions, 'FetchDiagnosticEventNumbers.xml')
+        open(path, 'w').write(xml)
+        try:
+            self.assertEqual(diagnostics.event_numbers('DGKFL06JDHJP'), [])
+            self.assertEqual(diagnostics.harvest('DGKFL06JDHJP', lambda n, d: None), [])
+        finally:
+            os.remove(path)
+
+    def test_json_fixture(self):
+        result = lookups.Lookup(serialNumber='W874939YX92').repairs()
+        self.assertEqual(result.serialNumber, 'W874939YX92')
+
+    def test_fault(self):
+        with self.assertRaises(GsxError) as cm:
+            repairs.Repair('G135773004').details()
+        self.assertEqual(cm.exception.code, 'RPR.LKP.01')
+
+    def test_save_label(self):
+        import base64
+        from tests.server import ENVELOPE
+        xml = ENVELOPE.format(method='ReturnLabel', operation=1,
+                              body='<returnLabelData><returnLabelFileData>%s'
+                              '</returnLabelFileData></returnLabelData>' % base64.b64encode('%PDF'))
+        open(os.path.join(self.sessions, 'ReturnLabel.xml'), 'w').write(xml)
+        path = os.path.join(self.sessions, 'label.pdf')
+        returns.Return('7438971408').save_label('661-5769', path)
+        self.assertEqual(open(path).read(), '%PDF')
+
+    def test_download_labels_stalled(self):
+        import base64
+        import tempfile
+        from gsxws import core
+        from tests.server import ENVELOPE
+        xml = ENVELOPE.format(method='ReturnLabel', operation=1,
+                              body='<returnLabelData><returnLabelFileData>%s'
+                              '</returnLabelFileData></returnLabelData>' % base64.b64encode('%PDF'))
+        fixture = os.path.join(self.sessions, 'ReturnLabel.xml')
+        open(fixture, 'w').write(xml)
+        directory = tempfile.mkdtemp(dir=self.sessions)
+        timeout, core.GSX_TIMEOUT = core.GSX_TIMEOUT, 0.2
+        self.server.stall = 0.5
+        try:
+            labels = [('7438971408', '661-5769'), ('7438971409', '661-5769')]
+            result = dict(returns.download_labels(labels, directory))
+        finally:
+            core.GSX_TIMEOUT = timeout
+            self.server.stall = 0
+            core.CircuitBreaker.reset_all()
+            os.remove(fixture)
+        self.assertEqual(len(result), 2)
+        self.assertTrue(all(isinstance(r, GsxError) for r in result.values()))
+        self.assertEqual(os.listdir(directory), [])
+
+    def test_save_invoice_stalled(self):
+        import base64
+        from gsxws import core
+        from tests.server import ENVELOPE
+        xml = ENVELOPE.format(method='InvoiceDetailsLookup', operation=1,
+                              body='<lookupResponseData><invoiceData>%s</invoiceData>'
+                              '</lookupResponseData>' % base64.b64encode('%PDF' * 100))
+        fixture = os.path.join(self.sessions, 'InvoiceDetailsLookup.xml')
+        open(fixture, 'w').write(xml)
+        path = os.path.join(self.sessions, 'invoice.pdf')
+        timeout, core.GSX_TIMEOUT = core.GSX_TIMEOUT, 0.2
+        self.server.stall = 0.5
+        try:
+            self.assertRaises(GsxError, lookups.Lookup(invoiceID=9670348809).save_invoice, path)
+        finally:
+            core.GSX_TIMEOUT = timeout
+            self.server.stall = 0
+            core.CircuitBreaker.reset_all()
+        try:
+            self.assertFalse(os.path.exists(path + '.part'))
+            lookups.Lookup(invoiceID=9670348809).save_invoice(path)
+            self.assertEqual(open(path).read(), '%PDF' * 100)
+        finally:
+            os.remove(fixture)
+
+    def test_outbox(self):
+        from gsxws.outbox import Outbox
+        outbox = Outbox(os.path.join(self.sessions, 'outbox.db'))
+        done = []
+        rep = repairs.CarryInRepair(serialNumber='DGKFL06JDHJP', poNumber='PO1')
+        key = outbox.enqueue(rep, callback=done.append)
+        self.assertEqual(outbox.enqueue(rep, key=key), key)
+        self.assertEqual(outbox.status(key)['state'], 'queued')
+        self.assertEqual(outbox.pending(), [key])
+        self.assertTrue(outbox.process())
+        self.assertFalse(outbox.process())
+        entry = outbox.status(key)
+        self.assertEqual(entry['state'], 'done')
+        self.assertEqual(entry['attempts'], 1)
+        self.assertTrue(entry['confirmation'].startswith('G'))
+        self.assertEqual(done, [entry])
+
+    def test_outbox_reconcile(self):
+        from gsxws.outbox import Outbox
+        from tests.server import ENVELOPE
+        outbox = Outbox(os.path.join(self.sessions, 'reconcile.db'))
+        rep = repairs.CarryInRepair(serialNumber='DGKFL06JDHJP', poNumber='PO2')
+        key = outbox.enqueue(rep)
+        # as if the process died while sending it
+        with outbox.db:
+            outbox.db.execute("UPDATE outbox SET state = 'sending', first_sent = ?",
+                              (outbox.status(key)['created'],))
+        xml = ENVELOPE.format(method='RepairLookup', operation=1,
+                              body='<lookupResponseData><repairConfirmationNumber>G111'
+                              '</repairConfirmationNumber><purchaseOrderNumber>PO2'
+                              '</purchaseOrderNumber></lookupResponseData>')
+        path = os.path.join(self.sessions, 'RepairLookup.xml')
+        open(path, 'w').write(xml)
+        calls = self.server.stats.get('CreateCarryIn', {}).get(200, 0)
+        try:
+            outbox.start()
+            entry = outbox.wait(key, timeout=5)
+        finally:
+            outbox.stop()
+            os.remove(path)
+        self.assertEqual(entry['state'], 'done')
+        self.assertEqual(entry['confirmation'], 'G111')
+        self.assertEqual(self.server.stats.get('CreateCarryIn', {}).get(200, 0), calls)
+
+    def test_outbox_unresolved(self):
+        from gsxws.outbox import Outbox
+        outbox = Outbox(os.path.join(self.sessions, 'unresolved.db'))
+        # no PO number to tell the repair apart from the ones the lookup finds
+        without_po = outbox.enqueue(repairs.CarryInRepair(serialNumber='DGKFL06JDHJP'))
+        without_sn = outbox.enqueue(repairs.CarryInRepair(alternateDeviceId='013348005376007'))
+        with outbox.db:
+            outbox.db.execute("UPDATE outbox SET state = 'sending', first_sent = created")
+        calls = self.server.stats.get('CreateCarryIn', {}).get(200, 0)
+        self.assertTrue(outbox.process())
+        self.assertTrue(outbox.process())
+        for key in (without_po, without_sn):
+            entry = outbox.status(key)
+            self.assertEqual(entry['state'], 'failed')
+            self.assertIn('may have been created', entry['error'])
+        self.assertEqual(self.server.stats.get('CreateCarryIn', {}).get(200, 0), calls)
+
+    def test_outbox_fault(self):
+        from gsxws.outbox import Outbox
+        outbox = Outbox(os.path.join(self.sessions, 'fault.db'))
+        key = outbox.enqueue(repairs.CarryInRepair(serialNumber='DGKFL06JDHJP', poNumber='PO3'))
+        self.server.errors['CreateCarryIn'] = 'RPR.CRT.001'
+        try:
+            outbox.process()
+        finally:
+            del self.server.errors['CreateCarryIn']
+        entry = outbox.status(key)
+        self.assertEqual(entry['state'], 'failed')
+        self.assertEqual(entry['attempts'], 1)
+        self.assertFalse(entry['uncertain'])
+        self.assertIn('Injected fault', entry['error'])
+
+    def test_outbox_retry(self):
+        import time
+        from gsxws import core
+        from gsxws.outbox import Outbox
+        outbox = Outbox(os.path.join(self.sessions, 'retry.db'), retries=3, backoff=60)
+        key = outbox.enqueue(repairs.CarryInRepair(serialNumber='DGKFL06JDHJP', poNumber='PO4'))
+        # the connection drops while reading the response, GSX may have it
+        timeout, core.GSX_TIMEOUT = core.GSX_TIMEOUT, 0.2
+        self.server.stall = 0.5
+        try:
+            outbox.process()
+        finally:
+            core.GSX_TIMEOUT = timeout
+            self.server.stall = 0
+            core.CircuitBreaker.reset_all()
+        entry = outbox.status(key)
+        self.assertEqual(entry['state'], 'queued')
+        self.assertEqual(entry['attempts'], 1)
+        self.assertTrue(entry['uncertain'])
+        self.assertFalse(outbox.process())  # backing off
+        next_attempt = outbox.db.execute("SELECT next_attempt FROM outbox").fetchone()[0]
+        self.assertTrue(next_attempt >= time.time() + 55)
+        with outbox.db:
+            outbox.db.execute("UPDATE outbox SET next_attempt = 0")
+        lookups = self.server.stats.get('RepairLookup', {}).get(200, 0)
+        self.assertTrue(outbox.process())
+        self.assertEqual(self.server.stats['RepairLookup'][200], lookups + 1)
+        entry = outbox.status(key)
+        self.assertEqual(entry['state'], 'done')
+        self.assertEqual(entry['attempts'], 2)
+
+    def test_outbox_exception(self):
+        from gsxws.outbox import Outbox
+        outbox = Outbox(os.path.join(self.sessions, 'exception.db'), retries=2)
+        key = outbox.enqueue(repairs.CarryInRepair(serialNumber='DGKFL06JDHJP', poNumber='PO5'))
+
+        def create(self):
+            raise ValueError('Connection reset')
+
+        create, repairs.CarryInRepair.create = repairs.CarryInRepair.create, create
+        try:
+            outbox.process()
+            entry = outbox.status(key)
+            self.assertEqual(entry['state'], 'queued')
+            self.assertTrue(entry['uncertain'])
+            self.assertEqual(entry['error'], 'Connection reset')
+            with outbox.db:
+                outbox.db.execute("UPDATE outbox SET next_attempt = 0")
+            outbox.process()
+        finally:
+            repairs.CarryInRepair.create = create
+        entry = outbox.status(key)
+        self.assertEqual(entry['state'], 'failed')
+        self.assertEqual(entry['attempts'], 2)
+
+    def test_outbox_circuit_open(self):
+        from gsxws import core
+        from gsxws.outbox import Outbox, is_ambiguous, is_retryable
+        error = core.GsxCircuitOpen(core.GSX_URL, 60)
+        self.assertTrue(is_retryable(error))
+        self.assertFalse(is_ambiguous(error))
+        outbox = Outbox(os.path.join(self.sessions, 'circuit.db'))
+        key = outbox.enqueue(repairs.CarryInRepair(serialNumber='DGKFL06JDHJP', poNumber='PO6'))
+
+        def create(self):
+            raise error
+
+        create, repairs.CarryInRepair.create = repairs.CarryInRepair.create, create
+        try:
+            outbox.process()
+        finally:
+            repairs.CarryInRepair.create = create
+        entry = outbox.status(key)
+        self.assertEqual(entry['state'], 'queued')
+        self.assertFalse(entry['uncertain'])
+
+    def test_refresher(self):
+        import time
+        from gsxws import core, comms, scheduler
+        session = core.GsxSession('stub', '123456', 'en', 'CEST')
+        refresher = scheduler.reference_data(session=session)
+        self.assertEqual(refresher['articles'], None)
+        logins = self.server.stats.get('Authenticate', {}).get(200, 0)
+        try:
+            self.assertTrue(refresher.run_pending() > 0)
+        finally:
+            refresher.stop()
+        self.assertEqual(self.server.stats['Authenticate'][200], logins + 1)
+        self.assertTrue(len(refresher['articles']) > 0)
+        self.assertEqual(refresher['articles'][0].createdDate, comms.fetch()[0].createdDate)
+        comptia = refresher.jobs['comptia']  # no fixture for ComptiaCodeLookup
+        self.assertEqual(comptia.failures, 1)
+        self.assertEqual(refresher['comptia'], None)
+        self.assertLessEqual(comptia.next_run - time.time(), scheduler.BACKOFF * 1.1)
+        self.assertGreater(refresher.jobs['session'].next_run - time.time(),
+                           scheduler.SESSION_INTERVAL * 0.89)
+
+    def test_refresher_thread(self):
+        import time
+        from gsxws import scheduler
+        refresher = scheduler.Refresher()
+        calls, stopped = [], []
+        refresher.on_stop(lambda: stopped.append(True))
+        refresher.start()
+        self.assertIn(refresher, scheduler._running)
+        refresher.register('spam', lambda: calls.append(1) or len(calls), 0.01)
+        try:
+            for i in range(100):
+                if len(calls) >= 3:
+                    break
+                time.sleep(0.01)
+        finally:
+            refresher.stop(timeout=5)
+        self.assertGreaterEqual(refresher['spam'], 3)
+        self.assertEqual(stopped, [True])
+        self.assertNotIn(refresher, scheduler._running)
+        count = len(calls)
+        time.sleep(0.05)
+        self.assertEqual(len(calls), count)
+
+
+class ImageCacheTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        from tests.server import GsxStubServer
+        cls.server = GsxStubServer(images={'/a.gif': 'A' * 100, '/b.gif': 'B' * 100,
+                                           '/c.gif': 'C' * 100, '/a2.gif': 'A' * 100,
+                                           '/d.png?w=100': 'D' * 100}).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        import tempfile
+        from datetime import timedelta
+        from gsxws.images import ImageCache
+        self.server.stats = {}
+        self.server.latency = 0
+        self.directory = tempfile.mkdtemp()
+        self.cache = ImageCache(self.directory, max_age=timedelta(0))
+
+    def tearDown(self):
+        import shutil
+        self.cache.close()
+        shutil.rmtree(self.directory)
+
+    def test_revalidate(self):
+        url = self.server.image_url('/a.gif')
+        path = self.cache.get(url)
+        self.assertEqual(open(path).read(), 'A' * 100)
+        self.assertEqual(self.cache.get(url), path)
+        self.assertEqual(self.server.stats['GET'], {200: 1, 304: 1})
+
+    def test_content_addressed(self):
+        a = self.cache.get(self.server.image_url('/a.gif'))
+        self.assertEqual(self.cache.get(self.server.image_url('/a2.gif')), a)
+        self.assertEqual(self.cache.size(), 100)
+
+    def test_evict(self):
+        import time
+        self.cache.max_size = 250
+        for name in ('/a.gif', '/b.gif', '/c.gif'):
+            path = self.cache.get(self.server.image_url(name))
+            time.sleep(0.01)
+        self.assertEqual(self.cache.size(), 200)
+        self.assertTrue(os.path.exists(path))
+
+    def test_inflight(self):
+        import threading
+        from datetime import timedelta
+        self.cache.max_age = timedelta(days=1)
+        self.server.latency = 0.2
+        url = self.server.image_url('/b.gif')
+        paths = []
+        threads = [threading.Thread(target=lambda: paths.append(self.cache.get(url)))
+                   for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(set(paths)), 1)
+        self.assertEqual(self.server.stats['GET'], {200: 1})
+
+    def test_prefetch(self):
+        urls = [self.server.image_url(p) for p in ('/a.gif', '/b.gif', '/missing.gif')]
+        result = dict(self.cache.prefetch(urls))
+        self.assertTrue(os.path.exists(result[urls[1]]))
+        self.assertIsInstance(result[urls[2]], GsxError)
+
+    def test_ext(self):
+        from gsxws.images import image_ext
+        path = self.cache.get(self.server.image_url('/d.png?w=100'))
+        self.assertTrue(path.endswith('.png'))
+        url = 'https://example.com/kb/imageService.jsp?image=661-5571_350_350.gif&w=100'
+        self.assertEqual(image_ext(url), '.gif')
+        self.assertEqual(image_ext('https://example.com/image'), '.img')
+
+    def test_evict_shared(self):
+        import time
+        self.cache.max_size = 250
+        a = self.cache.get(self.server.image_url('/a.gif'))
+        time.sleep(0.01)
+        b = self.cache.get(self.server.image_url('/b.gif'))
+        time.sleep(0.01)
+        self.assertEqual(self.cache.get(self.server.image_url('/a2.gif')), a)
+        time.sleep(0.01)
+        self.cache.get(self.server.image_url('/c.gif'))
+        self.assertTrue(os.path.exists(a))
+        self.assertFalse(os.path.exists(b))
+
+    def test_disk_error(self):
+        def store(url, res):
+            raise IOError(28, 'No space left on device')
+
+        self.cache._store = store
+        urls = [self.server.image_url(p) for p in ('/a.gif', '/b.gif')]
+        result = dict(self.cache.prefetch(urls))
+        for url in urls:
+            self.assertIsInstance(result[url], GsxError)
+            self.assertIn('No space left', str(result[url]))
+
+
+class HarnessTestCase(TestCase):
+    """Smoke tests of the load test and benchmark scripts against the stand-in."""
+    def run_script(self, *args):
+        import sys
+        import subprocess
+        p = subprocess.Popen([sys.executable, '-m'] + list(args),
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                             cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        out = p.communicate()[0]
+        return p.returncode, out
+
+    def test_loadtest(self):
+        rc, out = self.run_script('tests.loadtest', 'warranty', '--stub',
+                                  '--threads', '2', '--requests', '4')
+        self.assertEqual(rc, 0, out)
+        self.assertIn('4 calls from 2 threads', out)
+        self.assertIn('error rate 0.00%', out)
+
+    def test_loadtest_writes(self):
+        from tests.loadtest import LoadTest
+        self.assertRaises(ValueError, LoadTest, 'create', 'DGKFL06JDHJP')
+        rc, out = self.run_script('tests.loadtest', 'create', '--requests', '1',
+                                  '--url', 'http://127.0.0.1:1/{env}/{region}')
+        self.assertEqual(rc, 2, out)
+        self.assertIn('--allow-writes', out)
+        rc, out = self.run_script('tests.loadtest', 'create', '--stub', '--requests', '2')
+        self.assertEqual(rc, 0, out)
+        self.assertIn('error rate 0.00%', out)
+
+    def test_benchmark(self):
+        import json
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'results.json')
+            rc, out = self.run_script('tests.benchmark', '--quick', '--save', path,
+                                      'e2e', 'parse.warranty_status', 'import.core')
+            self.assertEqual(rc, 0, out)
+            results = json.load(open(path))['results']
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(sorted(results), ['e2e.parts', 'e2e.repairs', 'e2e.warranty',
+                                           'import.core', 'parse.warranty_status'])
+        self.assertEqual(results['e2e.warranty']['number'], 1)
+
+
 class ConnectionTestCase(TestCase):
     """Basic connection tests."""
 